@@ -1,59 +1,48 @@
 import os
 import json
-import requests
-import datetime
+import hashlib
+import io
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-import google.genai as genai
-from google.genai import types
 from twilio.twiml.messaging_response import MessagingResponse
-from invoice_gen import generate_pdf
-from db_manager import (
-    get_user, create_user, update_user, set_user_state,
-    add_conversation_entry
+
+# Load environment variables from .env file before the project modules read their settings
+load_dotenv()
+
+from invoice_templates import invalidate_template
+from invoice_numbers import issue_invoice
+from db_manager import UserSession, cache_stats, is_onboarding_complete
+from async_worker import QueueWorker
+from job_queue import get_queue
+from message_coalescer import enqueue_message
+from order_import import (
+    IMPORT_API_TOKEN, RENDER_STAGE as IMPORT_RENDER_STAGE, detect_format, get_store as get_import_store,
+    handle_import_job, import_orders, record_import_failure, require_import_token
 )
+from idempotency import idempotent_webhook
+from reply_client import get_reply_client
+from media_fetcher import fetch_many_media, get_fetcher
+from image_preprocess import PREPROCESS_SIGNATURE, prepare_image, prepare_images
+from parse_cache import get_parse_cache, parse_cache_key, prompt_version
+from order_validation import ORDER_RESPONSE_SCHEMA, OrderDecodeError, decode_order_response, decoder_stats, missing_fields
+from fast_parser import MIN_CONFIDENCE, parse_text_order
+from slot_filler import fill_slots
+from item_catalog import apply_catalog, get_catalog_store, learn_order
+from customer_directory import learn_customer, resolve_customer
+from llm_client import GEMINI_MODEL, ExtractionRequest, LLMTimeout, LLMUnavailable, get_extractor
 
 app = Flask(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
-
-# Configure Google Gemini API with new package
-GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
-if GOOGLE_API_KEY:
-    client = genai.Client(api_key=GOOGLE_API_KEY)
+# The Gemini client, limiter and circuit breaker live in llm_client ($LLM_BACKEND, $GEMINI_MODEL)
 
-# Twilio credentials for media downloads
-TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
-TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+# Twilio credentials are read by media_fetcher and reply_client
+TWILIO_WHATSAPP_NUMBER = os.environ.get('TWILIO_WHATSAPP_NUMBER')
 
+# Async webhook mode: ack Twilio immediately and send the reply via the REST API
+ASYNC_WEBHOOK = os.environ.get('ASYNC_WEBHOOK', '0') == '1'
 
-def parse_order(media_url=None, text_body=None, pending_order=None, input_type='text', mime_type=None):
-    """
-    Parse order information from IMAGE, AUDIO, or TEXT using Google Gemini 2.5 Flash.
-    Now with OCR support for handwritten notes and intelligent missing field detection.
-    
-    Args:
-        media_url (str, optional): URL to media file (image/audio) to download and process
-        text_body (str, optional): Text message to process
-        pending_order (dict, optional): Previously extracted partial order data
-        input_type (str): 'image', 'audio', or 'text'
-        mime_type (str, optional): MIME type of the media (e.g., 'image/jpeg', 'audio/ogg')
-    
-    Returns:
-        dict: Response with structure:
-            {
-                'status': 'complete' | 'incomplete' | 'error',
-                'data': {'customer': str, 'items': [...]},
-                'missing_fields': ['customer', 'item_X_rate', ...],
-                'message': 'Human-readable message'
-            }
-    """
-    
-    # DYNAMIC SYSTEM PROMPT based on input type
-    if input_type == 'image':
-        # OCR-focused prompt for handwritten notes
-        system_prompt = """You are an intelligent OCR assistant for handwritten Kacha Bills (rough customer order notes).
+# OCR-focused prompt for handwritten notes
+IMAGE_SYSTEM_PROMPT = """You are an intelligent OCR assistant for handwritten Kacha Bills (rough customer order notes).
 
 Analyze the image carefully. The handwriting may be:
 - In Hindi, Marathi, English, or mixed languages
@@ -88,9 +77,9 @@ Rules:
 - Set status to "incomplete" if ANY information is missing or unclear
 - Return ONLY the JSON object
 """
-    else:
-        # Original prompt for audio/text with Hinglish translation
-        system_prompt = """You are an order processing assistant for Indian businesses. Extract order information and return a JSON object with this structure:
+
+# Prompt for audio/text with Hinglish translation
+TEXT_SYSTEM_PROMPT = """You are an order processing assistant for Indian businesses. Extract order information and return a JSON object with this structure:
 
 {
     "status": "complete" or "incomplete",
@@ -113,139 +102,182 @@ Rules:
 - If the message is just a greeting (Hi, Hello, etc.) or not an order, return status: incomplete with empty items
 - Return ONLY the JSON object
 """
+
+# Changes whenever a prompt or the model changes, so cached parses are never reused across versions
+PROMPT_VERSION = prompt_version(
+    IMAGE_SYSTEM_PROMPT, TEXT_SYSTEM_PROMPT, GEMINI_MODEL, PREPROCESS_SIGNATURE, json.dumps(ORDER_RESPONSE_SCHEMA)
+)
+
+
+def parse_order(media_url=None, text_body=None, pending_order=None, input_type='text', mime_type=None,
+                extra_media=None):
+    """
+    Parse order information from IMAGE, AUDIO, or TEXT using Google Gemini 2.5 Flash.
+    Now with OCR support for handwritten notes and intelligent missing field detection.
+    
+    Simple structured text orders are parsed locally by fast_parser, and short
+    follow-up answers to a pending order are merged into it by slot_filler;
+    both fall back to Gemini when their confidence is low. Model results are cached
+    by a hash of the input, pending order and prompt version, so a resent
+    photo, forwarded voice note or repeated text order skips the model call.
+    
+    Args:
+        media_url (str, optional): URL to media file (image/audio) to download and process
+        text_body (str, optional): Text message to process; with media it is
+            passed along as extra context (e.g. a caption or the customer name)
+        pending_order (dict, optional): Previously extracted partial order data
+        input_type (str): 'image', 'audio', or 'text'
+        mime_type (str, optional): MIME type of the media (e.g., 'image/jpeg', 'audio/ogg')
+        extra_media (list, optional): (url, mime_type) of further bill pages sent with
+            the first image; all pages are downloaded concurrently and extracted
+            together as one order
+    
+    Returns:
+        dict: Response with structure:
+            {
+                'status': 'complete' | 'incomplete' | 'error',
+                'data': {'customer': str, 'items': [...]},
+                'missing_fields': ['customer', 'item_X_rate', ...],
+                'message': 'Human-readable message'
+            }
+    """
+    
+    # DYNAMIC SYSTEM PROMPT based on input type
+    system_prompt = IMAGE_SYSTEM_PROMPT if input_type == 'image' else TEXT_SYSTEM_PROMPT
+    
+    # Local fast path for plain text orders like "Bill for Ramesh: 10 Rice at 50"
+    if input_type == 'text' and text_body and not pending_order:
+        local_result, confidence = parse_text_order(text_body)
+        if confidence >= MIN_CONFIDENCE:
+            print(f"⚡ Parsed locally (confidence {confidence:.2f}), skipping Gemini call")
+            return local_result
+    
+    # Short AWAITING_INFO answers like "Ramesh" or "rate 50" are merged locally
+    if input_type == 'text' and text_body and pending_order:
+        local_result, confidence = fill_slots(pending_order, text_body)
+        if confidence >= MIN_CONFIDENCE:
+            print(f"⚡ Filled {', '.join(missing_fields(pending_order))} locally, skipping Gemini call")
+            return local_result
     
     try:
-        # Use the new google.genai API
-        # Gemini 2.5 Flash is the default and best for this use case
-        model_name = 'gemini-3-flash-preview'
-        
         # Prepare context if there's a pending order
         context = ""
         if pending_order:
             context = f"\n\nPrevious partial order: {json.dumps(pending_order)}\nUpdate this with new information from the current message."
         
+        extra_media = list(extra_media or []) if input_type == 'image' else []
+        extra_data = []
         if input_type == 'image' and media_url:
-            # Download the image with Twilio authentication
+            # Download every page into memory concurrently with the pooled fetcher
             print(f"📸 Downloading IMAGE from: {media_url}")
             print(f"🎨 MIME Type: {mime_type}")
-            response = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-            print(f"Media Download Status: {response.status_code}")
-            response.raise_for_status()
-            
-            # Save temporarily
-            temp_image_path = '/tmp/order_image.jpg'
-            with open(temp_image_path, 'wb') as f:
-                f.write(response.content)
-            
-            # Read image file
-            print("📤 Uploading image to Gemini for OCR...")
-            with open(temp_image_path, 'rb') as f:
-                image_data = f.read()
-            
-            # Generate content with image using new API
-            result = client.models.generate_content(
-                model=model_name,
-                contents=[
-                    system_prompt + context,
-                    types.Part.from_bytes(
-                        data=image_data,
-                        mime_type=mime_type or 'image/jpeg'
-                    ),
-                    "Extract the order information from this handwritten note/bill image."
-                ]
-            )
-            
-            # Clean up
-            os.remove(temp_image_path)
-            print("✅ OCR processing complete")
-            
+            for url, _ in extra_media:
+                print(f"📸 Downloading IMAGE from: {url}")
+            downloads = fetch_many_media([media_url] + [url for url, _ in extra_media])
+            media_data = downloads[0].data
+            extra_data = [(download.data, page_mime) for download, (_, page_mime) in zip(downloads[1:], extra_media)]
         elif input_type == 'audio' and media_url:
-            # Download the audio file with Twilio authentication
+            # Download the audio into memory with the pooled fetcher
             print(f"🎤 Downloading AUDIO from: {media_url}")
-            response = requests.get(media_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-            print(f"Media Download Status: {response.status_code}")
-            response.raise_for_status()
+            media_data = fetch_many_media([media_url])[0].data
+        elif text_body:
+            media_data = None
+        else:
+            return {
+                "status": "error",
+                "message": "No input provided"
+            }
+        
+        # Text sent together with media (a caption or a coalesced burst) is extra context
+        extra_text = ""
+        if media_data is not None and text_body:
+            extra_text = f"\nThe merchant also wrote: {text_body}"
+        
+        # Identical input + context + prompts → reuse the previous extraction
+        if media_data is not None:
+            content = media_data + b''.join(hashlib.sha256(data).digest() for data, _ in extra_data)
+            content += extra_text.encode('utf-8')
+        else:
+            content = text_body
+        cache_key = parse_cache_key(content, input_type, pending_order, PROMPT_VERSION)
+        cached = get_parse_cache(PROMPT_VERSION).get(cache_key)
+        if cached is not None:
+            print("⚡ Parse cache hit, skipping Gemini call")
+            return cached
+        
+        if input_type == 'image' and media_data is not None and extra_data:
+            # Pages are preprocessed in parallel and sent in one request, merged into one order
+            prepared = prepare_images([(media_data, mime_type)] + extra_data)
+            print(f"📤 Uploading {len(prepared)} pages to Gemini for OCR...")
+            extraction = ExtractionRequest(
+                input_type, system_prompt + context,
+                f"Extract the order information from these {len(prepared)} handwritten note/bill images. "
+                "They are consecutive pages of one bill: return a single order with the items of every "
+                "page in page order, and take the customer from whichever page names it." + extra_text,
+                media=prepared[0].data, mime_type=prepared[0].mime_type,
+                extra_media=[(page.data, page.mime_type) for page in prepared[1:]],
+                response_schema=ORDER_RESPONSE_SCHEMA
+            )
             
-            # Save temporarily
-            temp_audio_path = '/tmp/order_audio.ogg'
-            with open(temp_audio_path, 'wb') as f:
-                f.write(response.content)
+        elif input_type == 'image' and media_data is not None:
+            # Rotate, downscale and recompress the photo before upload
+            prepared = prepare_image(media_data, mime_type)
+            print("📤 Uploading image to Gemini for OCR...")
+            extraction = ExtractionRequest(
+                input_type, system_prompt + context,
+                "Extract the order information from this handwritten note/bill image." + extra_text,
+                media=prepared.data, mime_type=prepared.mime_type,
+                response_schema=ORDER_RESPONSE_SCHEMA
+            )
             
-            # Read audio file
+        elif input_type == 'audio' and media_data is not None:
             print("📤 Uploading audio to Gemini...")
-            with open(temp_audio_path, 'rb') as f:
-                audio_data = f.read()
-            
-            # Generate content with audio using new API
-            result = client.models.generate_content(
-                model=model_name,
-                contents=[
-                    system_prompt + context,
-                    types.Part.from_bytes(
-                        data=audio_data,
-                        mime_type='audio/ogg'
-                    ),
-                    "Extract the order information from this audio."
-                ]
+            extraction = ExtractionRequest(
+                input_type, system_prompt + context,
+                "Extract the order information from this audio." + extra_text,
+                media=media_data, mime_type='audio/ogg',
+                response_schema=ORDER_RESPONSE_SCHEMA
             )
             
-            # Clean up
-            os.remove(temp_audio_path)
-            
-        elif text_body:
+        else:
             # Process text input
             print(f"📝 Processing TEXT: {text_body}")
-            result = client.models.generate_content(
-                model=model_name,
-                contents=[
-                    system_prompt + context,
-                    f"Extract the order information from this message: {text_body}"
-                ]
+            extraction = ExtractionRequest(
+                'text', system_prompt + context,
+                f"Extract the order information from this message: {text_body}",
+                text=text_body, response_schema=ORDER_RESPONSE_SCHEMA
             )
         
-        else:
-            return {
-                "status": "error",
-                "message": "No input provided"
-            }
+        # Limiter, deadline and circuit breaker are applied by the extractor
+        response_text = get_extractor().extract(extraction)
+        if input_type == 'image':
+            print("✅ OCR processing complete")
         
-        # Parse the response
-        response_text = result.text.strip()
-        print(f"Gemini response: {response_text}")
-        
-        # Remove markdown code blocks if present
-        if response_text.startswith('```'):
-            response_text = response_text.split('```')[1]
-            if response_text.startswith('json'):
-                response_text = response_text[4:]
-            response_text = response_text.strip()
-        
-        # Parse JSON
-        parsed_response = json.loads(response_text)
-        
-        # Validate and enhance the response
-        if parsed_response.get('status') == 'complete':
-            # Double-check completeness
-            data = parsed_response.get('data', {})
-            items = data.get('items', [])
-            
-            # Reject if no items or customer
-            if not data.get('customer') or not items or len(items) == 0:
-                parsed_response['status'] = 'incomplete'
-                if not data.get('customer'):
-                    parsed_response['missing_fields'] = ['customer'] + parsed_response.get('missing_fields', [])
-                if not items or len(items) == 0:
-                    parsed_response['missing_fields'] = parsed_response.get('missing_fields', []) + ['items']
-            
-            # Check each item has name, qty, and rate
-            for idx, item in enumerate(items):
-                if not item.get('name') or item.get('qty') is None or item.get('rate') is None:
-                    parsed_response['status'] = 'incomplete'
-                    if 'items' not in parsed_response.get('missing_fields', []):
-                        parsed_response['missing_fields'] = parsed_response.get('missing_fields', []) + ['item details']
+        print(f"Gemini response: {response_text.strip()}")
         
+        # Strict decode into a typed order; status and missing fields are recomputed
+        order = decode_order_response(response_text)
+        if order.repairs:
+            print(f"🔧 Repaired model response locally: {', '.join(order.repairs)}")
+        parsed_response = order.result()
+        
+        get_parse_cache(PROMPT_VERSION).put(cache_key, parsed_response)
         return parsed_response
         
+    except (LLMUnavailable, LLMTimeout) as e:
+        # Busy, slow or failing upstream: not the user's fault, and worth retrying
+        print(f"⏳ Model unavailable: {str(e)}")
+        return {
+            "status": "error",
+            "retryable": True,
+            "message": str(e)
+        }
+    except OrderDecodeError as e:
+        print(f"❌ Unreadable model response: {str(e)}")
+        return {
+            "status": "error",
+            "message": "I couldn't read the order details"
+        }
     except Exception as e:
         print(f"❌ Error parsing order: {str(e)}")
         return {
@@ -254,6 +286,314 @@ Rules:
         }
 
 
+def parse_message(session, incoming_msg, media_url, media_content_type, extra_media=None):
+    """
+    Detect the input type of a message and extract the order from it.
+    
+    Args:
+        session (UserSession): Open session for the sender
+        incoming_msg (str): Text body of the message
+        media_url (str, optional): URL of the attached media
+        media_content_type (str): MIME type of the attached media
+        extra_media (list, optional): (url, content_type) of the other attachments
+    
+    Returns:
+        dict: parse_order() result, with missing rates filled from the
+            user's item catalog and the customer matched against their
+            customer directory
+    """
+    # Detect input type based on MediaContentType0
+    input_type = 'text'  # Default
+    mime_type = None
+    
+    if media_url and media_content_type:
+        print(f"🔍 Detected MediaContentType0: {media_content_type}")
+        
+        # Check if it's an image
+        if 'image' in media_content_type.lower():
+            input_type = 'image'
+            mime_type = media_content_type
+            print(f"📸 IMAGE detected: {mime_type}")
+        
+        # Check if it's audio
+        elif 'audio' in media_content_type.lower():
+            input_type = 'audio'
+            mime_type = media_content_type
+            print(f"🎤 AUDIO detected: {mime_type}")
+    
+    # Further photos are more pages of the same bill
+    pages = []
+    if input_type == 'image':
+        pages = [(url, content_type) for url, content_type in extra_media or [] if 'image' in content_type.lower()]
+        if pages:
+            print(f"📚 {len(pages) + 1} pages attached")
+    if len(pages) != len(extra_media or []):
+        print(f"⚠️ Ignoring {len(extra_media) - len(pages)} attachment(s) that are not bill pages")
+    
+    # Parse the order with context and input type; only an order the bot is
+    # still asking about is continued, anything else starts a new order
+    pending_order = session.user.get('pending_order') if session.user.get('state') == 'AWAITING_INFO' else None
+    parse_result = parse_order(
+        media_url=media_url,
+        text_body=incoming_msg or None,  # A caption or coalesced text is read together with the media
+        pending_order=pending_order,
+        input_type=input_type,
+        mime_type=mime_type,
+        extra_media=pages
+    )
+    
+    # Fill rates the merchant left out from the items they billed before
+    parse_result, filled = apply_catalog(get_catalog_store().get(session.phone_number), parse_result)
+    if filled:
+        print(f"📒 Rates filled from item catalog: {', '.join(filled)}")
+    
+    # Match the customer against past invoices: extracted "ramesh kirana store" -> "Ramesh Kirana",
+    # near matches and the usual customer are suggested for the merchant to confirm
+    parse_result, action = resolve_customer(
+        session.phone_number,
+        session.user.get('customer_directory'),
+        parse_result,
+        extracted=input_type in ('image', 'audio')
+    )
+    if action:
+        data = parse_result['data']
+        print(f"👥 Customer {action} from directory: {data.get('customer') or data.get('customer_suggestion')}")
+    
+    print(f"Parse result: {parse_result}")
+    return parse_result
+
+
+def reply_for_parse_result(session, incoming_msg, parse_result):
+    """
+    Build the reply for an error or incomplete parse and update the session.
+    
+    Args:
+        session (UserSession): Open session for the sender
+        incoming_msg (str): Text body of the message
+        parse_result (dict): parse_order() result
+    
+    Returns:
+        str: Reply message, or None if the order is complete and should be rendered
+    """
+    # Model busy or down: ask the user to resend instead of blaming their message
+    if parse_result.get('status') == 'error' and parse_result.get('retryable'):
+        response_message = "⏳ I'm handling a lot of orders right now. Please send that again in a minute."
+        session.add_conversation_entry(incoming_msg, response_message)
+        
+        return response_message
+    
+    # Handle parsing error
+    elif parse_result.get('status') == 'error':
+        response_message = f"❌ Sorry, I couldn't understand that. Error: {parse_result.get('message')}\n\nPlease try again."
+        session.add_conversation_entry(incoming_msg, response_message)
+        
+        return response_message
+    
+    # Handle incomplete order - ask for missing info
+    elif parse_result.get('status') == 'incomplete':
+        missing = parse_result.get('missing_fields', [])
+        order_data = parse_result.get('data', {})
+        
+        # Save the partial order
+        session.set_state('AWAITING_INFO', pending_order=order_data)
+        
+        # Generate human-friendly message about what's missing
+        response_message = "📝 I got some information, but I need a bit more:\n\n"
+        
+        if 'customer' in missing:
+            suggestion = order_data.get('customer_suggestion')
+            as_sent = order_data.get('customer_as_sent')
+            if suggestion and as_sent:
+                response_message += f"• Customer: did you mean *{suggestion}*? Reply *yes*, or *no* to keep {as_sent}\n"
+            elif suggestion:
+                response_message += f"• Customer: is this for *{suggestion}*? Reply *yes* or send the name\n"
+            else:
+                response_message += "• Customer name\n"
+        
+        if 'items' in missing or 'item' in str(missing).lower():
+            response_message += "• Item details (name, quantity, price)\n"
+        
+        for field in missing:
+            if 'rate' in field.lower() and 'items' not in missing:
+                response_message += f"• Price/rate for some items\n"
+                break
+        
+        for field in missing:
+            if 'qty' in field.lower() and 'items' not in missing:
+                response_message += f"• Quantity for some items\n"
+                break
+        
+        response_message += "\nPlease provide the missing details."
+        
+        session.add_conversation_entry(incoming_msg, response_message)
+        
+        return response_message
+    
+    elif parse_result.get('status') == 'complete':
+        return None
+    
+    return 'Unknown state'
+
+
+def render_order(session, incoming_msg, order_data, host_url, reference=None):
+    """
+    Generate the invoice PDF for a complete order and reset the user to READY.
+    
+    The order's items, rates and customer are learned into the user's item
+    catalog and customer directory.
+    
+    Args:
+        session (UserSession): Open session for the sender
+        incoming_msg (str): Text body of the message
+        order_data (dict): Complete order with customer and items
+        host_url (str): Public base URL used to build the invoice link
+        reference (str, optional): Stable key of the message or job being
+            answered; a retry returns the invoice already issued under it
+            instead of taking another invoice number
+    
+    Returns:
+        str: Reply message with the invoice link
+    
+    Raises:
+        Exception: If PDF generation fails
+    """
+    # Get company details from database
+    company_details = session.user.get('company_details', {})
+    
+    # Generate the PDF under the merchant's next invoice number, which also names the file
+    print(f"Generating invoice for {order_data.get('customer')}")
+    invoice_number, pdf_filename = issue_invoice(session.phone_number, order_data, company_details, reference=reference)
+    
+    # Remember items, rates and the customer for future orders
+    get_catalog_store().update(session.phone_number, lambda catalog: learn_order(catalog, order_data))
+    session.update_field('customer_directory', lambda directory: learn_customer(directory, order_data.get('customer')))
+    
+    # Create the full URL to the invoice
+    invoice_url = f"{host_url}static/{pdf_filename}"
+    print(f"Invoice URL: {invoice_url}")
+    
+    # Clear pending order and reset state (set_state leaves pending_order alone when given None)
+    session.update({'state': 'READY', 'pending_order': None})
+    
+    response_message = f"✅ Invoice {invoice_number} generated successfully!\n\n🧾 Customer: {order_data.get('customer')}\n📥 Download: {invoice_url}"
+    
+    session.add_conversation_entry(incoming_msg, response_message)
+    
+    return response_message
+
+
+def process_order(session, incoming_msg, media_url, media_content_type, host_url, extra_media=None, reference=None):
+    """
+    Parse an order message and either ask for missing details or generate the invoice.
+    
+    Args:
+        session (UserSession): Open session for the sender
+        incoming_msg (str): Text body of the message
+        media_url (str, optional): URL of the attached media
+        media_content_type (str): MIME type of the attached media
+        host_url (str): Public base URL used to build the invoice link
+        extra_media (list, optional): (url, content_type) of the other attachments
+        reference (str, optional): Idempotency key for the invoice, as for render_order
+    
+    Returns:
+        str: Reply message for the user
+    """
+    parse_result = parse_message(session, incoming_msg, media_url, media_content_type, extra_media)
+    
+    response_message = reply_for_parse_result(session, incoming_msg, parse_result)
+    if response_message is not None:
+        return response_message
+    
+    # Handle complete order - generate invoice!
+    try:
+        return render_order(session, incoming_msg, parse_result.get('data', {}), host_url, reference)
+    except Exception as e:
+        print(f"Error generating invoice: {str(e)}")
+        response_message = f"❌ Sorry, invoice generation failed: {str(e)}"
+        session.add_conversation_entry(incoming_msg, response_message)
+        
+        return response_message
+
+
+def handle_parse_job(payload, job):
+    """
+    Queue stage 'parse': extract the order and checkpoint a complete result.
+    
+    Complete orders are handed to the 'render' stage with the parsed data in
+    the payload, so a render failure never repeats the Gemini call. When the
+    model is unavailable the job fails and is retried with backoff.
+    """
+    with UserSession(payload['sender']) as session:
+        parse_result = parse_message(
+            session, payload['incoming_msg'], payload['media_url'], payload['media_content_type'],
+            payload.get('extra_media')
+        )
+        if parse_result.get('retryable'):
+            # Let the queue retry with backoff instead of replying with an error
+            raise LLMUnavailable(parse_result.get('message'))
+        response_message = reply_for_parse_result(session, payload['incoming_msg'], parse_result)
+    
+    if response_message is not None:
+        return [('reply', reply_payload(payload, response_message))]
+    
+    return [('render', {**payload, 'order_data': parse_result.get('data', {})})]
+
+
+def handle_render_job(payload, job):
+    """Queue stage 'render': generate the invoice for a checkpointed order."""
+    with UserSession(payload['sender']) as session:
+        # A retried render job (lost lease, failed commit) returns its first invoice
+        response_message = render_order(
+            session, payload['incoming_msg'], payload['order_data'], payload['host_url'],
+            reference=f"job-{job['id']}"
+        )
+    
+    return [('reply', reply_payload(payload, response_message))]
+
+
+def handle_reply_job(payload, job):
+    """Queue stage 'reply': deliver a message through the Twilio REST API."""
+    get_reply_client().send(to=payload['to'], from_=payload['from'], body=payload['body'])
+
+
+def reply_payload(payload, body):
+    """Build a 'reply' job payload answering the sender of a parse/render job."""
+    return {'to': payload['sender'], 'from': payload['bot_number'], 'body': body}
+
+
+def handle_dead_job(job, error):
+    """Tell the user when their order could not be processed after all retries."""
+    payload = job['payload']
+    if job['stage'] == 'reply':
+        return
+    if job['stage'] == IMPORT_RENDER_STAGE:
+        record_import_failure(job, error)
+        return
+    
+    if job['stage'] == 'render':
+        response_message = f"❌ Sorry, invoice generation failed: {str(error)}"
+    elif isinstance(error, LLMUnavailable):
+        response_message = "⏳ I'm handling a lot of orders right now. Please send that again in a few minutes."
+    else:
+        response_message = f"❌ Sorry, I couldn't understand that. Error: {str(error)}\n\nPlease try again."
+    
+    with UserSession(payload['sender']) as session:
+        session.add_conversation_entry(payload['incoming_msg'], response_message)
+    get_reply_client().send(to=payload['sender'], from_=payload['bot_number'], body=response_message)
+
+
+order_worker = QueueWorker(
+    {'parse': handle_parse_job, 'render': handle_render_job, 'reply': handle_reply_job,
+     IMPORT_RENDER_STAGE: handle_import_job},
+    concurrency=int(os.environ.get('ASYNC_WORKERS', 4)),
+    on_dead=handle_dead_job,
+    background_stages=[IMPORT_RENDER_STAGE]
+)
+# Imported orders are rendered by the same workers, after any live WhatsApp work
+if ASYNC_WEBHOOK or IMPORT_API_TOKEN:
+    order_worker.start()
+
+
 @app.route('/', methods=['GET'])
 def home():
     """Welcome page to verify server is running"""
@@ -302,26 +642,95 @@ def home():
     """, 200
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Processing metrics: model calls, response decoding, media downloads and the caches."""
+    return jsonify({
+        'decoder': decoder_stats(),
+        'llm': get_extractor().stats(),
+        'parse_cache': get_parse_cache(PROMPT_VERSION).stats(),
+        'media': get_fetcher().stats(),
+        'user_cache': cache_stats()  # None unless USER_CACHE_SIZE > 0
+    }), 200
+
+
+@app.route('/import', methods=['POST'])
+@require_import_token
+def import_upload():
+    """
+    Stream a CSV or JSONL file of orders (the raw request body) into the render queue.
+    
+    Query args: phone (the merchant, who must have finished onboarding) and
+    optionally format ('csv' or 'jsonl', otherwise taken from the Content-Type).
+    Returns the import id and its progress; poll GET /import/<id> afterwards.
+    """
+    phone = request.args.get('phone', '')
+    if not is_onboarding_complete(phone):
+        return jsonify({'error': 'Unknown merchant or onboarding not complete'}), 400
+    
+    fmt = request.args.get('format') or detect_format(content_type=request.content_type)
+    # Read the body as a text stream, row by row, without buffering the upload
+    lines = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    progress = import_orders(lines, phone, fmt)
+    return jsonify(progress), 400 if progress['status'] == 'aborted' else 202
+
+
+@app.route('/import/<int:import_id>', methods=['GET'])
+@require_import_token
+def import_status(import_id):
+    """Progress of an order import."""
+    progress = get_import_store().get(import_id)
+    if progress is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(progress), 200
+
+
 @app.route('/whatsapp', methods=['POST'])
+@idempotent_webhook
 def whatsapp():
     """
     Handle incoming WhatsApp messages via Twilio webhook with conversation state management.
+    
+    The user record is loaded once and written back once per message, and
+    Twilio retries of the same MessageSid are answered from the idempotency store.
+    """
+    sender = request.form.get('From', '')
+    with UserSession(sender) as session:
+        return handle_message(session)
+
+
+def handle_message(session):
+    """
+    Run the conversation state machine for one message against a user session.
+    
+    Args:
+        session (UserSession): Open session for the sender
+    
+    Returns:
+        tuple: (TwiML string, HTTP status)
     """
     # Get form data from the incoming request
     incoming_msg = request.form.get('Body', '').strip()
-    sender = request.form.get('From', '')
+    sender = session.phone_number
     media_url = request.form.get('MediaUrl0', None)
+    # Attachments after the first, e.g. more pages of a long bill; Twilio sends at most 10
+    num_media = min(request.form.get('NumMedia', 0, type=int), 10)
+    extra_media = [
+        (request.form.get(f'MediaUrl{i}'), request.form.get(f'MediaContentType{i}', ''))
+        for i in range(1, num_media) if request.form.get(f'MediaUrl{i}')
+    ]
     
     # Log the incoming message
     print(f"\n{'='*60}")
     print(f"Received message from {sender}: {incoming_msg}")
     if media_url:
         print(f"Media URL: {media_url}")
+    for url, _ in extra_media:
+        print(f"Media URL: {url}")
     
     # Get or create user
-    user = get_user(sender)
-    if not user:
-        user = create_user(sender)
+    user = session.user
+    if session.is_new:
         print(f"New user created: {sender}")
     
     print(f"User state: {user.get('state')}")
@@ -334,7 +743,7 @@ def whatsapp():
     if command in greetings:
         # If user has pending order, cancel it
         if user.get('state') in ['AWAITING_INFO', 'COLLECTING_ORDER']:
-            update_user(sender, {
+            session.update({
                 'state': 'READY',
                 'pending_order': None
             })
@@ -350,12 +759,7 @@ def whatsapp():
     
     if command in ['reset', 'start over', 'restart', 'new']:
         # Reset user to NEW state for re-onboarding
-        update_user(sender, {
-            'state': 'NEW',
-            'onboarding_step': 0,
-            'company_details': {},
-            'pending_order': None
-        })
+        session.reset()
         resp = MessagingResponse()
         resp.message("🔄 Account reset! Let's start fresh.\n\nSend 'hi' to begin onboarding.")
         return str(resp), 200
@@ -371,12 +775,12 @@ def whatsapp():
     
     # ========== STATE: NEW USER ==========
     if user['state'] == 'NEW':
-        update_user(sender, {
+        session.update({
             'state': 'ONBOARDING',
             'onboarding_step': 1
         })
         response_message = "👋 Welcome to BillBot!\n\nI'll help you generate invoices instantly. First, let me get your company details.\n\n📝 What is your Company Name?"
-        add_conversation_entry(sender, incoming_msg, response_message)
+        session.add_conversation_entry(incoming_msg, response_message)
         
         # Return TwiML response for WhatsApp
         resp = MessagingResponse()
@@ -386,10 +790,12 @@ def whatsapp():
     # ========== STATE: ONBOARDING ==========
     elif user['state'] == 'ONBOARDING':
         step = user.get('onboarding_step', 1)
+        # Company details are about to change; drop their cached invoice letterhead
+        invalidate_template(user.get('company_details'))
         
         if step == 1:
             # Capture company name
-            update_user(sender, {
+            session.update({
                 'company_details': {'name': incoming_msg},
                 'onboarding_step': 2
             })
@@ -398,27 +804,27 @@ def whatsapp():
         elif step == 2:
             # Capture address (optional)
             if incoming_msg.lower() != 'skip':
-                update_user(sender, {
+                session.update({
                     'company_details': {'address': incoming_msg},
                     'onboarding_step': 3
                 })
             else:
-                update_user(sender, {'onboarding_step': 3})
+                session.update({'onboarding_step': 3})
             response_message = "🔢 What is your GSTIN number? (Type 'skip' if not applicable)"
         
         elif step == 3:
             # Capture GSTIN (optional)
             if incoming_msg.lower() != 'skip':
-                update_user(sender, {
+                session.update({
                     'company_details': {'gstin': incoming_msg},
                     'state': 'READY'
                 })
             else:
-                update_user(sender, {'state': 'READY'})
+                session.update({'state': 'READY'})
             
             response_message = "🎉 Setup complete! You're all set.\n\n📋 To create an invoice, just send me an order like:\n\n\"Bill for Ramesh Kirana:\n- 10 Rice bags at ₹50 each\n- 5 Oil bottles at ₹120 each\"\n\nTry it now!"
         
-        add_conversation_entry(sender, incoming_msg, response_message)
+        session.add_conversation_entry(incoming_msg, response_message)
         
         # Return TwiML response for WhatsApp
         resp = MessagingResponse()
@@ -427,127 +833,39 @@ def whatsapp():
     
     # ========== STATE: READY or COLLECTING_ORDER ==========
     elif user['state'] in ['READY', 'COLLECTING_ORDER', 'AWAITING_INFO']:
-        
-        # Detect input type based on MediaContentType0
         media_content_type = request.form.get('MediaContentType0', '')
-        input_type = 'text'  # Default
-        mime_type = None
-        
-        if media_url and media_content_type:
-            print(f"🔍 Detected MediaContentType0: {media_content_type}")
-            
-            # Check if it's an image
-            if 'image' in media_content_type.lower():
-                input_type = 'image'
-                mime_type = media_content_type
-                print(f"📸 IMAGE detected: {mime_type}")
-            
-            # Check if it's audio
-            elif 'audio' in media_content_type.lower():
-                input_type = 'audio'
-                mime_type = media_content_type
-                print(f"🎤 AUDIO detected: {mime_type}")
-        
-        # Parse the order with context and input type
-        pending_order = user.get('pending_order')
-        parse_result = parse_order(
-            media_url=media_url,
-            text_body=incoming_msg if not media_url else None,  # Only use text if no media
-            pending_order=pending_order,
-            input_type=input_type,
-            mime_type=mime_type
-        )
-        
-        print(f"Parse result: {parse_result}")
         
-        # Handle parsing error
-        if parse_result.get('status') == 'error':
-            response_message = f"❌ Sorry, I couldn't understand that. Error: {parse_result.get('message')}\n\nPlease try again."
-            add_conversation_entry(sender, incoming_msg, response_message)
+        if ASYNC_WEBHOOK:
+            # Ack Twilio right away and reply out-of-band once the order is processed
+            if not incoming_msg and not media_url:
+                resp = MessagingResponse()
+                resp.message("❌ Sorry, I couldn't understand that. Error: No input provided\n\nPlease try again.")
+                return str(resp), 200
             
-            # Return TwiML response for WhatsApp
-            resp = MessagingResponse()
-            resp.message(response_message)
-            return str(resp), 200
+            # Messages of a quick burst are merged into one pending parse job
+            job_id, merged = enqueue_message(get_queue(), {
+                'sender': sender,
+                'bot_number': request.form.get('To') or TWILIO_WHATSAPP_NUMBER,
+                'incoming_msg': incoming_msg,
+                'media_url': media_url,
+                'media_content_type': media_content_type,
+                'extra_media': extra_media,
+                'host_url': request.host_url
+            })
+            print(f"⏳ Order {'merged into' if merged else 'queued for async processing:'} job #{job_id}")
+            return str(MessagingResponse()), 200
         
-        # Handle incomplete order - ask for missing info
-        elif parse_result.get('status') == 'incomplete':
-            missing = parse_result.get('missing_fields', [])
-            order_data = parse_result.get('data', {})
-            
-            # Save the partial order
-            set_user_state(sender, 'AWAITING_INFO', pending_order=order_data)
-            
-            # Generate human-friendly message about what's missing
-            response_message = "📝 I got some information, but I need a bit more:\n\n"
-            
-            if 'customer' in missing:
-                response_message += "• Customer name\n"
-            
-            if 'items' in missing or 'item' in str(missing).lower():
-                response_message += "• Item details (name, quantity, price)\n"
-            
-            for field in missing:
-                if 'rate' in field.lower() and 'items' not in missing:
-                    response_message += f"• Price/rate for some items\n"
-                    break
-            
-            for field in missing:
-                if 'qty' in field.lower() and 'items' not in missing:
-                    response_message += f"• Quantity for some items\n"
-                    break
-            
-            response_message += "\nPlease provide the missing details."
-            
-            add_conversation_entry(sender, incoming_msg, response_message)
-            
-            # Return TwiML response for WhatsApp
-            resp = MessagingResponse()
-            resp.message(response_message)
-            return str(resp), 200
+        # Twilio retries a failed webhook with the same MessageSid; reuse its invoice
+        sid = request.form.get('MessageSid')
+        response_message = process_order(
+            session, incoming_msg, media_url, media_content_type, request.host_url, extra_media,
+            reference=f"msg-{sid}" if sid else None
+        )
         
-        # Handle complete order - generate invoice!
-        elif parse_result.get('status') == 'complete':
-            order_data = parse_result.get('data', {})
-            
-            try:
-                # Get company details from database
-                company_details = user.get('company_details', {})
-                
-                # Create a unique filename
-                timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-                customer_clean = order_data.get('customer', 'Unknown').replace(' ', '_')
-                pdf_filename = f"invoice_{customer_clean}_{timestamp}.pdf"
-                
-                # Generate the PDF with company details
-                print(f"Generating invoice: {pdf_filename}")
-                generate_pdf(order_data, pdf_filename, company_details)
-                
-                # Create the full URL to the invoice
-                invoice_url = f"{request.host_url}static/{pdf_filename}"
-                print(f"Invoice URL: {invoice_url}")
-                
-                # Clear pending order and reset state
-                set_user_state(sender, 'READY', pending_order=None)
-                
-                response_message = f"✅ Invoice generated successfully!\n\n🧾 Customer: {order_data.get('customer')}\n📥 Download: {invoice_url}"
-                
-                add_conversation_entry(sender, incoming_msg, response_message)
-                
-                # Return TwiML response for WhatsApp
-                resp = MessagingResponse()
-                resp.message(response_message)
-                return str(resp), 200
-                
-            except Exception as e:
-                print(f"Error generating invoice: {str(e)}")
-                response_message = f"❌ Sorry, invoice generation failed: {str(e)}"
-                add_conversation_entry(sender, incoming_msg, response_message)
-                
-                # Return TwiML error response for WhatsApp
-                resp = MessagingResponse()
-                resp.message(response_message)
-                return str(resp), 200
+        # Return TwiML response for WhatsApp
+        resp = MessagingResponse()
+        resp.message(response_message)
+        return str(resp), 200
     
     # Default fallback
     resp = MessagingResponse()
@@ -0,0 +1,125 @@
+"""
+Background workers for out-of-band order processing.
+
+Workers poll the durable job queue (job_queue.py), run the handler
+registered for each job's stage and record the outcome. Follow-up stages
+returned by a handler are enqueued in the same transaction that completes
+the job, so a finished parse is checkpointed before rendering starts.
+While a handler runs, its lease is extended every third of the lease time,
+so slow renders are not reclaimed and run twice.
+
+Background stages (bulk work such as imported orders) are only claimed
+when no interactive job is runnable, so a live WhatsApp reply waits for at
+most the background jobs already running, not for the whole backlog.
+"""
+import threading
+import time
+import traceback
+
+from job_queue import LEASE_SECONDS, get_queue
+
+
+class QueueWorker:
+    """
+    Pool of threads that process jobs from a JobQueue.
+
+    Handlers are called as handler(payload, job) and may return a list of
+    (stage, payload) follow-up jobs, which inherit the job's key.
+    on_dead(job, error) is called when a job exhausts its retries. Jobs of
+    background_stages are claimed only when no other stage has a runnable job.
+    """
+
+    def __init__(self, handlers, queue=None, concurrency=4, poll_interval=0.5,
+                 lease_seconds=LEASE_SECONDS, on_dead=None, background_stages=()):
+        self.handlers = handlers
+        self.background_stages = [stage for stage in handlers if stage in background_stages]
+        self.interactive_stages = [stage for stage in handlers if stage not in background_stages]
+        self._queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.on_dead = on_dead
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def queue(self):
+        # Resolved lazily so importing the app never creates the queue file
+        if self._queue is None:
+            self._queue = get_queue()
+        return self._queue
+
+    def start(self):
+        """Start the worker threads."""
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f"billbot-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, wait=True):
+        """Ask the worker threads to exit after their current job."""
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._stop.wait(self.poll_interval)
+
+    def run_once(self):
+        """
+        Claim and process a single job.
+
+        Returns:
+            bool: True if a job was processed, False if the queue was idle
+        """
+        job = self._claim()
+        if job is None:
+            return False
+
+        started = time.perf_counter()
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, finished), daemon=True)
+        heartbeat.start()
+        try:
+            next_jobs = self.handlers[job['stage']](job['payload'], job) or []
+            next_ids = self.queue.complete(
+                job['id'], job['lease_token'],
+                result={'seconds': round(time.perf_counter() - started, 3)},
+                next_jobs=[(stage, payload, job['key']) for stage, payload in next_jobs]
+            )
+            if next_ids is None:
+                print(f"⚠️ Lost the lease on {job['stage']} job #{job['id']}; its result was discarded")
+        except Exception as e:
+            print(f"❌ {job['stage']} job #{job['id']} failed (attempt {job['attempts']}): {str(e)}")
+            traceback.print_exc()
+            if self.queue.fail(job['id'], job['lease_token'], e) == 'dead':
+                print(f"💀 Job #{job['id']} moved to dead-letter queue")
+                if self.on_dead:
+                    try:
+                        self.on_dead(job, e)
+                    except Exception as callback_error:
+                        print(f"❌ Dead-letter callback failed: {str(callback_error)}")
+        finally:
+            finished.set()
+            heartbeat.join()
+        return True
+
+    def _claim(self):
+        """Lease the next interactive job, or a background job if none is runnable."""
+        for stages in (self.interactive_stages, self.background_stages):
+            if stages:
+                job = self.queue.claim(stages, self.lease_seconds)
+                if job is not None:
+                    return job
+        return None
+
+    def _heartbeat(self, job, finished):
+        """Keep extending a job's lease until its handler finishes."""
+        while not finished.wait(self.lease_seconds / 3):
+            if not self.queue.extend(job['id'], job['lease_token'], self.lease_seconds):
+                print(f"⚠️ Lost the lease on {job['stage']} job #{job['id']}")
+                return
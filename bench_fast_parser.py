@@ -0,0 +1,93 @@
+"""
+Benchmark for the local fast-path parser.
+
+Runs fast_parser over a labelled corpus (fast_parser_corpus.jsonl) and
+reports how much traffic it handles locally, how often the local result
+matches the label, and how long it takes. Lines labelled with
+"expected": null are messages that should fall back to Gemini.
+
+Usage: python bench_fast_parser.py [corpus.jsonl] [--model]
+
+With --model every message is also sent through app.parse_order with the
+fast path disabled to compare latency, using the extractor chosen by
+LLM_BACKEND (Gemini needs GOOGLE_API_KEY).
+"""
+import json
+import statistics
+import sys
+import time
+
+from fast_parser import MIN_CONFIDENCE, parse_text_order
+
+REPEAT = 200
+
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _matches(data, expected):
+    if (data.get('customer') or None) != expected.get('customer'):
+        return False
+    items = [(i.get('name', '').lower(), i.get('qty'), i.get('rate')) for i in data.get('items', [])]
+    wanted = [(i['name'].lower(), i['qty'], i['rate']) for i in expected['items']]
+    return items == wanted
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_local(corpus):
+    handled = correct = false_accepts = 0
+    timings = []
+    for case in corpus:
+        started = time.perf_counter()
+        for _ in range(REPEAT):
+            result, confidence = parse_text_order(case['text'])
+        timings.append((time.perf_counter() - started) / REPEAT)
+
+        if confidence < MIN_CONFIDENCE:
+            continue
+        handled += 1
+        if case['expected'] is None:
+            false_accepts += 1
+            print(f"  accepted a fallback case: {case['text']!r}")
+        elif _matches(result['data'], case['expected']):
+            correct += 1
+        else:
+            print(f"  mismatch: {case['text']!r}\n    got {result['data']}")
+
+    print(f"Local fast path (threshold {MIN_CONFIDENCE})")
+    print(f"  messages:       {len(corpus)}")
+    print(f"  coverage:       {handled / len(corpus):.1%} ({handled} handled locally)")
+    if handled:
+        print(f"  accuracy:       {correct / handled:.1%} ({false_accepts} false accepts)")
+    print(f"  latency mean:   {statistics.mean(timings) * 1e6:.1f}us")
+    print(f"  latency p99:    {_percentile(timings, 0.99) * 1e6:.1f}us")
+
+
+def run_model(corpus):
+    import os
+    os.environ.setdefault('PARSE_CACHE', '0')
+    import app
+    app.MIN_CONFIDENCE = float('inf')  # force every message through the model
+
+    timings = []
+    for case in corpus:
+        started = time.perf_counter()
+        app.parse_order(text_body=case['text'], input_type='text')
+        timings.append(time.perf_counter() - started)
+    print(f"Model path ({app.get_extractor().name})")
+    print(f"  latency mean:   {statistics.mean(timings) * 1000:.0f}ms")
+    print(f"  latency p99:    {_percentile(timings, 0.99) * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    corpus = load_corpus(args[0] if args else 'fast_parser_corpus.jsonl')
+    run_local(corpus)
+    if '--model' in sys.argv:
+        run_model(corpus)
@@ -0,0 +1,112 @@
+"""
+Benchmark for image preprocessing before OCR upload.
+
+Reports bytes saved and latency per image before and after preprocessing.
+Upload time is estimated from --uplink-kbps. With --model both versions
+are also sent to the extractor chosen by LLM_BACKEND (Gemini needs
+GOOGLE_API_KEY) and the real end-to-end OCR latency is measured.
+
+Usage: python bench_image_preprocess.py [image files or directories] [--uplink-kbps=2000] [--model]
+
+Without image arguments a synthetic 12MP photo of a handwritten bill is
+generated, so the script runs anywhere.
+"""
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from image_preprocess import get_preprocessor
+from llm_client import ExtractionRequest, get_extractor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic')
+
+
+def synthetic_bill(width=4000, height=3000, seed=7):
+    """A noisy, slightly tinted 12MP JPEG resembling a phone photo of a bill."""
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (236, 230, 214))
+    draw = ImageDraw.Draw(image)
+    for y in range(300, height - 300, 180):
+        x = 400
+        while x < width - 600:
+            word = rng.randint(80, 360)
+            for i in range(0, word, 12):
+                draw.line((x + i, y + rng.randint(-20, 20), x + i + 12, y + rng.randint(-20, 20)),
+                          fill=(40, 40, 90), width=9)
+            x += word + rng.randint(60, 160)
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    image = Image.blend(image, noise, 0.12).filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def load_images(paths):
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(load_images(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            ))
+        else:
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+    return images
+
+
+def time_ocr(extractor, data, mime_type):
+    from app import IMAGE_SYSTEM_PROMPT
+
+    started = time.perf_counter()
+    extractor.extract(ExtractionRequest(
+        'image', IMAGE_SYSTEM_PROMPT,
+        "Extract the order information from this handwritten note/bill image.",
+        media=data, mime_type=mime_type
+    ))
+    return time.perf_counter() - started
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    uplink_kbps = float(options.get('uplink-kbps', 2000))
+    use_model = '--model' in sys.argv
+
+    images = load_images(args) if args else [('synthetic-bill.jpg', synthetic_bill())]
+    preprocessor = get_preprocessor()
+
+    extractor = get_extractor() if use_model else None
+
+    def upload(size):
+        return size * 8 / (uplink_kbps * 1000)
+
+    before, after = [], []
+    print(f"{'image':<28}{'before':>12}{'after':>12}{'saved':>8}{'prep ms':>9}{'e2e before':>12}{'e2e after':>11}")
+    for name, data in images:
+        prepared = preprocessor.prepare(data, 'image/jpeg')
+        e2e_before = upload(len(data))
+        e2e_after = prepared.seconds + upload(prepared.size)
+        if extractor is not None:
+            e2e_before = time_ocr(extractor, data, 'image/jpeg')
+            e2e_after = prepared.seconds + time_ocr(extractor, prepared.data, prepared.mime_type)
+        before.append(e2e_before)
+        after.append(e2e_after)
+        print(f"{name[:27]:<28}{len(data):>12,}{prepared.size:>12,}{1 - prepared.size / len(data):>8.0%}"
+              f"{prepared.seconds * 1000:>9.0f}{e2e_before:>11.2f}s{e2e_after:>10.2f}s")
+
+    stats = preprocessor.stats()
+    kind = f'measured with {extractor.name}' if extractor is not None else f'estimated upload at {uplink_kbps:.0f} kbps'
+    print(f"\nTotal: {stats['bytes_in']:,} -> {stats['bytes_out']:,} bytes "
+          f"({stats['bytes_saved'] / max(stats['bytes_in'], 1):.0%} saved), "
+          f"avg preprocessing {stats['avg_seconds'] * 1000:.0f}ms")
+    print(f"Mean latency ({kind}): {statistics.mean(before):.2f}s before, {statistics.mean(after):.2f}s after")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark for the two invoice rendering engines.
+
+Renders the same orders with the direct-canvas engine (fast_invoice) and
+the platypus engine (invoice_gen) and reports renders per second, latency
+and PDF size for each. Orders that overflow one page are rendered by
+platypus in both runs, as generate_pdf does in production.
+
+Usage: python bench_invoice_engines.py [--items=1,3,5,9,20] [--repeat=100]
+
+PDFs are written to static/ as bench_*.pdf and removed afterwards.
+"""
+import os
+import statistics
+import sys
+import time
+
+from invoice_gen import generate_pdf
+
+COMPANY = {
+    'name': 'Sharma Kirana Stores',
+    'address': '12 Station Road, Pune, Maharashtra - 411001',
+    'gstin': '27ABCDE1234F1Z5'
+}
+ENGINES = ('fast', 'platypus')
+
+
+def sample_order(item_count):
+    names = ['Basmati Rice 5kg', 'Sunflower Oil 1L', 'Toor Dal', 'Sugar', 'Atta 10kg', 'Tea Powder']
+    return {
+        'customer': 'Ramesh Traders',
+        'items': [
+            {'name': names[i % len(names)], 'qty': i % 7 + 1, 'rate': 40.0 + i * 5}
+            for i in range(item_count)
+        ]
+    }
+
+
+def _option(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith(f'--{name}='):
+            return arg.split('=', 1)[1]
+    return default
+
+
+def run(engine, order, repeat):
+    filename = f'bench_{engine}.pdf'
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        path = generate_pdf(order, filename, COMPANY, engine=engine)
+        timings.append(time.perf_counter() - started)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return timings, size
+
+
+if __name__ == '__main__':
+    item_counts = [int(n) for n in _option('items', '1,3,5,9,20').split(',')]
+    repeat = int(_option('repeat', 100))
+
+    # Warm up the template cache and reportlab's font metrics
+    for engine in ENGINES:
+        run(engine, sample_order(3), 2)
+
+    results = []
+    for item_count in item_counts:
+        order = sample_order(item_count)
+        row = {'items': item_count}
+        for engine in ENGINES:
+            row[engine] = run(engine, order, repeat)
+        results.append(row)
+
+    print(f"\n{'items':>5}  {'engine':<9} {'renders/s':>10} {'mean':>9} {'p95':>9} {'size':>9}")
+    for row in results:
+        for engine in ENGINES:
+            timings, size = row[engine]
+            p95 = sorted(timings)[min(len(timings) - 1, int(len(timings) * 0.95))]
+            print(f"{row['items']:>5}  {engine:<9} {1 / statistics.mean(timings):>10.0f} "
+                  f"{statistics.mean(timings) * 1000:>7.2f}ms {p95 * 1000:>7.2f}ms {size / 1024:>7.1f}KB")
+        fast_mean = statistics.mean(row['fast'][0])
+        platypus_mean = statistics.mean(row['platypus'][0])
+        print(f"{'':>5}  speedup   {platypus_mean / fast_mean:>9.1f}x")
@@ -0,0 +1,288 @@
+"""
+Bulk invoice rendering on a process pool.
+
+Month-end re-issues and batch runs render thousands of invoices. ReportLab
+rendering is CPU-bound and holds the GIL, so threads do not help; this
+module fans orders out over a ProcessPoolExecutor instead. Each worker
+warms up once (imports, fonts, the invoice template of the first company)
+and then keeps its per-company templates cached for the whole run.
+
+Orders are read as a stream and at most max_in_flight are pending at a
+time, so memory stays flat however long the input is. Every order gets a
+result record (rendered or failed, with the reason), and the run reports
+its throughput.
+
+Input is JSONL, one order per line:
+
+    {"id": "A-17", "customer": "Ramesh", "items": [{"name": "Rice", "qty": 10, "rate": 50}],
+     "phone": "whatsapp:+91...", "company_details": {"name": "...", "address": "...", "gstin": "..."},
+     "invoice_number": "optional, e.g. INV-000042 when re-issuing", "filename": "optional.pdf"}
+
+Orders are decoded with order_validation.decode_order, like imported
+orders: numbers written as "₹50" are coerced, and zero quantities,
+negative rates and other invalid values fail the order. Orders without an
+invoice_number get the merchant's next number from invoice_numbers (keyed
+by phone) and are named after it, like WhatsApp invoices; re-issues keep
+their number. Every order needs one of the two. The files of re-issues
+carry a key of the merchant (phone, else company_details), so two
+merchants' INV-000042 never overwrite each other.
+
+CLI:
+    python bulk_render.py orders.jsonl [--workers=N] [--in-flight=N] [--report=results.jsonl]
+                          [--engine=auto|fast|platypus]
+
+Use '-' to read orders from stdin. PDFs are written to static/.
+"""
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from invoice_numbers import company_key
+from order_validation import OrderDecodeError, decode_order
+
+WORKERS = int(os.environ.get('BULK_RENDER_WORKERS', os.cpu_count() or 2))
+# Pending orders per worker; bounds memory while keeping workers busy
+IN_FLIGHT_PER_WORKER = 4
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), 'static')
+
+
+@dataclass
+class BulkStats:
+    total: int = 0
+    rendered: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    render_seconds: float = 0.0  # Summed across workers
+    failures: dict = field(default_factory=dict)  # reason -> count
+
+    @property
+    def throughput(self):
+        return self.rendered / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'rendered': self.rendered,
+            'failed': self.failed,
+            'seconds': round(self.seconds, 3),
+            'invoices_per_second': round(self.throughput, 1),
+            'avg_render_ms': round(self.render_seconds / self.rendered * 1000, 2) if self.rendered else 0.0,
+            'failures': dict(self.failures),
+        }
+
+
+def read_jsonl(stream):
+    """
+    Yield (line_number, record) from a JSONL stream.
+
+    Unparseable lines are yielded as (line_number, ValueError) so they are
+    reported as failures instead of stopping the run.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("line is not a JSON object")
+            yield line_number, record
+        except ValueError as e:
+            yield line_number, ValueError(f"invalid JSON: {str(e)}")
+
+
+def _reissue_filename(invoice_number, phone=None, company_details=None):
+    """File name of a re-issued invoice; the number is only unique per merchant, so the merchant is keyed in."""
+    number = re.sub(r'[^A-Za-z0-9-]+', '_', str(invoice_number))
+    merchant = phone or json.dumps(company_details, sort_keys=True)
+    return f"invoice_{company_key(merchant)}_{number}.pdf"
+
+
+# Invoice engine of this worker process, set by _warm_up
+_engine = None
+
+
+def _warm_up(engine, company_details):
+    """Process pool initializer: load reportlab and build the first template."""
+    from multiprocessing.util import Finalize
+
+    from invoice_numbers import get_allocator
+    from invoice_templates import get_template
+
+    global _engine
+    _engine = engine
+    get_template(company_details)
+    # Pool workers skip atexit, so hand unused invoice numbers back on worker exit
+    allocator = get_allocator()
+    Finalize(allocator, allocator.close, exitpriority=10)
+
+
+def _render(record_id, order, company_details, phone, invoice_number, filename):
+    """Render one order in a worker process. Never raises."""
+    import contextlib
+    import io
+
+    from invoice_gen import generate_pdf
+    from invoice_numbers import issue_invoice
+
+    started = time.perf_counter()
+    try:
+        # Keep per-invoice progress prints out of the bulk output
+        with contextlib.redirect_stdout(io.StringIO()):
+            if invoice_number:
+                filename = filename or _reissue_filename(invoice_number, phone, company_details)
+                generate_pdf(order, filename, company_details, engine=_engine, invoice_number=invoice_number)
+            else:
+                invoice_number, filename = issue_invoice(phone, order, company_details, engine=_engine)
+    except Exception as e:
+        return {'id': record_id, 'status': 'failed', 'error': f"{type(e).__name__}: {str(e)}"}
+    return {'id': record_id, 'status': 'rendered', 'invoice_number': invoice_number,
+            'path': os.path.join(STATIC_FOLDER, filename), 'seconds': round(time.perf_counter() - started, 4)}
+
+
+def _prepare(line_number, record):
+    """Validate a record; returns (render args, None) or (None, failure result)."""
+    if isinstance(record, Exception):
+        return None, {'id': line_number, 'status': 'failed', 'error': str(record)}
+
+    record_id = record.get('id', line_number)
+    try:
+        decoded = decode_order({'customer': record.get('customer'), 'items': record.get('items') or []})
+    except OrderDecodeError as e:
+        return None, {'id': record_id, 'status': 'failed', 'error': f"invalid order: {str(e)}"}
+    missing = decoded.missing_fields()
+    if missing:
+        # Zero quantities and negative rates are dropped by the decoder and show up as missing
+        label = 'missing or invalid fields' if any(r.endswith('_invalid') for r in decoded.repairs) else 'missing fields'
+        return None, {'id': record_id, 'status': 'failed', 'error': f"{label}: {', '.join(missing)}"}
+    order = decoded.to_dict()
+
+    phone, invoice_number = record.get('phone'), record.get('invoice_number')
+    if not phone and not invoice_number:
+        return None, {'id': record_id, 'status': 'failed', 'error': "missing fields: phone or invoice_number"}
+    if invoice_number and not phone and not record.get('filename') and not record.get('company_details'):
+        # Nothing to tell this merchant's INV-000042 from another's
+        return None, {'id': record_id, 'status': 'failed', 'error': "missing fields: phone or company_details"}
+    filename = os.path.basename(record['filename']) if record.get('filename') and invoice_number else None
+    return (record_id, order, record.get('company_details'), phone, invoice_number, filename), None
+
+
+def render_orders(records, workers=WORKERS, max_in_flight=None, engine=None, on_result=None):
+    """
+    Render a stream of orders on a process pool.
+
+    Args:
+        records (iterable): (line_number, record) pairs, e.g. from read_jsonl()
+        workers (int): Worker processes
+        max_in_flight (int, optional): Orders submitted but not finished;
+            defaults to IN_FLIGHT_PER_WORKER per worker
+        engine (str, optional): Invoice engine, see invoice_gen.generate_pdf
+        on_result (callable, optional): Called with each result dict as it completes
+
+    Returns:
+        BulkStats: Totals, failures by reason and throughput
+    """
+    max_in_flight = max_in_flight or workers * IN_FLIGHT_PER_WORKER
+    stats = BulkStats()
+    started = time.perf_counter()
+    records = iter(records)
+
+    def record_result(result):
+        stats.total += 1
+        if result['status'] == 'rendered':
+            stats.rendered += 1
+            stats.render_seconds += result['seconds']
+        else:
+            stats.failed += 1
+            reason = result['error'].split(':')[0]
+            stats.failures[reason] = stats.failures.get(reason, 0) + 1
+        if on_result:
+            on_result(result)
+
+    # Warm workers up with the first valid order's company
+    first = None
+    for line_number, record in records:
+        args, failure = _prepare(line_number, record)
+        if failure:
+            record_result(failure)
+            continue
+        first = args
+        break
+    if first is None:
+        stats.seconds = time.perf_counter() - started
+        return stats
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_up, initargs=(engine, first[2])) as pool:
+        pending = {pool.submit(_render, *first)}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    line_number, record = next(records)
+                except StopIteration:
+                    exhausted = True
+                    break
+                args, failure = _prepare(line_number, record)
+                if failure:
+                    record_result(failure)
+                else:
+                    pending.add(pool.submit(_render, *args))
+
+            if pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record_result(future.result())
+
+    stats.seconds = time.perf_counter() - started
+    return stats
+
+
+def _option(argv, name, default=None):
+    for arg in argv:
+        if arg.startswith(f'--{name}='):
+            return arg.split('=', 1)[1]
+    return default
+
+
+def main(argv):
+    paths = [arg for arg in argv if not arg.startswith('--')]
+    if not paths:
+        print(__doc__)
+        return 1
+
+    workers = int(_option(argv, 'workers', WORKERS))
+    in_flight = _option(argv, 'in-flight')
+    report_path = _option(argv, 'report')
+    engine = _option(argv, 'engine')
+
+    stream = sys.stdin if paths[0] == '-' else open(paths[0], 'r', encoding='utf-8')
+    report = open(report_path, 'w', encoding='utf-8') if report_path else None
+
+    def on_result(result):
+        if report:
+            report.write(json.dumps(result) + '\n')
+        if result['status'] == 'failed':
+            print(f"❌ {result['id']}: {result['error']}")
+
+    print(f"🖨️ Rendering with {workers} worker processes...")
+    try:
+        stats = render_orders(read_jsonl(stream), workers, int(in_flight) if in_flight else None, engine, on_result)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if report:
+            report.close()
+
+    summary = stats.to_dict()
+    print(f"✅ Rendered {summary['rendered']}/{summary['total']} invoices in {summary['seconds']}s "
+          f"({summary['invoices_per_second']}/s, {summary['avg_render_ms']}ms per invoice)")
+    for reason, count in sorted(summary['failures'].items()):
+        print(f"   {count} failed: {reason}")
+    return 0 if not stats.failed else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,211 @@
+"""
+Append-only conversation log.
+
+Conversation entries are written as JSON lines to segment files that rotate
+by size or by day:
+
+    conversation_logs/
+        CURRENT                              # name of the active segment
+        segment-000001-20260101.jsonl
+        segment-000002-20260102.jsonl
+        index/ab/ab12....idx                 # per-user offset index
+
+Each per-user index file is a sequence of fixed-size (segment, offset)
+records, so the last N entries for a user are found by seeking to the end
+of their index instead of scanning the log.
+
+History that older versions kept in the user record ('conversation_history')
+is moved in with prepend(), which writes it to the active segment but puts
+it at the front of the user's index, so it still reads as the oldest.
+"""
+import glob
+import hashlib
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+LOG_DIR = os.environ.get('CONVERSATION_LOG_DIR', 'conversation_logs')
+MAX_SEGMENT_BYTES = int(os.environ.get('CONVERSATION_LOG_SEGMENT_BYTES', 16 * 1024 * 1024))
+
+# One index record: segment number (uint32) + byte offset (uint64)
+INDEX_RECORD = struct.Struct('<IQ')
+
+
+class ConversationLog:
+    """Append-only, segmented JSONL log of conversation entries."""
+
+    def __init__(self, directory=LOG_DIR, max_segment_bytes=MAX_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._segment_paths = {}
+        os.makedirs(os.path.join(directory, 'index'), exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """Serialise appends across threads and processes."""
+        with self._lock:
+            with open(os.path.join(self.directory, 'log.lock'), 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _index_path(self, phone_number):
+        digest = hashlib.sha1(phone_number.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'index', digest[:2], f"{digest}.idx")
+
+    def _segment_path(self, seq):
+        path = self._segment_paths.get(seq)
+        if path is None:
+            matches = glob.glob(os.path.join(self.directory, f"segment-{seq:06d}-*.jsonl"))
+            if not matches:
+                return None
+            path = self._segment_paths[seq] = matches[0]
+        return path
+
+    def _active_segment(self):
+        """Return (seq, path) of the segment to append to, rotating if needed."""
+        pointer = os.path.join(self.directory, 'CURRENT')
+        today = datetime.now().strftime('%Y%m%d')
+
+        seq = 0
+        if os.path.exists(pointer):
+            with open(pointer, 'r') as f:
+                name = f.read().strip()
+            if name:
+                seq = int(name.split('-')[1])
+                path = os.path.join(self.directory, name)
+                day = name.split('-')[2].split('.')[0]
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                if day == today and size < self.max_segment_bytes:
+                    return seq, path
+
+        # Rotate to a new segment
+        seq += 1
+        name = f"segment-{seq:06d}-{today}.jsonl"
+        path = os.path.join(self.directory, name)
+        open(path, 'a').close()
+        tmp_pointer = f"{pointer}.tmp"
+        with open(tmp_pointer, 'w') as f:
+            f.write(name)
+        os.replace(tmp_pointer, pointer)
+        self._segment_paths[seq] = path
+        return seq, path
+
+    def append(self, phone_number, entry):
+        """
+        Append one conversation entry for a user.
+
+        Args:
+            phone_number (str): WhatsApp phone number
+            entry (dict): Entry with timestamp, message and response
+        """
+        line = json.dumps({'phone': phone_number, **entry}, ensure_ascii=False) + '\n'
+        index_path = self._index_path(phone_number)
+
+        with self._locked():
+            seq, path = self._active_segment()
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(line.encode('utf-8'))
+
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(index_path, 'ab') as f:
+                f.write(INDEX_RECORD.pack(seq, offset))
+
+    def prepend(self, phone_number, entries):
+        """
+        Add entries older than everything logged for a user so far.
+
+        Args:
+            phone_number (str): WhatsApp phone number
+            entries (list): Entries with timestamp, message and response, oldest first
+        """
+        if not entries:
+            return
+        index_path = self._index_path(phone_number)
+
+        with self._locked():
+            seq, path = self._active_segment()
+            pointers = []
+            with open(path, 'ab') as f:
+                for entry in entries:
+                    pointers.append(INDEX_RECORD.pack(seq, f.tell()))
+                    f.write((json.dumps({'phone': phone_number, **entry}, ensure_ascii=False) + '\n').encode('utf-8'))
+
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            existing = b''
+            if os.path.exists(index_path):
+                with open(index_path, 'rb') as f:
+                    existing = f.read()
+            tmp_path = f"{index_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(pointers) + existing)
+            os.replace(tmp_path, index_path)
+
+    def recent(self, phone_number, limit=10):
+        """
+        Read the last entries for a user, oldest first.
+
+        Args:
+            phone_number (str): WhatsApp phone number
+            limit (int, optional): Number of entries to return. None returns
+                the full history.
+
+        Returns:
+            list: Conversation entries
+        """
+        index_path = self._index_path(phone_number)
+        if not os.path.exists(index_path):
+            return []
+
+        with open(index_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            count = f.tell() // INDEX_RECORD.size
+            start = 0 if limit is None else max(0, count - limit)
+            f.seek(start * INDEX_RECORD.size)
+            pointers = list(INDEX_RECORD.iter_unpack(f.read((count - start) * INDEX_RECORD.size)))
+
+        entries = []
+        handles = {}
+        try:
+            for seq, offset in pointers:
+                if seq not in handles:
+                    path = self._segment_path(seq)
+                    handles[seq] = open(path, 'rb') if path else None
+                handle = handles[seq]
+                if handle is None:
+                    continue  # Segment was archived or removed
+                handle.seek(offset)
+                record = json.loads(handle.readline().decode('utf-8'))
+                record.pop('phone', None)
+                entries.append(record)
+        finally:
+            for handle in handles.values():
+                if handle:
+                    handle.close()
+
+        return entries
+
+
+_log = None
+
+
+def get_log():
+    """Return the shared conversation log, creating it on first use."""
+    global _log
+    if _log is None:
+        _log = ConversationLog()
+    return _log
@@ -0,0 +1,286 @@
+"""
+Per-merchant customer directory with a fuzzy trigram index.
+
+Customer names arrive with small variations ("Ramesh Kirana", "ramesh
+kirana store", OCR slips like "Ramesh Kirna"). Every generated invoice
+records its customer in the user's 'customer_directory':
+
+    {
+        'customers': {'ramesh kirana': {'name': 'Ramesh Kirana', 'count': 14, 'last_used': '...'}},
+        'total': 31,
+        'revision': 31
+    }
+
+Names are matched against it through an in-memory trigram index (built
+once per directory revision and cached per process). A name read from a
+photo or voice note that normalizes to a known customer gets the canonical
+spelling; names the merchant typed are kept as typed. Anything short of an
+exact match only ever becomes a suggestion for the merchant to confirm,
+since the invoice goes to whoever is named on it, and only when every word
+agrees: same number of words, same numbers ("Hotel Sai 2" is not "Hotel
+Sai") and each word at most one character away. When a name is missing and
+one customer accounts for most of the merchant's invoices, that customer is
+suggested the same way.
+
+While a suggestion is pending the order data carries it for the next reply:
+
+    {'customer': None, 'customer_suggestion': 'Ramesh Kumar',
+     'customer_as_sent': 'Rajesh Kumar', 'customer_asked': True, 'items': [...]}
+"""
+import copy
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from order_validation import order_result
+
+MAX_CUSTOMERS = int(os.environ.get('CUSTOMER_DIRECTORY_MAX', 5000))
+# Dice similarity of name trigrams needed to treat two names as the same customer
+MATCH_THRESHOLD = float(os.environ.get('CUSTOMER_MATCH_THRESHOLD', 0.75))
+# Share of invoices above which a missing customer is suggested for confirmation
+SUGGEST_SHARE = float(os.environ.get('CUSTOMER_SUGGEST_SHARE', 0.5))
+# Invoices needed before a customer counts as dominant
+MIN_HISTORY = 5
+INDEX_CACHE_SIZE = 256
+
+# Words that do not distinguish one customer from another
+GENERIC_WORDS = {'store', 'stores', 'shop', 'general', 'mart', 'ji', 'sir', 'bhai', 'and', 'co', 'the', 'mr', 'mrs', 'shri'}
+# Shortest word in which a one-character difference can still be a misspelling
+MIN_SLIP_WORD = 4
+# Order data keys that carry a pending customer confirmation between replies
+CONFIRMATION_KEYS = ('customer_suggestion', 'customer_as_sent', 'customer_asked')
+
+
+def normalize_customer(name):
+    """
+    Normalize a customer name for matching.
+
+    'Ramesh Kirana Store' -> 'ramesh kirana', 'Sharma ji' -> 'sharma'
+    """
+    words = re.sub(r'[^a-z0-9]+', ' ', (name or '').lower()).split()
+    significant = [word for word in words if word not in GENERIC_WORDS]
+    return ' '.join(significant or words)
+
+
+def _trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _one_edit(a, b):
+    """True if b is a with at most one character substituted, inserted or deleted."""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+def tokens_agree(key, candidate):
+    """
+    True if two normalized names can be spellings of one customer: the same
+    number of words, words with digits identical and every other word equal
+    or one character away.
+    """
+    words, candidate_words = key.split(), candidate.split()
+    if len(words) != len(candidate_words):
+        return False
+    for word, candidate_word in zip(words, candidate_words):
+        if word == candidate_word:
+            continue
+        if any(ch.isdigit() for ch in word + candidate_word):
+            return False
+        if min(len(word), len(candidate_word)) < MIN_SLIP_WORD or not _one_edit(word, candidate_word):
+            return False
+    return True
+
+
+class CustomerIndex:
+    """
+    Trigram inverted index over the customers of one directory.
+
+    Lookups use prefix filtering: a name can only reach the threshold if it
+    shares one of its rarest trigrams with the query, so only the short
+    posting lists of those trigrams are scanned before exact scoring.
+    """
+
+    def __init__(self, customers):
+        self.customers = customers
+        self.postings = {}
+        self.grams = {}
+        for key in customers:
+            grams = _trigrams(key)
+            self.grams[key] = grams
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(key)
+
+    def match(self, name, threshold=MATCH_THRESHOLD):
+        """
+        Find the customer a name most likely refers to.
+
+        Returns:
+            tuple: (key, score) of the best match at or above threshold,
+                or (None, 0.0)
+        """
+        key = normalize_customer(name)
+        if not key:
+            return None, 0.0
+        if key in self.customers:
+            return key, 1.0
+
+        grams = _trigrams(key)
+        # Dice >= t needs at least t*|q|/(2-t) shared trigrams
+        min_shared = max(1, math.ceil(threshold * len(grams) / (2.0 - threshold) - 1e-9))
+        rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))
+        candidates = set()
+        for gram in rarest[:len(grams) - min_shared + 1]:
+            candidates.update(self.postings.get(gram, ()))
+
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            candidate_grams = self.grams[candidate]
+            score = 2.0 * len(grams & candidate_grams) / (len(grams) + len(candidate_grams))
+            # Prefer the more frequently billed customer on ties
+            if score > best_score or (score == best_score and best is not None
+                                      and self.customers[candidate]['count'] > self.customers[best]['count']):
+                best, best_score = candidate, score
+        if best_score >= threshold:
+            return best, best_score
+        return None, 0.0
+
+
+_index_cache = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def get_index(phone_number, directory):
+    """
+    Return the trigram index for a user's directory, building it if the
+    directory changed since the cached copy was built.
+    """
+    version = directory.get('revision', 0)
+    with _index_lock:
+        cached = _index_cache.get(phone_number)
+        if cached is not None and cached[0] == version:
+            _index_cache.move_to_end(phone_number)
+            return cached[1]
+
+    index = CustomerIndex(directory.get('customers', {}))
+    with _index_lock:
+        _index_cache[phone_number] = (version, index)
+        _index_cache.move_to_end(phone_number)
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def dominant_customer(directory, share):
+    """
+    Return the customer name with at least `share` of all invoices, or None.
+    """
+    if not directory or directory.get('total', 0) < MIN_HISTORY:
+        return None
+    customers = directory.get('customers', {})
+    if not customers:
+        return None
+    top = max(customers.values(), key=lambda entry: entry['count'])
+    if top['count'] / directory['total'] >= share:
+        return top['name']
+    return None
+
+
+def learn_customer(directory, name):
+    """
+    Record the customer of a generated invoice.
+
+    Args:
+        directory (dict): User's customer directory (may be None)
+        name (str): Customer name as printed on the invoice
+
+    Returns:
+        dict: Updated directory (a new dict; the input is not modified)
+    """
+    directory = copy.deepcopy(directory) if directory else {'customers': {}, 'total': 0, 'revision': 0}
+    key = normalize_customer(name)
+    if not key:
+        return directory
+
+    customers = directory.setdefault('customers', {})
+    entry = customers.setdefault(key, {'name': name.strip(), 'count': 0})
+    entry['count'] += 1
+    entry['last_used'] = datetime.now().isoformat()
+    directory['total'] = directory.get('total', 0) + 1
+    directory['revision'] = directory.get('revision', 0) + 1
+
+    if len(customers) > MAX_CUSTOMERS:
+        stale = sorted(customers, key=lambda k: customers[k].get('last_used', ''))[:len(customers) - MAX_CUSTOMERS]
+        for k in stale:
+            directory['total'] -= customers.pop(k)['count']
+    return directory
+
+
+def _suggest(data, suggestion, as_sent=None):
+    """Leave the customer missing and carry a suggestion for the merchant to confirm."""
+    data['customer'] = None
+    data['customer_suggestion'] = suggestion
+    if as_sent:
+        data['customer_as_sent'] = as_sent
+    data['customer_asked'] = True
+    return order_result(data)
+
+
+def resolve_customer(phone_number, directory, parse_result, extracted=False):
+    """
+    Canonicalize an extracted customer name, or suggest one to confirm.
+
+    Args:
+        phone_number (str): Merchant's phone number (index cache key)
+        directory (dict): User's customer directory (may be None)
+        parse_result (dict): parse_order() result
+        extracted (bool): True if the name was read from a photo or voice
+            note rather than typed by the merchant
+
+    Returns:
+        tuple: (result, action) where action is 'matched' when an extracted
+            name was replaced by the canonical spelling of the same customer,
+            'suggested' when a near match or the dominant customer is left
+            for the merchant to confirm, or None. A complete
+            result never carries CONFIRMATION_KEYS.
+    """
+    if parse_result.get('status') not in ('complete', 'incomplete'):
+        return parse_result, None
+
+    result, action = copy.deepcopy(parse_result), None
+    data = result.get('data') or {}
+    name = (data.get('customer') or '').strip()
+    # Once the merchant was asked, their answer is used as given
+    asked = data.get('customer_asked')
+    if directory and directory.get('customers') and not data.get('customer_suggestion'):
+        if name:
+            key, _ = get_index(phone_number, directory).match(name)
+            canonical = directory['customers'][key]['name'] if key else None
+            if canonical is None or canonical == name:
+                pass
+            elif key == normalize_customer(name):
+                if extracted:
+                    data['customer'] = canonical
+                    action = 'matched'
+            elif not asked and tokens_agree(normalize_customer(name), key):
+                result, action = _suggest(data, canonical, as_sent=name), 'suggested'
+        elif not asked:
+            dominant = dominant_customer(directory, SUGGEST_SHARE)
+            if dominant is not None:
+                result, action = _suggest(data, dominant), 'suggested'
+
+    if result['status'] == 'complete':
+        for field in CONFIRMATION_KEYS:
+            result['data'].pop(field, None)
+    return result, action
@@ -0,0 +1,348 @@
+"""
+Storage backends for the user database.
+
+db_manager talks to one of these through a small interface so the storage
+engine can be swapped without touching app.py:
+
+    get(phone_number)                 -> dict or None
+    put(phone_number, user_data)      -> None
+    update(phone_number, mutate)      -> dict   (atomic read-modify-write)
+    delete(phone_number)              -> None
+    items()                           -> iterator of (phone_number, dict)
+
+Select the backend with the DB_BACKEND environment variable ('json',
+'sharded' or 'sqlite'). Migrate an existing user_data.json with:
+
+    python db_backends.py migrate user_data.json user_data.db
+    python db_backends.py migrate-sharded user_data.json user_data/
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+
+class StorageError(Exception):
+    """Raised when a database file cannot be read safely."""
+
+
+class JSONBackend:
+    """
+    Single-file JSON store. Every operation reads and rewrites the whole
+    file, so it is only suitable for small deployments.
+
+    Writers take an exclusive fcntl lock on a sidecar .lock file and replace
+    the data file atomically (write to temp, fsync, rename), so concurrent
+    workers never see a truncated file or lose each other's updates.
+    """
+
+    def __init__(self, path='user_data.json'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self, exclusive=True):
+        """Hold the in-process lock and an fcntl lock on the .lock file."""
+        with self._lock:
+            with open(f"{self.path}.lock", 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """
+        Load the whole database dict from disk.
+
+        Raises:
+            StorageError: If the file exists but is not valid JSON. The file
+                is left untouched so no merchant data is overwritten.
+        """
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+            except json.JSONDecodeError as e:
+                raise StorageError(f"Corrupted database file {self.path}: {e}") from e
+        return {}
+
+    def save(self, db):
+        """Atomically replace the database file with db."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(db, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, phone_number):
+        with self._locked(exclusive=False):
+            return self.load().get(phone_number)
+
+    def put(self, phone_number, user_data):
+        with self._locked():
+            db = self.load()
+            db[phone_number] = user_data
+            self.save(db)
+
+    def update(self, phone_number, mutate):
+        with self._locked():
+            db = self.load()
+            db[phone_number] = mutate(db.get(phone_number))
+            self.save(db)
+            return db[phone_number]
+
+    def delete(self, phone_number):
+        with self._locked():
+            db = self.load()
+            if db.pop(phone_number, None) is not None:
+                self.save(db)
+
+    def items(self):
+        with self._locked(exclusive=False):
+            return iter(self.load().items())
+
+
+class ShardedJSONBackend:
+    """
+    JSON store split into shards by a hash of the phone number.
+
+    Each shard is an independent JSONBackend with its own lock, so workers
+    only contend when they touch users in the same shard, and a write only
+    rewrites one shard file.
+    """
+
+    def __init__(self, directory='user_data', num_shards=None):
+        self.directory = directory
+        self.num_shards = int(num_shards or os.environ.get('DB_SHARDS', 64))
+        os.makedirs(directory, exist_ok=True)
+        self.shards = [
+            JSONBackend(os.path.join(directory, f"shard-{i:03d}.json"))
+            for i in range(self.num_shards)
+        ]
+
+    def shard_index(self, phone_number):
+        """Return the index of the shard holding a phone number."""
+        digest = hashlib.sha1(phone_number.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') % self.num_shards
+
+    def shard_for(self, phone_number):
+        """Return the shard holding a phone number."""
+        return self.shards[self.shard_index(phone_number)]
+
+    def get(self, phone_number):
+        return self.shard_for(phone_number).get(phone_number)
+
+    def put(self, phone_number, user_data):
+        self.shard_for(phone_number).put(phone_number, user_data)
+
+    def update(self, phone_number, mutate):
+        return self.shard_for(phone_number).update(phone_number, mutate)
+
+    def delete(self, phone_number):
+        self.shard_for(phone_number).delete(phone_number)
+
+    def items(self):
+        for shard in self.shards:
+            yield from shard.items()
+
+
+class SQLiteBackend:
+    """
+    One row per user in an SQLite database running in WAL mode.
+
+    Reads and writes touch a single row, so the cost of a webhook no longer
+    grows with the number of merchants. WAL lets readers proceed while a
+    writer is active, and BEGIN IMMEDIATE serialises read-modify-write
+    cycles across threads and processes.
+    """
+
+    def __init__(self, path='user_data.db', timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    phone TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TEXT
+                )
+                """
+            )
+
+    def _connect(self):
+        # sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _write_row(conn, phone_number, user_data):
+        conn.execute(
+            'INSERT INTO users (phone, data, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(phone) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+            (phone_number, json.dumps(user_data), user_data.get('updated_at'))
+        )
+
+    def get(self, phone_number):
+        row = self._connect().execute(
+            'SELECT data FROM users WHERE phone = ?', (phone_number,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, phone_number, user_data):
+        with self._transaction() as conn:
+            self._write_row(conn, phone_number, user_data)
+
+    def update(self, phone_number, mutate):
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT data FROM users WHERE phone = ?', (phone_number,)
+            ).fetchone()
+            user_data = mutate(json.loads(row[0]) if row else None)
+            self._write_row(conn, phone_number, user_data)
+            return user_data
+
+    def delete(self, phone_number):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM users WHERE phone = ?', (phone_number,))
+
+    def items(self):
+        for phone, data in self._connect().execute('SELECT phone, data FROM users'):
+            yield phone, json.loads(data)
+
+
+BACKENDS = {
+    'json': (JSONBackend, 'user_data.json'),
+    'sharded': (ShardedJSONBackend, 'user_data'),
+    'sqlite': (SQLiteBackend, 'user_data.db'),
+}
+
+
+def create_backend(name=None, path=None):
+    """
+    Build a storage backend.
+
+    Args:
+        name (str, optional): 'json', 'sharded' or 'sqlite'. Defaults to $DB_BACKEND or 'json'.
+        path (str, optional): Storage location. Defaults to $DB_PATH or the
+            backend's default file name.
+
+    Returns:
+        Backend instance
+    """
+    name = (name or os.environ.get('DB_BACKEND', 'json')).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown DB_BACKEND '{name}'. Choose one of: {', '.join(BACKENDS)}")
+    backend_class, default_path = BACKENDS[name]
+    return backend_class(path or os.environ.get('DB_PATH') or default_path)
+
+
+def migrate_json_to_sqlite(json_path='user_data.json', sqlite_path='user_data.db'):
+    """
+    One-shot migration of every user in a JSON database into SQLite.
+
+    Existing rows with the same phone number are overwritten, so the
+    migration can safely be re-run.
+
+    Args:
+        json_path (str): Source user_data.json
+        sqlite_path (str): Destination SQLite database
+
+    Returns:
+        int: Number of users migrated
+    """
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(json_path)
+
+    with open(json_path, 'r') as f:
+        db = json.load(f)
+
+    target = SQLiteBackend(sqlite_path)
+    with target._transaction() as conn:
+        for phone_number, user_data in db.items():
+            target._write_row(conn, phone_number, user_data)
+
+    print(f"Migrated {len(db)} users from {json_path} to {sqlite_path}")
+    return len(db)
+
+
+def migrate_json_to_sharded(json_path='user_data.json', directory='user_data'):
+    """
+    One-shot migration of every user in a JSON database into shard files.
+
+    Users are grouped by shard so each shard file is written once.
+
+    Args:
+        json_path (str): Source user_data.json
+        directory (str): Destination shard directory
+
+    Returns:
+        int: Number of users migrated
+    """
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(json_path)
+
+    with open(json_path, 'r') as f:
+        db = json.load(f)
+
+    target = ShardedJSONBackend(directory)
+    by_shard = {}
+    for phone_number, user_data in db.items():
+        by_shard.setdefault(target.shard_index(phone_number), {})[phone_number] = user_data
+
+    for index, users in by_shard.items():
+        shard = target.shards[index]
+        with shard._locked():
+            shard_db = shard.load()
+            shard_db.update(users)
+            shard.save(shard_db)
+
+    print(f"Migrated {len(db)} users from {json_path} to {directory}/")
+    return len(db)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        migrate_json_to_sqlite(*sys.argv[2:4])
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'migrate-sharded':
+        migrate_json_to_sharded(*sys.argv[2:4])
+    else:
+        print("Usage: python db_backends.py migrate [user_data.json] [user_data.db]")
+        print("       python db_backends.py migrate-sharded [user_data.json] [user_data/]")
+        sys.exit(1)
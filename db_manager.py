@@ -1,26 +1,107 @@
-import json
-import os
+import sys
 from datetime import datetime
 
+from conversation_log import get_log
+from db_backends import JSONBackend, create_backend
+from item_catalog import get_catalog_store
+from session_cache import CACHE_SIZE, CachedBackend
+
 DB_FILE = 'user_data.json'
 
+# Storage backend, chosen from $DB_BACKEND on first use
+_backend = None
+
+
+def get_backend():
+    """
+    Return the active storage backend, creating it on first use.
+    
+    The backend is wrapped in an in-memory session cache when
+    USER_CACHE_SIZE is above 0 (single-process deployments only).
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+        if CACHE_SIZE > 0:
+            _backend = CachedBackend(_backend)
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the active storage backend (e.g. for scripts and migrations)."""
+    global _backend
+    _backend = backend
+
+
+def invalidate_user(phone_number):
+    """Drop a user from the session cache, if one is active."""
+    backend = get_backend()
+    if hasattr(backend, 'invalidate'):
+        backend.invalidate(phone_number)
+
+
+def cache_stats():
+    """
+    Session cache hit/miss counters.
+    
+    Returns:
+        dict: Cache statistics, or None if caching is disabled
+    """
+    backend = get_backend()
+    return backend.stats() if hasattr(backend, 'stats') else None
+
 
 def load_database():
-    """Load the user database from JSON file."""
-    if os.path.exists(DB_FILE):
-        try:
-            with open(DB_FILE, 'r') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("Warning: Corrupted database file. Creating new one.")
-            return {}
-    return {}
+    """Load the whole user database from the JSON file."""
+    return JSONBackend(DB_FILE).load()
 
 
 def save_database(db):
-    """Save the database to JSON file."""
-    with open(DB_FILE, 'w') as f:
-        json.dump(db, f, indent=2)
+    """Save the whole user database to the JSON file."""
+    JSONBackend(DB_FILE).save(db)
+
+
+# Fields older versions kept in the user record; sessions move them out on commit
+LEGACY_FIELDS = ('conversation_history', 'item_catalog')
+
+# Fields written when a user sends 'reset'
+RESET_UPDATES = {
+    'state': 'NEW',
+    'onboarding_step': 0,
+    'company_details': {},
+    'pending_order': None
+}
+
+
+def _new_user(phone_number):
+    """Build the default record for a new user."""
+    return {
+        'phone': phone_number,
+        'created_at': datetime.now().isoformat(),
+        'state': 'NEW',  # NEW, ONBOARDING, READY, COLLECTING_ORDER, AWAITING_INFO
+        'onboarding_step': 0,  # Track onboarding progress
+        'company_details': {
+            'name': None,
+            'address': None,
+            'gstin': None,
+            'logo_path': None
+        },
+        'customer_directory': {'customers': {}, 'total': 0, 'revision': 0},  # See customer_directory.py
+        'pending_order': None  # Temporary storage for incomplete orders
+    }
+
+
+def _apply_updates(user_data, updates):
+    """Merge an updates dict into a user record in place."""
+    for key, value in updates.items():
+        if key == 'company_details' and isinstance(value, dict):
+            # Merge company details instead of replacing
+            user_data['company_details'].update(value)
+        else:
+            user_data[key] = value
+
+    user_data['updated_at'] = datetime.now().isoformat()
+    return user_data
 
 
 def get_user(phone_number):
@@ -33,8 +114,7 @@ def get_user(phone_number):
     Returns:
         dict: User data or None if user doesn't exist
     """
-    db = load_database()
-    return db.get(phone_number)
+    return get_backend().get(phone_number)
 
 
 def create_user(phone_number):
@@ -47,25 +127,8 @@ def create_user(phone_number):
     Returns:
         dict: Newly created user data
     """
-    db = load_database()
-    
-    user_data = {
-        'phone': phone_number,
-        'created_at': datetime.now().isoformat(),
-        'state': 'NEW',  # NEW, ONBOARDING, READY, COLLECTING_ORDER, AWAITING_INFO
-        'onboarding_step': 0,  # Track onboarding progress
-        'company_details': {
-            'name': None,
-            'address': None,
-            'gstin': None,
-            'logo_path': None
-        },
-        'pending_order': None,  # Temporary storage for incomplete orders
-        'conversation_history': []
-    }
-    
-    db[phone_number] = user_data
-    save_database(db)
+    user_data = _new_user(phone_number)
+    get_backend().put(phone_number, user_data)
     
     return user_data
 
@@ -81,23 +144,26 @@ def update_user(phone_number, updates):
     Returns:
         dict: Updated user data
     """
-    db = load_database()
-    
-    if phone_number not in db:
-        db[phone_number] = create_user(phone_number)
+    def mutate(user_data):
+        return _apply_updates(user_data or _new_user(phone_number), updates)
     
-    # Merge updates
-    for key, value in updates.items():
-        if key == 'company_details' and isinstance(value, dict):
-            # Merge company details instead of replacing
-            db[phone_number]['company_details'].update(value)
-        else:
-            db[phone_number][key] = value
+    # Single-row read-modify-write on the backend
+    return get_backend().update(phone_number, mutate)
+
+
+def reset_user(phone_number):
+    """
+    Reset a user to NEW for re-onboarding and drop their cached session.
     
-    db[phone_number]['updated_at'] = datetime.now().isoformat()
-    save_database(db)
+    Args:
+        phone_number (str): WhatsApp phone number
     
-    return db[phone_number]
+    Returns:
+        dict: Updated user data
+    """
+    user_data = update_user(phone_number, RESET_UPDATES)
+    invalidate_user(phone_number)
+    return user_data
 
 
 def set_user_state(phone_number, state, pending_order=None):
@@ -120,27 +186,32 @@ def add_conversation_entry(phone_number, message, response):
     """
     Add a conversation entry for context (optional, for debugging).
     
+    Entries go to the append-only conversation log, not the user record.
+    
     Args:
         phone_number (str): WhatsApp phone number
         message (str): User's message
         response (str): Bot's response
     """
-    user = get_user(phone_number)
-    if not user:
-        user = create_user(phone_number)
-    
-    entry = {
+    get_log().append(phone_number, {
         'timestamp': datetime.now().isoformat(),
         'message': message,
         'response': response
-    }
+    })
+
+
+def get_conversation_history(phone_number, limit=10):
+    """
+    Get the most recent conversation entries for a user.
     
-    # Keep only last 10 conversations to avoid bloat
-    history = user.get('conversation_history', [])
-    history.append(entry)
-    history = history[-10:]  # Keep last 10
+    Args:
+        phone_number (str): WhatsApp phone number
+        limit (int, optional): Number of entries, or None for full history
     
-    update_user(phone_number, {'conversation_history': history})
+    Returns:
+        list: Entries with timestamp, message and response, oldest first
+    """
+    return get_log().recent(phone_number, limit)
 
 
 def is_onboarding_complete(phone_number):
@@ -159,3 +230,155 @@ def is_onboarding_complete(phone_number):
     
     company_name = user.get('company_details', {}).get('name')
     return company_name is not None and company_name.strip() != ''
+
+
+class UserSession:
+    """
+    Unit of work for a single incoming message.
+    
+    Loads the user record once on entry, collects state, pending-order,
+    company-detail and history changes in memory, and applies them in a
+    single backend update when the block exits without an exception. Only
+    the changes are replayed onto the stored record, so fields written by
+    other messages or jobs while the session was open are kept.
+    Conversation entries are appended to the conversation log at the same time.
+    
+    Usage:
+        with UserSession(phone_number) as session:
+            session.update({'state': 'READY'})
+            session.add_conversation_entry(message, response)
+    """
+    
+    def __init__(self, phone_number, backend=None):
+        self.phone_number = phone_number
+        self.backend = backend or get_backend()
+        self.user = None
+        self.is_new = False
+        self._dirty = False
+        self._changes = []  # ('fields', updates) or ('field', name, fn), replayed on commit
+        self._entries = []
+        self._invalidate = False
+    
+    def __enter__(self):
+        self.user = self.backend.get(self.phone_number)
+        if self.user is None:
+            self.user = _new_user(self.phone_number)
+            self.is_new = True
+            self._dirty = True
+        if 'item_catalog' in self.user:
+            # Records from before the catalog store: move it there; commit drops it from the record
+            get_catalog_store().adopt(self.phone_number, self.user['item_catalog'])
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Discard in-memory changes if the handler failed
+        if exc_type is None:
+            self.commit()
+        return False
+    
+    def update(self, updates):
+        """Merge updates into the in-memory record (same rules as update_user)."""
+        _apply_updates(self.user, updates)
+        self._changes.append(('fields', updates))
+        self._dirty = True
+        return self.user
+    
+    def update_field(self, name, fn):
+        """
+        Update one field from its current value, e.g. a learned catalog.
+        
+        fn is applied now to the in-memory value and again on commit to the
+        stored value, so changes made to the field meanwhile are not lost.
+        
+        Args:
+            name (str): Field name
+            fn (callable): Takes the current value and returns the new one
+        """
+        self.user[name] = fn(self.user.get(name))
+        self.user['updated_at'] = datetime.now().isoformat()
+        self._changes.append(('field', name, fn))
+        self._dirty = True
+        return self.user
+    
+    def reset(self):
+        """Reset the user for re-onboarding; the cached session is dropped on commit."""
+        self._invalidate = True
+        return self.update(RESET_UPDATES)
+    
+    def set_state(self, state, pending_order=None):
+        """Update conversation state (same rules as set_user_state)."""
+        updates = {'state': state}
+        if pending_order is not None:
+            updates['pending_order'] = pending_order
+        return self.update(updates)
+    
+    def add_conversation_entry(self, message, response):
+        """Queue a conversation entry for the log; written on commit."""
+        self._entries.append({
+            'timestamp': datetime.now().isoformat(),
+            'message': message,
+            'response': response
+        })
+    
+    def commit(self):
+        """Apply the session's changes to the stored record, then flush log entries."""
+        legacy_history = []
+        if self._dirty or any(field in self.user for field in LEGACY_FIELDS):
+            changes = self._changes
+            
+            def mutate(user_data):
+                user_data = user_data or _new_user(self.phone_number)
+                # Records from before the conversation log still carry their history
+                legacy_history[:] = user_data.pop('conversation_history', None) or []
+                user_data.pop('item_catalog', None)
+                for change in changes:
+                    if change[0] == 'fields':
+                        _apply_updates(user_data, change[1])
+                    else:
+                        user_data[change[1]] = change[2](user_data.get(change[1]))
+                        user_data['updated_at'] = datetime.now().isoformat()
+                return user_data
+            
+            self.user = self.backend.update(self.phone_number, mutate)
+            self._changes = []
+            self._dirty = False
+        if self._invalidate and hasattr(self.backend, 'invalidate'):
+            self.backend.invalidate(self.phone_number)
+            self._invalidate = False
+        get_log().prepend(self.phone_number, legacy_history)
+        for entry in self._entries:
+            get_log().append(self.phone_number, entry)
+        self._entries = []
+
+
+def migrate_user_records():
+    """
+    One-shot move of every user's LEGACY_FIELDS out of their record: the
+    conversation history into the conversation log, the item catalog into
+    the catalog store.
+    
+    Sessions also move them on a user's first message, so this only shrinks
+    the records of users who have not written since. Safe to re-run.
+    
+    Returns:
+        int: Number of users migrated
+    """
+    backend = get_backend()
+    migrated = 0
+    for phone_number, user_data in list(backend.items()):
+        if not any(field in (user_data or {}) for field in LEGACY_FIELDS):
+            continue
+        with UserSession(phone_number, backend):
+            pass
+        migrated += 1
+    
+    print(f"Moved the conversation history and item catalog of {migrated} users out of their records")
+    return migrated
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == 'migrate-records':
+        migrate_user_records()
+    else:
+        print("Usage: python db_manager.py migrate-records")
+        sys.exit(1)
@@ -0,0 +1,186 @@
+"""
+Direct-canvas invoice renderer.
+
+Most invoices are a few rows, yet the platypus flow in invoice_gen pays for
+flowable wrapping, table layout and page splitting on every one. This
+engine draws the same fixed layout straight onto a reportlab canvas:
+letterhead and footer from the cached invoice template, the customer
+block, the item table with its totals, and the Code128 barcode.
+
+It only handles invoices whose rows fit on one page; generate_pdf switches
+to the platypus engine for anything longer (see fits_one_page).
+"""
+import os
+from datetime import datetime
+
+from reportlab.lib import colors
+from reportlab.lib.units import inch
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+from invoice_templates import (
+    CGST_RATE, ITEM_COL_WIDTHS, ITEM_HEADER, MARGIN, PAGE_SIZE, SGST_RATE, draw_barcode, get_template,
+    invoice_amounts
+)
+
+# Row geometry of the platypus tables: font leading plus cell padding
+FRAME_PADDING = 6
+CUSTOMER_ROW_HEIGHT = 12 + 6 + 6
+HEADER_ROW_HEIGHT = 11 * 1.2 + 12 + 12
+ROW_HEIGHT = 10 * 1.2 + 8 + 8
+GRAND_TOTAL_ROW_HEIGHT = 12 * 1.2 + 8 + 8
+CELL_PADDING = 6
+# Blank row, subtotal, CGST, SGST and total tax rows under the items
+TOTALS_ROWS = 5
+
+GRID_COLOR = colors.HexColor('#bdbdbd')
+HEADER_COLOR = colors.HexColor('#283593')
+STRIPE_COLOR = colors.HexColor('#f5f5f5')
+TOTALS_LINE_COLOR = colors.HexColor('#757575')
+GRAND_TOTAL_COLOR = colors.HexColor('#e3f2fd')
+
+
+def _body_top(template):
+    return PAGE_SIZE[1] - template.top_margin - FRAME_PADDING
+
+
+def max_rows(template):
+    """Number of item rows that fit on one page below the given letterhead."""
+    fixed = 2 * CUSTOMER_ROW_HEIGHT + 0.4 * inch + HEADER_ROW_HEIGHT + TOTALS_ROWS * ROW_HEIGHT \
+        + GRAND_TOTAL_ROW_HEIGHT
+    available = _body_top(template) - (MARGIN + FRAME_PADDING) - fixed
+    return max(0, int(available // ROW_HEIGHT))
+
+
+def fits_one_page(data, company_details=None):
+    """True if the fixed one-page layout can hold all the order's items."""
+    return len(data.get('items', [])) <= max_rows(get_template(company_details))
+
+
+def _draw_labelled(c, x, y, label, value, size=10):
+    """Draw '<b>label</b> value' on one line."""
+    c.setFont('Helvetica-Bold', size)
+    c.drawString(x, y, label)
+    c.setFont('Helvetica', size)
+    c.drawString(x + stringWidth(label + ' ', 'Helvetica-Bold', size), y, value)
+
+
+def _draw_row(c, x, y, height, cells, font, size, color=colors.black, align=None):
+    """Draw one table row's text; y is the bottom of the row."""
+    c.setFillColor(color)
+    c.setFont(font, size)
+    baseline = y + (height - size) / 2 + 0.2 * size
+    left = x
+    for idx, (width, text) in enumerate(zip(ITEM_COL_WIDTHS, cells)):
+        if text:
+            cell_align = align or ('LEFT' if idx == 0 else 'RIGHT')
+            if cell_align == 'CENTER':
+                c.drawCentredString(left + width / 2, baseline, text)
+            elif cell_align == 'LEFT':
+                c.drawString(left + CELL_PADDING, baseline, text)
+            else:
+                c.drawRightString(left + width - CELL_PADDING, baseline, text)
+        left += width
+
+
+def render_fast_pdf(data, filename, company_details=None, invoice_number=None):
+    """
+    Render a one-page invoice directly on the canvas.
+
+    Args:
+        data (dict): Order data with 'customer' and 'items'
+        filename (str): Name of the PDF file (without path)
+        company_details (dict, optional): Company information, as for generate_pdf
+        invoice_number (str, optional): Number printed on the invoice; defaults to a timestamp
+
+    Returns:
+        str: Full path to the generated PDF file
+
+    Raises:
+        ValueError: If the items do not fit on one page
+    """
+    template = get_template(company_details)
+    items = data.get('items', [])
+    if len(items) > max_rows(template):
+        raise ValueError(f"{len(items)} items do not fit on one page")
+
+    static_folder = os.path.join(os.path.dirname(__file__), 'static')
+    os.makedirs(static_folder, exist_ok=True)
+    pdf_path = os.path.join(static_folder, filename)
+
+    invoice_number = invoice_number or f"INV-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    invoice_date = datetime.now().strftime('%d-%b-%Y')
+
+    c = canvas.Canvas(pdf_path, pagesize=PAGE_SIZE)
+    template.draw_letterhead(c, None)
+    draw_barcode(c, filename)
+
+    # Customer block, two columns like the platypus customer table
+    table_width = sum(ITEM_COL_WIDTHS)
+    left = (PAGE_SIZE[0] - 7 * inch) / 2 + CELL_PADDING
+    right = left + 3.5 * inch
+    y = _body_top(template) - CELL_PADDING - 10
+    c.setFont('Helvetica-Bold', 10)
+    c.drawString(left, y, "Bill To:")
+    _draw_labelled(c, right, y, "Invoice #:", invoice_number)
+    y -= CUSTOMER_ROW_HEIGHT
+    c.setFont('Helvetica-Bold', 10)
+    c.drawString(left, y, str(data.get('customer', 'N/A')))
+    _draw_labelled(c, right, y, "Date:", invoice_date)
+
+    # Item table
+    x = (PAGE_SIZE[0] - table_width) / 2
+    top = _body_top(template) - 2 * CUSTOMER_ROW_HEIGHT - 0.4 * inch
+    rows, subtotal, total_tax, grand_total = invoice_amounts(items)
+
+    y = top - HEADER_ROW_HEIGHT
+    c.setFillColor(HEADER_COLOR)
+    c.rect(x, y, table_width, HEADER_ROW_HEIGHT, stroke=0, fill=1)
+    _draw_row(c, x, y, HEADER_ROW_HEIGHT, ITEM_HEADER, 'Helvetica-Bold', 11, colors.whitesmoke, 'CENTER')
+
+    for idx, (name, qty, rate, item_tax, item_total) in enumerate(rows):
+        y -= ROW_HEIGHT
+        if idx % 2:
+            c.setFillColor(STRIPE_COLOR)
+            c.rect(x, y, table_width, ROW_HEIGHT, stroke=0, fill=1)
+        # Rs. instead of ₹ for better PDF compatibility
+        cells = [str(name), str(qty), f"Rs. {rate:.2f}", f"Rs. {item_tax:.2f}", f"Rs. {item_total:.2f}"]
+        _draw_row(c, x, y, ROW_HEIGHT, cells, 'Helvetica', 10)
+
+    # Grid over the header and item rows
+    c.setStrokeColor(GRID_COLOR)
+    c.setLineWidth(1)
+    c.rect(x, y, table_width, top - y, stroke=1, fill=0)
+    row_top = top - HEADER_ROW_HEIGHT
+    while row_top > y + 0.01:
+        c.line(x, row_top, x + table_width, row_top)
+        row_top -= ROW_HEIGHT
+    col = x
+    for width in ITEM_COL_WIDTHS[:-1]:
+        col += width
+        c.line(col, y, col, top)
+
+    # Totals
+    totals_left = x + sum(ITEM_COL_WIDTHS[:2])
+    y -= ROW_HEIGHT  # Blank row
+    c.setStrokeColor(TOTALS_LINE_COLOR)
+    c.line(totals_left, y + ROW_HEIGHT, x + table_width, y + ROW_HEIGHT)
+    for label, amount in (('Subtotal:', subtotal), ('CGST (9%):', subtotal * CGST_RATE),
+                          ('SGST (9%):', subtotal * SGST_RATE), ('Total Tax:', total_tax)):
+        y -= ROW_HEIGHT
+        _draw_row(c, x, y, ROW_HEIGHT, ['', '', label, '', f"Rs. {amount:.2f}"], 'Helvetica-Bold', 10)
+
+    y -= GRAND_TOTAL_ROW_HEIGHT
+    c.setFillColor(GRAND_TOTAL_COLOR)
+    c.rect(x, y, table_width, GRAND_TOTAL_ROW_HEIGHT, stroke=0, fill=1)
+    c.setStrokeColor(HEADER_COLOR)
+    c.setLineWidth(2)
+    c.line(totals_left, y + GRAND_TOTAL_ROW_HEIGHT, x + table_width, y + GRAND_TOTAL_ROW_HEIGHT)
+    _draw_row(c, x, y, GRAND_TOTAL_ROW_HEIGHT, ['', '', 'Grand Total:', '', f"Rs. {grand_total:.2f}"],
+              'Helvetica-Bold', 10, align='LEFT')
+
+    c.showPage()
+    c.save()
+
+    print(f"Invoice generated successfully: {pdf_path}")
+    return pdf_path
@@ -0,0 +1,206 @@
+"""
+Local deterministic parser for simply structured text orders.
+
+Much of the text traffic already looks like the README examples:
+
+    Bill for Ramesh: 10 Rice at ₹50, 5 Oil at 120
+    Bill for Raju Fruits:
+    10 Apples @ ₹50/kg
+    5 Bananas @ Rs 20/dozen
+
+These are parsed locally in microseconds instead of paying a Gemini round
+trip. The parser returns the same {status, data, missing_fields} structure
+as parse_order together with a confidence score; parse_order only uses the
+local result when the confidence reaches FAST_PATH_MIN_CONFIDENCE and falls
+back to the model otherwise (unrecognised lines, non-Latin script, no items).
+
+Quantities are converted into the unit the rate is quoted in when the two
+are compatible ("500 g paneer at 400/kg" is 0.5 at 400, "2 dz eggs at 5
+each" is 24 at 5). Incompatible units and "for <amount>" without a
+per-unit marker (a total or a unit rate?) are left to the model. A zero
+quantity or rate is left missing, like the model decoder does, so the bot
+asks for it instead of invoicing it.
+"""
+import os
+import re
+
+from order_validation import order_result
+
+MIN_CONFIDENCE = float(os.environ.get('FAST_PATH_MIN_CONFIDENCE', 0.9))
+
+# Common Hinglish item names and their English invoice names
+HINGLISH_ITEMS = {
+    'ande': 'Eggs', 'anda': 'Eggs', 'chawal': 'Rice', 'chaawal': 'Rice', 'doodh': 'Milk',
+    'dudh': 'Milk', 'atta': 'Wheat Flour', 'aata': 'Wheat Flour', 'maida': 'Refined Flour',
+    'cheeni': 'Sugar', 'chini': 'Sugar', 'shakkar': 'Sugar', 'namak': 'Salt', 'tel': 'Oil',
+    'dal': 'Lentils', 'daal': 'Lentils', 'aloo': 'Potatoes', 'alu': 'Potatoes',
+    'pyaz': 'Onions', 'pyaaz': 'Onions', 'kanda': 'Onions', 'tamatar': 'Tomatoes',
+    'seb': 'Apples', 'kela': 'Bananas', 'kele': 'Bananas', 'chai': 'Tea', 'chai patti': 'Tea Leaves',
+    'sabun': 'Soap', 'haldi': 'Turmeric', 'mirchi': 'Chillies', 'dahi': 'Curd', 'makkhan': 'Butter',
+    'ghee': 'Ghee', 'paneer': 'Paneer', 'gud': 'Jaggery', 'besan': 'Gram Flour', 'sooji': 'Semolina',
+    'rava': 'Semolina', 'poha': 'Flattened Rice', 'jeera': 'Cumin', 'dhaniya': 'Coriander',
+    'bhindi': 'Okra', 'gobi': 'Cauliflower', 'palak': 'Spinach', 'adrak': 'Ginger', 'lehsun': 'Garlic',
+    'matar': 'Peas', 'gajar': 'Carrots', 'baingan': 'Brinjal', 'nimbu': 'Lemons', 'biscuit': 'Biscuits',
+}
+
+UNITS = r'(?:kgs?|kilos?|gms?|g|grams?|ltrs?|litres?|liters?|l|ml|pcs?|pieces?|nos?|dz|dozens?|packets?|pkts?|bags?|boxes|box|bottles?)'
+CURRENCY = r'(?:rs\.?|inr|₹|rupees?)'
+NUMBER = r'\d+(?:\.\d+)?'
+
+# "Bill for Ramesh Kirana:" / "Invoice to Ramesh -" / "Customer: Ramesh"
+CUSTOMER_HEADER = re.compile(
+    r'^\s*(?:(?:bill|invoice|order)\s+(?:for|to)|customer\s*[:\-]|to\s*[:\-])\s*'
+    r'(?P<customer>[^\d:\n\-–,;]+?)\s*(?:[:\-–\n,;]|$)',
+    re.IGNORECASE
+)
+# "Ramesh: 10 rice at 50" - a bare name followed by a colon
+BARE_CUSTOMER = re.compile(r'^\s*(?P<customer>[a-z][a-z .&\']{1,40}?)\s*:\s*', re.IGNORECASE)
+
+RATE_SUFFIX = (
+    rf'(?:\s*/-)?(?:\s*(?:/|per\s+)\s*(?P<rate_unit>{UNITS}|unit|each)\b|\s+(?P<each>each)|\s*{CURRENCY})?'
+)
+
+# Unit aliases -> (dimension, size in the dimension's base unit); packaging units only match themselves
+UNIT_SIZES = (
+    (r'kgs?|kilos?', ('weight', 1000)),
+    (r'gms?|g|grams?', ('weight', 1)),
+    (r'ltrs?|litres?|liters?|l', ('volume', 1000)),
+    (r'ml', ('volume', 1)),
+    (r'pcs?|pieces?|nos?|unit|each', ('count', 1)),
+    (r'dz|dozens?', ('count', 12)),
+    (r'packets?|pkts?', ('packet', 1)),
+    (r'bags?', ('bag', 1)),
+    (r'boxes|box', ('box', 1)),
+    (r'bottles?', ('bottle', 1)),
+)
+# Greetings, filler and bot commands that BARE_CUSTOMER would otherwise take for a customer name
+NOT_CUSTOMERS = {
+    'hi', 'hii', 'hello', 'hey', 'namaste', 'namaskar', 'ok', 'okay', 'order', 'new order', 'bill',
+    'invoice', 'please', 'pls', 'sir', 'bhai', 'ji', 'items', 'note', 'list', 'help', 'reset', 'status',
+    'start over', 'restart', 'new', 'cancel', 'stop', 'test', 'update', 'edit', 'change',
+}
+
+# 10 [kg] Rice [bags] at/@/for [Rs|₹] 50 [/kg|each]
+QTY_FIRST = re.compile(
+    rf'^(?P<qty>{NUMBER})\s*(?P<unit>{UNITS})?\.?\s+(?:of\s+)?(?P<name>[^\d@=₹]+?)'
+    rf'(?:\s*(?P<sep>@|=|\bat\b|\bfor\b|\bx\b|-|:)\s*{CURRENCY}?\s*|\s+{CURRENCY}\s*|\s+)'
+    rf'(?P<rate>{NUMBER}){RATE_SUFFIX}\s*$',
+    re.IGNORECASE
+)
+# Rice 10 [kg] @ 50
+NAME_FIRST = re.compile(
+    rf'^(?P<name>[^\d@=₹]+?)\s*[-:]?\s*(?P<qty>{NUMBER})\s*(?P<unit>{UNITS})?\.?'
+    rf'\s*(?P<sep>@|=|\bat\b|\bx\b|\*)\s*{CURRENCY}?\s*(?P<rate>{NUMBER}){RATE_SUFFIX}\s*$',
+    re.IGNORECASE
+)
+# 10 [kg] Rice   (rate still missing)
+QTY_ONLY = re.compile(rf'^(?P<qty>{NUMBER})\s*(?P<unit>{UNITS})?\.?\s+(?:of\s+)?(?P<name>[^\d@=₹]+?)\s*$', re.IGNORECASE)
+
+SEGMENT_SPLIT = re.compile(r'[\n;,]+|\s+and\s+|\s+&\s+', re.IGNORECASE)
+BULLET = re.compile(r'^\s*(?:[-•*]|\d+[.)])\s+')
+NON_LATIN = re.compile(r'[^\x00-\x7f₹–•]')
+
+
+def _number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _unit_size(unit):
+    unit = unit.lower()
+    for pattern, size in UNIT_SIZES:
+        if re.fullmatch(pattern, unit):
+            return size
+    return None
+
+
+def _clean_name(name):
+    name = re.sub(r'\s+', ' ', name).strip(" .:-'")
+    key = name.lower()
+    if key in HINGLISH_ITEMS:
+        return HINGLISH_ITEMS[key]
+    return ' '.join(word if word.isupper() else word.capitalize() for word in name.split(' '))
+
+
+def _parse_item(segment):
+    """Parse one item segment. Returns (item, confidence) or (None, 0)."""
+    for pattern in (QTY_FIRST, NAME_FIRST, QTY_ONLY):
+        match = pattern.match(segment)
+        if not match:
+            continue
+        confidence = 1.0
+        name = _clean_name(match.group('name'))
+        if not name or not re.search(r'[a-z]', name, re.IGNORECASE):
+            return None, 0.0
+        groups = match.groupdict()
+        qty, rate = _number(match.group('qty')), groups.get('rate')
+        if rate is not None and not groups.get('sep') and not re.search(CURRENCY, segment, re.IGNORECASE):
+            # "10 Rice 50": probably a rate, but without "at"/"@"/currency it is a guess
+            confidence = 0.6
+
+        rate_unit = groups.get('rate_unit') or groups.get('each')
+        if rate is not None and (groups.get('sep') or '').lower() == 'for' and not rate_unit:
+            # "10 Rice for 500": the amount may be the line total or the unit rate
+            confidence = min(confidence, 0.5)
+        if rate_unit and groups.get('unit'):
+            qty_size, rate_size = _unit_size(groups['unit']), _unit_size(rate_unit)
+            if qty_size and rate_size and qty_size[0] == rate_size[0]:
+                # "500 g at 400/kg" -> 0.5 at 400; "2 dz at 5 each" -> 24 at 5
+                qty = _number(round(qty * qty_size[1] / rate_size[1], 3))
+            else:
+                confidence = min(confidence, 0.5)
+        rate = _number(rate) if rate is not None else None
+        return {
+            'name': name,
+            # "0 rice at 50" / "10 rice at 0": ask for the value rather than invoice it
+            'qty': qty if qty > 0 else None,
+            'rate': rate if rate is None or rate > 0 else None
+        }, confidence
+    return None, 0.0
+
+
+def parse_text_order(text):
+    """
+    Parse a text order without calling the model.
+
+    Args:
+        text (str): Message body
+
+    Returns:
+        tuple: (result, confidence) where result has the parse_order
+            structure {status, data, missing_fields} and confidence is in
+            [0, 1]. Callers should fall back to the model below MIN_CONFIDENCE.
+    """
+    if not text or not text.strip():
+        return None, 0.0
+    if NON_LATIN.search(text):
+        # Devanagari and other scripts need translation by the model
+        return None, 0.0
+
+    body = re.sub(r'(?<=\d),(?=\d{3}\b)', '', text.strip())  # 1,200 -> 1200
+    customer = None
+    header = CUSTOMER_HEADER.match(body) or BARE_CUSTOMER.match(body)
+    if header:
+        customer = ' '.join(header.group('customer').split()).strip(" .'")
+        body = body[header.end():]
+        if customer.lower() in NOT_CUSTOMERS:
+            # "hi: 10 rice at 50" - a greeting, not a name
+            customer = None
+
+    items = []
+    confidence = 1.0
+    for segment in SEGMENT_SPLIT.split(body):
+        segment = BULLET.sub('', segment).strip(' .')
+        if not segment:
+            continue
+        item, item_confidence = _parse_item(segment)
+        if item is None:
+            return None, 0.0
+        items.append(item)
+        confidence = min(confidence, item_confidence)
+
+    if not items:
+        return None, 0.0
+
+    data = {'customer': customer.title() if customer and customer.islower() else customer, 'items': items}
+    return order_result(data), confidence
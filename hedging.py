@@ -0,0 +1,209 @@
+"""
+Hedged model requests.
+
+A small share of Gemini calls take far longer than the rest and dominate
+the p99 of parse_order. HedgedExtractor sends each request to the primary
+model; if no valid answer has arrived after a delay taken from a
+percentile of recent primary latencies, the same request also goes to a
+faster fallback model. The first valid answer wins.
+
+The losing call is abandoned: a hedge that has not started yet is
+cancelled, and an in-flight HTTP call is left to finish in the background
+with its result discarded (the blocking Gemini client cannot abort it).
+Its limiter slot is released when it returns. The fallback shares the
+primary's limiter, so primary and hedge calls together stay within
+LLM_MAX_CONCURRENCY (and LLM_RATE_PER_MINUTE).
+
+Policies are set per input type, e.g. for images:
+
+    HEDGE_IMAGE_PERCENTILE=0.95   # hedge after the p95 primary latency (0 disables)
+    HEDGE_IMAGE_INITIAL_DELAY=8   # delay used until enough samples exist
+
+Which path won is counted per input type (see HedgedExtractor.stats()).
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from llm_client import MAX_CONCURRENCY, FakeExtractor, GeminiExtractor, LLMTimeout
+from order_validation import OrderDecodeError, decode_order_response
+
+HEDGE_ENABLED = os.environ.get('LLM_HEDGE', '0') == '1'
+FALLBACK_MODEL = os.environ.get('GEMINI_FALLBACK_MODEL', 'gemini-2.5-flash-lite')
+FAKE_FALLBACK_LATENCY = float(os.environ.get('FAKE_LLM_FALLBACK_LATENCY', 0))
+MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.5))
+MAX_DELAY = float(os.environ.get('HEDGE_MAX_DELAY', 20))
+# Primary latencies needed before the percentile replaces the initial delay
+MIN_SAMPLES = 20
+WINDOW = 500
+
+
+@dataclass
+class HedgePolicy:
+    percentile: float  # 0 disables hedging for the input type
+    initial_delay: float
+
+    @classmethod
+    def from_env(cls, input_type, percentile, initial_delay):
+        prefix = f'HEDGE_{input_type.upper()}'
+        return cls(
+            float(os.environ.get(f'{prefix}_PERCENTILE', percentile)),
+            float(os.environ.get(f'{prefix}_INITIAL_DELAY', initial_delay))
+        )
+
+
+DEFAULT_POLICIES = {
+    'text': HedgePolicy.from_env('text', 0.9, 4),
+    'image': HedgePolicy.from_env('image', 0.95, 8),
+    'audio': HedgePolicy.from_env('audio', 0.95, 8),
+}
+
+
+def is_valid_response(text):
+    """True if a model response decodes to an order (see decode_order_response)."""
+    try:
+        decode_order_response(text, record_stats=False)
+    except OrderDecodeError:
+        return False
+    return True
+
+
+class HedgedExtractor:
+    """
+    Race a primary extractor against a fallback after a percentile delay.
+
+    Has the same extract(request, timeout)/stats() interface as
+    OrderExtractor; the limiter, deadline and circuit breaker of each model
+    are applied by the wrapped extractors. Give both the same limiter (as
+    create_hedged_extractor does), or in-flight calls can reach twice the limit.
+    """
+
+    def __init__(self, primary, fallback, policies=None, validate=is_valid_response, workers=MAX_CONCURRENCY * 2):
+        self.primary = primary
+        self.fallback = fallback
+        self.policies = policies or DEFAULT_POLICIES
+        self.validate = validate
+        self.name = f'hedged({primary.name})'
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='billbot-hedge')
+        self._lock = threading.Lock()
+        self._latencies = {}  # input_type -> deque of primary latencies
+        self._wins = {}  # input_type -> {outcome: count}
+
+    def hedge_delay(self, input_type):
+        """Seconds to wait for the primary before sending the hedge."""
+        policy = self.policies.get(input_type)
+        with self._lock:
+            samples = sorted(self._latencies.get(input_type, ()))
+        if len(samples) < MIN_SAMPLES:
+            delay = policy.initial_delay
+        else:
+            delay = samples[min(len(samples) - 1, int(len(samples) * policy.percentile))]
+        return min(MAX_DELAY, max(MIN_DELAY, delay))
+
+    def extract(self, request, timeout=None):
+        """
+        Run one extraction, hedging to the fallback model when the primary is slow.
+
+        Returns:
+            str: The first valid response text
+
+        Raises:
+            LLMTimeout: Neither model answered before the deadline
+            LLMError: Both models failed (the primary's error is raised)
+        """
+        policy = self.policies.get(request.input_type)
+        if policy is None or not policy.percentile:
+            return self.primary.extract(request, timeout)
+
+        timeout = timeout or self.primary.timeout
+        deadline = time.monotonic() + timeout
+        started = time.perf_counter()
+        primary = self._executor.submit(self.primary.extract, request, timeout)
+        primary.add_done_callback(lambda f: self._record_latency(request.input_type, f, started))
+        paths = {primary: 'primary'}
+
+        delay = self.hedge_delay(request.input_type)
+        wait([primary], timeout=min(delay, timeout))
+        hedged = False
+        # Hedge when the primary is slow, or failed fast
+        if not self._succeeded(primary):
+            hedged = True
+            remaining = max(0.1, deadline - time.monotonic())
+            if primary.done():
+                print(f"🏁 Primary model failed after {time.perf_counter() - started:.2f}s, falling back")
+            else:
+                print(f"🏁 Primary model slower than {delay:.1f}s, hedging to fallback")
+            paths[self._executor.submit(self.fallback.extract, request, remaining)] = 'fallback'
+
+        errors = {}
+        pending = set(paths)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if self._succeeded(future):
+                    for loser in pending:
+                        loser.cancel()
+                    outcome = paths[future] if not hedged or paths[future] == 'fallback' else 'primary_after_hedge'
+                    self._record_win(request.input_type, outcome)
+                    print(f"🏁 {paths[future].capitalize()} model won ({request.input_type}, {time.perf_counter() - started:.2f}s)")
+                    return future.result()
+                errors[paths[future]] = future.exception() or ValueError("Model returned an invalid response")
+
+        self._record_win(request.input_type, 'failed')
+        for future in pending:
+            future.cancel()
+        if 'primary' in errors:
+            raise errors['primary']
+        if errors:
+            raise errors['fallback']
+        raise LLMTimeout(f"No model answered within {timeout:.1f}s")
+
+    def _succeeded(self, future):
+        return future.done() and not future.cancelled() and future.exception() is None \
+            and self.validate(future.result())
+
+    def _record_latency(self, input_type, future, started):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            self._latencies.setdefault(input_type, deque(maxlen=WINDOW)).append(time.perf_counter() - started)
+
+    def _record_win(self, input_type, outcome):
+        with self._lock:
+            wins = self._wins.setdefault(input_type, {})
+            wins[outcome] = wins.get(outcome, 0) + 1
+
+    def stats(self):
+        """
+        Hedging metrics, for tuning the cost/latency tradeoff.
+
+        Returns:
+            dict: Per input type, how often each path won ('primary' without
+                a hedge, 'primary_after_hedge', 'fallback', 'failed') and the
+                current hedge delay, plus both extractors' stats
+        """
+        with self._lock:
+            wins = {input_type: dict(outcomes) for input_type, outcomes in self._wins.items()}
+        return {
+            'backend': self.name,
+            'wins': wins,
+            'hedge_delay': {input_type: round(self.hedge_delay(input_type), 3)
+                            for input_type, policy in self.policies.items() if policy.percentile},
+            'primary': self.primary.stats(),
+            'fallback': self.fallback.stats(),
+        }
+
+
+def create_hedged_extractor(name, primary):
+    """Wrap a primary extractor with the fallback model for its backend."""
+    # One limiter for both models keeps hedges within LLM_MAX_CONCURRENCY
+    if name == 'fake':
+        fallback = FakeExtractor(latency=FAKE_FALLBACK_LATENCY, slow_every=0, limiter=primary.limiter)
+    else:
+        fallback = GeminiExtractor(model=FALLBACK_MODEL, limiter=primary.limiter)
+    return HedgedExtractor(primary, fallback)
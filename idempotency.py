@@ -0,0 +1,192 @@
+"""
+MessageSid idempotency for the Twilio webhook.
+
+Twilio retries a webhook that is slow to answer. Without protection each
+retry repeats the media download, the Gemini call and the PDF render. The
+first request for a MessageSid claims it; a retry that arrives while the
+first is still running waits for it, and a retry after completion gets the
+stored TwiML response back. Entries expire after IDEMPOTENCY_TTL seconds.
+
+State lives in SQLite so retries are deduplicated across worker processes.
+"""
+import functools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+
+IDEMPOTENCY_PATH = os.environ.get('IDEMPOTENCY_PATH', 'idempotency.db')
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# How long a retry waits for the original request to finish
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 12))
+# A pending claim older than this is assumed to belong to a crashed worker
+PENDING_TIMEOUT = float(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', 120))
+
+
+class IdempotencyStore:
+    """SQLite-backed record of processed MessageSids and their responses."""
+
+    def __init__(self, path=IDEMPOTENCY_PATH, ttl=IDEMPOTENCY_TTL, pending_timeout=PENDING_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self._local = threading.local()
+        # Wakes waiters in this process as soon as a response is stored
+        self._finished = threading.Condition()
+        self._last_purge = 0.0
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS requests (
+                    sid TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    response TEXT,
+                    status_code INTEGER,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def begin(self, sid):
+        """
+        Try to claim a MessageSid for processing.
+
+        Returns:
+            tuple: ('new', None) if the caller should process the message,
+                ('pending', None) if another request is processing it, or
+                ('done', (response, status_code)) if it was already answered
+        """
+        now = time.time()
+        self._purge_expired(now)
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT status, response, status_code, created_at, expires_at FROM requests WHERE sid = ?',
+                (sid,)
+            ).fetchone()
+            if row and row[4] > now:
+                status, response, status_code, created_at, _ = row
+                if status == 'done':
+                    return 'done', (response, status_code)
+                if now - created_at < self.pending_timeout:
+                    return 'pending', None
+
+            conn.execute(
+                'INSERT OR REPLACE INTO requests (sid, status, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                (sid, 'pending', now, now + self.ttl)
+            )
+            return 'new', None
+
+    def finish(self, sid, response, status_code):
+        """Store the response for a processed MessageSid."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE requests SET status = 'done', response = ?, status_code = ? WHERE sid = ?",
+                (response, status_code, sid)
+            )
+        with self._finished:
+            self._finished.notify_all()
+
+    def abandon(self, sid):
+        """Release a claim after a failure so a retry can process the message."""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM requests WHERE sid = ? AND status = 'pending'", (sid,))
+        with self._finished:
+            self._finished.notify_all()
+
+    def wait(self, sid, timeout=IDEMPOTENCY_WAIT, poll_interval=0.25):
+        """
+        Wait for another request to finish processing a MessageSid.
+
+        Returns:
+            tuple: ('done', (response, status_code)), ('new', None) if the
+                original request failed and this one now owns the message,
+                or ('pending', None) if it is still running at the deadline
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            outcome = self.begin(sid)
+            remaining = deadline - time.monotonic()
+            if outcome[0] != 'pending' or remaining <= 0:
+                return outcome
+            # Woken early by finish() in this process; poll for other processes
+            with self._finished:
+                self._finished.wait(min(poll_interval, remaining))
+
+    def _purge_expired(self, now):
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM requests WHERE expires_at <= ?', (now,))
+
+
+_store = None
+
+
+def get_store():
+    """Return the shared idempotency store, creating it on first use."""
+    global _store
+    if _store is None:
+        _store = IdempotencyStore()
+    return _store
+
+
+def idempotent_webhook(view):
+    """
+    Decorate a Twilio webhook view so each MessageSid is processed once.
+
+    Requests without a MessageSid are passed straight through.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        sid = request.form.get('MessageSid')
+        if not sid:
+            return view(*args, **kwargs)
+
+        store = get_store()
+        outcome, cached = store.begin(sid)
+        if outcome == 'pending':
+            print(f"🔁 Twilio retry for {sid} while still processing, waiting...")
+            outcome, cached = store.wait(sid)
+
+        if outcome == 'done':
+            print(f"🔁 Returning cached response for {sid}")
+            return cached
+        if outcome == 'pending':
+            # Still running: answer without reprocessing so no duplicate invoice is made
+            print(f"⚠️ {sid} still processing after {IDEMPOTENCY_WAIT:.0f}s, skipping retry")
+            return '<?xml version="1.0" encoding="UTF-8"?><Response />', 200
+
+        try:
+            response, status_code = view(*args, **kwargs)
+        except Exception:
+            store.abandon(sid)
+            raise
+        store.finish(sid, response, status_code)
+        return response, status_code
+
+    return wrapper
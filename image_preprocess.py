@@ -0,0 +1,204 @@
+"""
+Image preprocessing before OCR upload.
+
+Phone photos of bills are often several megabytes, and uploading them to
+Gemini dominates request latency. Before upload each image is:
+
+    1. rotated according to its EXIF orientation,
+    2. downscaled so its longest side is at most IMAGE_MAX_DIMENSION,
+    3. converted to grayscale when it is essentially colourless (paper and ink),
+    4. recompressed as JPEG, lowering quality and then size until it fits
+       IMAGE_TARGET_BYTES.
+
+Decoding and encoding run in a shared thread pool; Pillow releases the GIL
+for most of that work, so several images can be prepared in parallel.
+Images Pillow cannot decode are passed through unchanged.
+"""
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps, ImageStat
+
+PREPROCESS_ENABLED = os.environ.get('IMAGE_PREPROCESS', '1') == '1'
+MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 1600))
+TARGET_BYTES = int(os.environ.get('IMAGE_TARGET_BYTES', 400 * 1024))
+# 'auto' converts near-colourless photos, '1' always, '0' never
+GRAYSCALE = os.environ.get('IMAGE_GRAYSCALE', 'auto')
+WORKERS = int(os.environ.get('IMAGE_PREPROCESS_WORKERS', 4))
+
+# Mean saturation (0-255) below which a photo is treated as colourless
+GRAYSCALE_SATURATION = 40
+JPEG_QUALITIES = (85, 75, 65, 55)
+MIN_DIMENSION = 800
+
+# Changes whenever preprocessing would produce different OCR input
+PREPROCESS_SIGNATURE = f"{PREPROCESS_ENABLED}:{MAX_DIMENSION}:{TARGET_BYTES}:{GRAYSCALE}"
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    original_size: int
+    seconds: float
+    width: int = 0
+    height: int = 0
+    grayscale: bool = False
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def _is_colourless(image):
+    thumbnail = image.copy()
+    thumbnail.thumbnail((64, 64))
+    saturation = ImageStat.Stat(thumbnail.convert('HSV')).mean[1]
+    return saturation < GRAYSCALE_SATURATION
+
+
+def _encode(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def preprocess_image(data, mime_type=None, max_dimension=MAX_DIMENSION, target_bytes=TARGET_BYTES,
+                     grayscale=GRAYSCALE):
+    """
+    Shrink an image for OCR upload.
+
+    Args:
+        data (bytes): Original image bytes
+        mime_type (str, optional): Original MIME type
+        max_dimension (int): Longest side after downscaling, in pixels
+        target_bytes (int): Size to recompress to
+        grayscale (str): 'auto', '1' or '0'
+
+    Returns:
+        PreparedImage: The smaller of the processed and original image
+    """
+    started = time.perf_counter()
+    original = PreparedImage(data, mime_type or 'image/jpeg', len(data), 0.0)
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder skip detail we are going to throw away
+        image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        is_gray = image.mode == 'L'
+        if not is_gray and (grayscale == '1' or (grayscale == 'auto' and _is_colourless(image))):
+            image = image.convert('L')
+            is_gray = True
+
+        encoded = None
+        while True:
+            for quality in JPEG_QUALITIES:
+                encoded = _encode(image, quality)
+                if len(encoded) <= target_bytes:
+                    break
+            if len(encoded) <= target_bytes or max(image.size) <= MIN_DIMENSION:
+                break
+            # Still too large at the lowest quality: trade resolution instead
+            image = image.resize((int(image.width * 0.8), int(image.height * 0.8)), Image.LANCZOS)
+    except Exception as e:
+        print(f"⚠️ Image preprocessing skipped: {str(e)}")
+        original.seconds = time.perf_counter() - started
+        return original
+
+    seconds = time.perf_counter() - started
+    if len(encoded) >= len(data):
+        original.seconds = seconds
+        return original
+    return PreparedImage(encoded, 'image/jpeg', len(data), seconds, image.width, image.height, is_gray)
+
+
+class ImagePreprocessor:
+    """Thread pool that prepares images and records size/time metrics."""
+
+    def __init__(self, workers=WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='billbot-image')
+        self._lock = threading.Lock()
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds_total = 0.0
+
+    def submit(self, data, mime_type=None):
+        """Start preparing an image. Returns a Future of PreparedImage."""
+        return self._executor.submit(self._prepare, data, mime_type)
+
+    def prepare(self, data, mime_type=None):
+        """Prepare an image on the pool and wait for the result."""
+        return self.submit(data, mime_type).result()
+
+    def prepare_many(self, images):
+        """Prepare (data, mime_type) pairs in parallel, preserving order."""
+        futures = [self.submit(data, mime_type) for data, mime_type in images]
+        return [future.result() for future in futures]
+
+    def _prepare(self, data, mime_type):
+        prepared = preprocess_image(data, mime_type)
+        with self._lock:
+            self.images += 1
+            self.bytes_in += prepared.original_size
+            self.bytes_out += prepared.size
+            self.seconds_total += prepared.seconds
+        print(f"🖼️ Image {prepared.original_size} -> {prepared.size} bytes in {prepared.seconds * 1000:.0f}ms")
+        return prepared
+
+    def stats(self):
+        """
+        Preprocessing metrics.
+
+        Returns:
+            dict: images, bytes_in, bytes_out, bytes_saved, avg_seconds
+        """
+        with self._lock:
+            return {
+                'images': self.images,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'bytes_saved': self.bytes_in - self.bytes_out,
+                'avg_seconds': round(self.seconds_total / self.images, 4) if self.images else 0.0,
+            }
+
+
+_preprocessor = None
+
+
+def get_preprocessor():
+    """Return the shared image preprocessor, creating it on first use."""
+    global _preprocessor
+    if _preprocessor is None:
+        _preprocessor = ImagePreprocessor()
+    return _preprocessor
+
+
+def prepare_image(data, mime_type=None):
+    """
+    Prepare an image for upload with the shared preprocessor.
+
+    Returns the original bytes untouched when IMAGE_PREPROCESS=0.
+    """
+    if not PREPROCESS_ENABLED:
+        return PreparedImage(data, mime_type or 'image/jpeg', len(data), 0.0)
+    return get_preprocessor().prepare(data, mime_type)
+
+
+def prepare_images(images):
+    """
+    Prepare several (data, mime_type) images in parallel with the shared preprocessor.
+
+    Returns the original bytes untouched when IMAGE_PREPROCESS=0.
+    """
+    if not PREPROCESS_ENABLED:
+        return [PreparedImage(data, mime_type or 'image/jpeg', len(data), 0.0) for data, mime_type in images]
+    return get_preprocessor().prepare_many(images)
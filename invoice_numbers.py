@@ -0,0 +1,430 @@
+"""
+Sequential invoice numbers per company.
+
+GST invoicing needs consecutive invoice numbers per merchant, and file
+names must never collide. Each company (keyed by the merchant's phone
+number) has a durable counter in SQLite. A process leases a block of
+INVOICE_NUMBER_BLOCK numbers at a time and hands them out from memory, so
+allocating a number needs no storage round trip; only leasing the next
+block does (BEGIN IMMEDIATE, safe across processes).
+
+The allocator keeps numbers gap-free where it can:
+
+    - a number whose invoice failed to render is released and reused next,
+    - unused numbers of a block are returned to a free list on shutdown and
+      leased again before the counter advances,
+    - blocks of a process that died are reclaimed: every number of the
+      block that was never issued goes back to the free list.
+
+Leases expire after INVOICE_BLOCK_LEASE_SECONDS. A live process renews its
+leases from a heartbeat thread, and checks that its last renewal is fresh
+before handing out a number, so it never uses a block that was reclaimed.
+Expired blocks are reclaimed from any host (e.g. a container that was
+killed and came back under a new hostname) at startup and whenever a
+block is leased; blocks of dead processes on the same host are reclaimed
+right away. Expiry compares wall clocks, so hosts sharing the database
+need reasonably synchronised clocks.
+
+Issued numbers are recorded in a ledger (confirm()), and ledger() reports
+what was issued and which numbers below the counter are still unissued.
+
+CLI:
+    python invoice_numbers.py ledger PHONE
+"""
+import atexit
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+INVOICE_NUMBERS_PATH = os.environ.get('INVOICE_NUMBERS_PATH', 'invoice_numbers.db')
+INVOICE_NUMBER_BLOCK = int(os.environ.get('INVOICE_NUMBER_BLOCK', 20))
+INVOICE_NUMBER_PREFIX = os.environ.get('INVOICE_NUMBER_PREFIX', 'INV')
+INVOICE_BLOCK_LEASE_SECONDS = float(os.environ.get('INVOICE_BLOCK_LEASE_SECONDS', 600))
+
+
+def company_key(phone_number):
+    """Short, stable key for a merchant that does not reveal their phone number."""
+    return hashlib.sha1(phone_number.encode('utf-8')).hexdigest()[:10]
+
+
+def format_invoice_number(number):
+    """e.g. 42 -> 'INV-000042'."""
+    return f"{INVOICE_NUMBER_PREFIX}-{number:06d}"
+
+
+def invoice_filename(phone_number, number):
+    """PDF file name for an allocated number; unique across companies."""
+    return f"invoice_{company_key(phone_number)}_{number:06d}.pdf"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class InvoiceNumberAllocator:
+    """Block-leasing allocator of per-company invoice numbers."""
+
+    def __init__(self, path=INVOICE_NUMBERS_PATH, block_size=INVOICE_NUMBER_BLOCK,
+                 lease_seconds=INVOICE_BLOCK_LEASE_SECONDS):
+        self.path = path
+        self.block_size = block_size
+        self.lease_seconds = lease_seconds
+        self.host = socket.gethostname()
+        # The random part keeps a restarted container that reuses host and pid from owning old blocks
+        self.owner = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._blocks = {}  # company -> [[next, end, block_start], ...] numbers still available in memory
+        self._held = {}  # (company, block_start) -> block_end of blocks leased by this allocator
+        self._renewed_at = time.time()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._leases = 0
+
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sequences (
+                    company TEXT PRIMARY KEY,
+                    next_number INTEGER NOT NULL
+                )
+                """
+            )
+            # Blocks currently leased, by owner ('host:pid:random'); leased_at is renewed by a heartbeat
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blocks (
+                    company TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL,
+                    owner TEXT NOT NULL,
+                    leased_at REAL NOT NULL,
+                    PRIMARY KEY (company, start)
+                )
+                """
+            )
+            # Numbers below the counter that were handed back unissued
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS free_ranges (
+                    company TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL,
+                    PRIMARY KEY (company, start)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS issued (
+                    company TEXT NOT NULL,
+                    number INTEGER NOT NULL,
+                    filename TEXT,
+                    reference TEXT,
+                    issued_at REAL NOT NULL,
+                    PRIMARY KEY (company, number)
+                )
+                """
+            )
+            if 'reference' not in {row[1] for row in conn.execute('PRAGMA table_info(issued)')}:
+                conn.execute('ALTER TABLE issued ADD COLUMN reference TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS issued_reference ON issued (company, reference)')
+        self.recover()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def allocate(self, company):
+        """
+        Take the next invoice number for a company.
+
+        Args:
+            company (str): Company key, e.g. the merchant's phone number
+
+        Returns:
+            int: Invoice number, unique for the company
+        """
+        with self._lock:
+            if self._held and time.time() - self._renewed_at > self.lease_seconds / 2:
+                # The heartbeat is behind; make sure no block was reclaimed before using it
+                self._renew()
+            ranges = self._blocks.setdefault(company, [])
+            if not ranges:
+                ranges.append(self._lease(company))
+            block = ranges[0]
+            number = block[0]
+            if block[0] == block[1]:
+                ranges.pop(0)
+            else:
+                block[0] += 1
+            return number
+
+    def release(self, company, number):
+        """Give back an allocated number that was not used, so it is issued next."""
+        with self._lock:
+            for (held_company, start), end in self._held.items():
+                if held_company == company and start <= number <= end:
+                    self._blocks.setdefault(company, []).insert(0, [number, number, start])
+                    return
+
+    def _renew(self):
+        """Renew this allocator's leases and forget blocks that were reclaimed. Caller holds _lock."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('UPDATE blocks SET leased_at = ? WHERE owner = ?', (now, self.owner))
+            leased = {(company, start) for company, start in conn.execute(
+                'SELECT company, start FROM blocks WHERE owner = ?', (self.owner,))}
+        lost = [key for key in self._held if key not in leased]
+        for company, start in lost:
+            del self._held[(company, start)]
+            self._blocks[company] = [r for r in self._blocks.get(company, []) if r[2] != start]
+        if lost:
+            print(f"⚠️ {len(lost)} invoice number blocks were reclaimed before this process renewed them")
+        self._renewed_at = now
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                with self._lock:
+                    self._renew()
+            except sqlite3.Error as e:
+                print(f"⚠️ Could not renew invoice number leases: {str(e)}")
+
+    def confirm(self, company, number, filename=None, reference=None):
+        """Record a number as issued in the ledger, optionally under a caller's reference."""
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO issued (company, number, filename, reference, issued_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (company, number, filename, reference, time.time())
+            )
+
+    def find(self, company, reference):
+        """
+        Look up the invoice issued under a reference.
+
+        Returns:
+            tuple: (number, filename), or None if nothing was issued for it
+        """
+        row = self._connect().execute(
+            'SELECT number, filename FROM issued WHERE company = ? AND reference = ? ORDER BY number LIMIT 1',
+            (company, reference)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def _lease(self, company):
+        """Lease a block, preferring returned numbers over advancing the counter. Caller holds _lock."""
+        with self._transaction() as conn:
+            self._reclaim(conn)
+            free = conn.execute(
+                'SELECT start, end FROM free_ranges WHERE company = ? ORDER BY start LIMIT 1', (company,)
+            ).fetchone()
+            if free is not None:
+                start, end = free[0], min(free[1], free[0] + self.block_size - 1)
+                conn.execute('DELETE FROM free_ranges WHERE company = ? AND start = ?', (company, start))
+                if end < free[1]:
+                    conn.execute('INSERT INTO free_ranges (company, start, end) VALUES (?, ?, ?)',
+                                 (company, end + 1, free[1]))
+            else:
+                row = conn.execute('SELECT next_number FROM sequences WHERE company = ?', (company,)).fetchone()
+                start = row[0] if row else 1
+                end = start + self.block_size - 1
+                conn.execute('INSERT OR REPLACE INTO sequences (company, next_number) VALUES (?, ?)',
+                             (company, end + 1))
+            conn.execute(
+                'INSERT OR REPLACE INTO blocks (company, start, end, owner, leased_at) VALUES (?, ?, ?, ?, ?)',
+                (company, start, end, self.owner, time.time())
+            )
+        self._leases += 1
+        if not self._held:
+            self._renewed_at = time.time()
+        self._held[(company, start)] = end
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='invoice-number-leases', daemon=True)
+            self._heartbeat.start()
+        return [start, end, start]
+
+    def _return_unissued(self, conn, company, start, end):
+        """Move the never-issued numbers of [start, end] to the free list."""
+        issued = {row[0] for row in conn.execute(
+            'SELECT number FROM issued WHERE company = ? AND number BETWEEN ? AND ?', (company, start, end)
+        )}
+        run_start = None
+        for number in range(start, end + 2):
+            if number <= end and number not in issued:
+                run_start = number if run_start is None else run_start
+            elif run_start is not None:
+                conn.execute('INSERT OR REPLACE INTO free_ranges (company, start, end) VALUES (?, ?, ?)',
+                             (company, run_start, number - 1))
+                run_start = None
+
+    def close(self):
+        """Give up this process's blocks, returning every unissued number to the free list."""
+        self._stop.set()
+        with self._lock:
+            self._blocks = {}
+            self._held = {}
+            with self._transaction() as conn:
+                leased = conn.execute('SELECT company, start, end FROM blocks WHERE owner = ?',
+                                      (self.owner,)).fetchall()
+                for company, start, end in leased:
+                    self._return_unissued(conn, company, start, end)
+                conn.execute('DELETE FROM blocks WHERE owner = ?', (self.owner,))
+
+    def _reclaim(self, conn):
+        """Return the unissued numbers of expired blocks and of dead local processes' blocks."""
+        expired_before = time.time() - self.lease_seconds
+        stale = []
+        for company, start, end, owner, leased_at in conn.execute(
+                'SELECT company, start, end, owner, leased_at FROM blocks').fetchall():
+            if owner == self.owner:
+                continue
+            host, _, rest = owner.partition(':')
+            pid = rest.split(':')[0]
+            dead = host == self.host and pid.isdigit() and not _pid_alive(int(pid))
+            if dead or leased_at < expired_before:
+                stale.append((company, start, end))
+        for company, start, end in stale:
+            self._return_unissued(conn, company, start, end)
+            conn.execute('DELETE FROM blocks WHERE company = ? AND start = ?', (company, start))
+        if stale:
+            print(f"🔢 Recovered {len(stale)} invoice number blocks from exited processes")
+        return len(stale)
+
+    def recover(self):
+        """
+        Reclaim blocks whose lease expired or whose process on this host is gone.
+
+        Returns:
+            int: Number of blocks recovered
+        """
+        with self._transaction() as conn:
+            return self._reclaim(conn)
+
+    def ledger(self, company):
+        """
+        Issued and unissued numbers of a company.
+
+        Returns:
+            dict: next_number (the counter), issued count, last issued number,
+                free ranges waiting to be reused and ranges leased to live
+                processes
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT next_number FROM sequences WHERE company = ?', (company,)).fetchone()
+        count, last = conn.execute(
+            'SELECT COUNT(*), MAX(number) FROM issued WHERE company = ?', (company,)
+        ).fetchone()
+        return {
+            'next_number': row[0] if row else 1,
+            'issued': count,
+            'last_issued': last,
+            'free': [list(r) for r in conn.execute(
+                'SELECT start, end FROM free_ranges WHERE company = ? ORDER BY start', (company,))],
+            'leased': [{'start': r[0], 'end': r[1], 'owner': r[2]} for r in conn.execute(
+                'SELECT start, end, owner FROM blocks WHERE company = ? ORDER BY start', (company,))],
+        }
+
+    def stats(self):
+        """Blocks leased by this process and numbers it still holds in memory."""
+        with self._lock:
+            held = sum(end - start + 1 for ranges in self._blocks.values() for start, end, _ in ranges)
+            return {'leases': self._leases, 'held': held, 'companies': len(self._blocks)}
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_allocator():
+    """Return the shared allocator, creating it on first use."""
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = InvoiceNumberAllocator()
+                atexit.register(_allocator.close)
+    return _allocator
+
+
+def set_allocator(allocator):
+    """Replace the shared allocator (e.g. a temporary file in tests)."""
+    global _allocator
+    _allocator = allocator
+
+
+def issue_invoice(phone_number, data, company_details=None, engine=None, reference=None):
+    """
+    Render an invoice under the merchant's next invoice number.
+
+    The number is released for reuse if rendering fails and recorded in the
+    ledger once the PDF exists. With a reference (e.g. an import row), an
+    invoice already issued under it is returned instead of rendering again,
+    so retried jobs do not issue a second number.
+
+    Args:
+        phone_number (str): Merchant's phone number; the sequence key
+        data (dict): Order data, as for generate_pdf
+        company_details (dict, optional): Company information, as for generate_pdf
+        engine (str, optional): Invoice engine, as for generate_pdf
+        reference (str, optional): Caller's idempotency key for this invoice
+
+    Returns:
+        tuple: (invoice number, PDF file name)
+    """
+    from invoice_gen import generate_pdf
+
+    allocator = get_allocator()
+    if reference is not None:
+        issued = allocator.find(phone_number, reference)
+        if issued is not None:
+            return format_invoice_number(issued[0]), issued[1]
+
+    number = allocator.allocate(phone_number)
+    invoice_number = format_invoice_number(number)
+    filename = invoice_filename(phone_number, number)
+    try:
+        generate_pdf(data, filename, company_details, engine=engine, invoice_number=invoice_number)
+    except BaseException:
+        allocator.release(phone_number, number)
+        raise
+    allocator.confirm(phone_number, number, filename, reference)
+    return invoice_number, filename
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'ledger':
+        print(json.dumps(get_allocator().ledger(sys.argv[2]), indent=2))
+        sys.exit(0)
+    print(__doc__)
+    sys.exit(1)
@@ -0,0 +1,265 @@
+"""
+Precompiled invoice templates.
+
+Everything on an invoice except the customer block and the item rows is
+the same for every invoice of a merchant: paragraph and table styles, the
+"INVOICE" title, the company letterhead and the footer. They are built
+once per company and cached, keyed by a hash of company_details, so
+generate_pdf only lays out the per-invoice parts.
+
+The letterhead and footer are drawn into a PDF form XObject the first time
+a document needs them and stamped on every page with doForm, so a
+multi-page invoice stores them once. Onboarding calls invalidate_template()
+when a merchant edits their company details.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.graphics.barcode import code128
+from reportlab.platypus import Paragraph, TableStyle
+
+TEMPLATE_CACHE_SIZE = int(os.environ.get('INVOICE_TEMPLATE_CACHE_SIZE', 256))
+
+PAGE_SIZE = A4
+MARGIN = inch  # SimpleDocTemplate's default margins
+
+# Tax rates
+CGST_RATE = 0.09  # 9%
+SGST_RATE = 0.09  # 9%
+TOTAL_TAX_RATE = CGST_RATE + SGST_RATE  # 18%
+
+# Item table column widths and header, shared by both rendering engines
+ITEM_COL_WIDTHS = [2.8 * inch, 0.8 * inch, 1.2 * inch, 1.2 * inch, 1.2 * inch]
+ITEM_HEADER = ['Item', 'Qty', 'Rate', 'Tax (18%)', 'Total']
+
+DEFAULT_COMPANY = {
+    'name': 'BillBot Services',
+    'address': '123 Business Street, City, State - 123456',
+    'gstin': '29XXXXX1234X1ZX'
+}
+
+# Styles and table styles shared by every template
+STYLES = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=STYLES['Heading1'],
+    fontSize=24,
+    textColor=colors.HexColor('#1a237e'),
+    spaceAfter=30,
+    alignment=1  # Center
+)
+HEADING_STYLE = ParagraphStyle(
+    'CustomHeading',
+    parent=STYLES['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#283593'),
+    spaceAfter=12
+)
+NORMAL_STYLE = STYLES['Normal']
+FOOTER_STYLE = ParagraphStyle('Footer', parent=NORMAL_STYLE, fontSize=8, textColor=colors.grey)
+
+CUSTOMER_TABLE_STYLE = TableStyle([
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+])
+
+# Header and item rows; the style holds for any number of items and for
+# each part of a table split across pages
+ITEM_TABLE_STYLE = TableStyle([
+    # Header row
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#283593')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('TOPPADDING', (0, 0), (-1, 0), 12),
+
+    # Data rows
+    ('ALIGN', (1, 1), (-1, -1), 'RIGHT'),
+    ('ALIGN', (0, 1), (0, -1), 'LEFT'),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 10),
+    ('TOPPADDING', (0, 1), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+
+    # Grid
+    ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#bdbdbd')),
+
+    # Alternating row colors for items
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f5f5f5')]),
+])
+
+# Blank row, subtotal, CGST, SGST, total tax and grand total under the items
+TOTALS_TABLE_STYLE = TableStyle([
+    ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+    ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('TOPPADDING', (0, 0), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    ('LINEABOVE', (2, 0), (-1, 0), 1, colors.HexColor('#757575')),
+
+    # Grand total row
+    ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#e3f2fd')),
+    ('LINEABOVE', (2, -1), (-1, -1), 2, colors.HexColor('#283593')),
+    ('FONTSIZE', (0, -1), (-1, -1), 12),
+])
+
+
+def invoice_amounts(items):
+    """
+    Compute per-item tax and totals.
+
+    Args:
+        items (list): Order items with 'name', 'qty' and 'rate'
+
+    Returns:
+        tuple: (rows, subtotal, total_tax, grand_total), where rows holds
+            (name, qty, rate, tax, total) per item
+    """
+    rows = []
+    subtotal = 0
+    total_tax = 0
+    for item in items:
+        qty = item.get('qty', 1)
+        rate = item.get('rate', 0.0)
+        item_subtotal = qty * rate
+        item_tax = item_subtotal * TOTAL_TAX_RATE
+
+        subtotal += item_subtotal
+        total_tax += item_tax
+        rows.append((item.get('name', 'Unknown Item'), qty, rate, item_tax, item_subtotal + item_tax))
+    return rows, subtotal, total_tax, subtotal + total_tax
+
+
+def draw_barcode(canvas_obj, filename):
+    """Draw the invoice's Code128 barcode (its filename) in the top-right corner."""
+    barcode_data = filename.replace('.pdf', '')
+    barcode = code128.Code128(barcode_data, barWidth=0.8, barHeight=30)
+    # Top-right corner with padding (360, 780)
+    barcode.drawOn(canvas_obj, 360, 780)
+
+
+def template_key(company_details):
+    """Hash of the company details a template was built from."""
+    encoded = json.dumps(company_details or DEFAULT_COMPANY, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class InvoiceTemplate:
+    """The static letterhead and footer of one company's invoices."""
+
+    def __init__(self, company_details):
+        self.company_details = company_details or DEFAULT_COMPANY
+        self.key = template_key(company_details)
+        self.form_name = f'letterhead_{self.key[:16]}'
+        self._lock = threading.Lock()
+
+        width = PAGE_SIZE[0] - 2 * MARGIN
+        self._header = self._wrap(self._header_flowables(), width)
+        self._footer = self._wrap(self._footer_flowables(), width)
+        self.header_height = sum(height + space for _, height, space in self._header)
+        # Body frame starts below the letterhead
+        self.top_margin = MARGIN + self.header_height
+
+    def _header_flowables(self):
+        name = self.company_details.get('name', 'BillBot Services')
+        address = self.company_details.get('address', 'N/A')
+        gstin = self.company_details.get('gstin', 'N/A')
+
+        flowables = [
+            (Paragraph("INVOICE", TITLE_STYLE), TITLE_STYLE.spaceAfter + 0.2 * inch),
+            (Paragraph(f"<b>{name}</b>", HEADING_STYLE), HEADING_STYLE.spaceAfter)
+        ]
+        if address and address != 'N/A':
+            flowables.append((Paragraph(address, NORMAL_STYLE), 0))
+        if gstin and gstin != 'N/A':
+            flowables.append((Paragraph(f"GSTIN: {gstin}", NORMAL_STYLE), 0))
+        # Space between the letterhead and the customer block
+        flowables[-1] = (flowables[-1][0], flowables[-1][1] + 0.3 * inch)
+        return flowables
+
+    def _footer_flowables(self):
+        return [
+            (Paragraph("<i>Thank you for your business!</i>", NORMAL_STYLE), 0.1 * inch),
+            (Paragraph("This is a computer generated invoice.", FOOTER_STYLE), 0)
+        ]
+
+    @staticmethod
+    def _wrap(flowables, width):
+        wrapped = []
+        for flowable, space in flowables:
+            _, height = flowable.wrap(width, PAGE_SIZE[1])
+            wrapped.append((flowable, height, space))
+        return wrapped
+
+    def draw_letterhead(self, canvas_obj, doc_obj):
+        """
+        Stamp the letterhead and footer on a page (a platypus onPage callback).
+
+        The first call for a document draws them into a form XObject; later
+        pages reuse it.
+        """
+        if not canvas_obj.hasForm(self.form_name):
+            with self._lock:
+                canvas_obj.beginForm(self.form_name)
+                self._draw(canvas_obj)
+                canvas_obj.endForm()
+        canvas_obj.doForm(self.form_name)
+
+    def _draw(self, canvas_obj):
+        y = PAGE_SIZE[1] - MARGIN
+        for flowable, height, space in self._header:
+            y -= height
+            flowable.drawOn(canvas_obj, MARGIN, y)
+            y -= space
+
+        # Footer sits in the bottom margin, below the body frame
+        y = MARGIN - 0.15 * inch
+        for flowable, height, space in self._footer:
+            y -= height
+            flowable.drawOn(canvas_obj, MARGIN, y)
+            y -= space
+
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def get_template(company_details):
+    """
+    Return the cached template for a company, building it on first use.
+
+    Args:
+        company_details (dict): Company name, address and GSTIN; None for the defaults
+
+    Returns:
+        InvoiceTemplate: Template shared by all invoices with these details
+    """
+    key = template_key(company_details)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is not None:
+            _templates.move_to_end(key)
+            return template
+
+    template = InvoiceTemplate(company_details)
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def invalidate_template(company_details):
+    """Drop the cached template for company details that are about to change."""
+    with _templates_lock:
+        _templates.pop(template_key(company_details), None)
@@ -0,0 +1,240 @@
+"""
+Per-merchant item catalog learned from generated invoices.
+
+Merchants bill the same items at the same prices again and again. Every
+order that reaches generate_pdf is recorded in the merchant's catalog, kept
+in its own SQLite store (ITEM_CATALOG_PATH) rather than in the user record,
+so user writes stay small however many items a merchant bills:
+
+    {
+        'items': {'rice': {'name': 'Rice', 'rate': 50, 'count': 12, 'last_used': '...'}},
+        'aliases': {'rice': 'rice', 'chawal': 'rice', 'chaawal': 'rice'}
+    }
+
+'aliases' is a precomputed index from normalized item names, including the
+Hinglish words for the item, to catalog keys, so a lookup is one dict access
+rather than a scan. New orders use the catalog to canonicalize item names and
+to fill rates the merchant left out, which saves an AWAITING_INFO round trip.
+"""
+import copy
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from fast_parser import HINGLISH_ITEMS
+from order_validation import order_result
+
+ITEM_CATALOG_PATH = os.environ.get('ITEM_CATALOG_PATH', 'item_catalog.db')
+MAX_CATALOG_ITEMS = int(os.environ.get('ITEM_CATALOG_MAX_ITEMS', 500))
+
+
+def _singular(word):
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def normalize_item_name(name):
+    """
+    Normalize an item name for alias lookups.
+
+    'Rice Bags' -> 'rice bag', 'EGGS' -> 'egg', ' Doodh. ' -> 'doodh'
+    """
+    words = re.sub(r'[^a-z0-9]+', ' ', (name or '').lower()).split()
+    return ' '.join(_singular(word) for word in words)
+
+
+# Normalized English name -> normalized Hinglish aliases, e.g. 'rice' -> ['chawal', 'chaawal']
+_HINGLISH_ALIASES = {}
+for _alias, _english in HINGLISH_ITEMS.items():
+    _HINGLISH_ALIASES.setdefault(normalize_item_name(_english), []).append(normalize_item_name(_alias))
+
+
+def empty_catalog():
+    """Return an empty catalog."""
+    return {'items': {}, 'aliases': {}}
+
+
+def lookup(catalog, name):
+    """
+    Find the catalog entry for an item name.
+
+    Args:
+        catalog (dict): User's item catalog (may be None)
+        name (str): Item name as written in the order
+
+    Returns:
+        dict: Entry with 'name', 'rate', 'count' and 'last_used', or None
+    """
+    if not catalog or not name:
+        return None
+    aliases = catalog.get('aliases', {})
+    key = aliases.get(normalize_item_name(name))
+    if key is None and name.strip().lower() in HINGLISH_ITEMS:
+        key = aliases.get(normalize_item_name(HINGLISH_ITEMS[name.strip().lower()]))
+    return catalog.get('items', {}).get(key) if key is not None else None
+
+
+def learn_order(catalog, order_data):
+    """
+    Record the items of a generated invoice in the catalog.
+
+    Args:
+        catalog (dict): User's item catalog (may be None)
+        order_data (dict): Complete order with 'items'
+
+    Returns:
+        dict: Updated catalog (a new dict; the input is not modified)
+    """
+    catalog = copy.deepcopy(catalog) if catalog else empty_catalog()
+    items = catalog.setdefault('items', {})
+    aliases = catalog.setdefault('aliases', {})
+    now = datetime.now().isoformat()
+
+    for item in order_data.get('items', []):
+        if not item.get('name') or item.get('rate') is None:
+            continue
+        key = aliases.get(normalize_item_name(item['name'])) or normalize_item_name(item['name'])
+        if not key:
+            continue
+        entry = items.setdefault(key, {'name': item['name'], 'count': 0})
+        entry['rate'] = item['rate']
+        entry['count'] += 1
+        entry['last_used'] = now
+
+        aliases[key] = key
+        aliases[normalize_item_name(item['name'])] = key
+        for alias in _HINGLISH_ALIASES.get(key, []):
+            # Never steal an alias another item was learned under
+            aliases.setdefault(alias, key)
+
+    if len(items) > MAX_CATALOG_ITEMS:
+        _evict(catalog, len(items) - MAX_CATALOG_ITEMS)
+    return catalog
+
+
+def _evict(catalog, count):
+    """Drop the least recently used entries and their aliases."""
+    items = catalog['items']
+    stale = set(sorted(items, key=lambda key: items[key].get('last_used', ''))[:count])
+    for key in stale:
+        del items[key]
+    catalog['aliases'] = {alias: key for alias, key in catalog['aliases'].items() if key not in stale}
+
+
+def apply_catalog(catalog, parse_result):
+    """
+    Canonicalize item names and fill missing rates from the catalog.
+
+    Args:
+        catalog (dict): User's item catalog (may be None)
+        parse_result (dict): parse_order() result
+
+    Returns:
+        tuple: (result, filled) where result is a new parse result with
+            status and missing_fields recomputed if any rate was filled, and
+            filled lists the names of the items whose rate came from the catalog
+    """
+    if not catalog or not catalog.get('items') or parse_result.get('status') not in ('complete', 'incomplete'):
+        return parse_result, []
+
+    result = copy.deepcopy(parse_result)
+    data = result.get('data') or {}
+    filled = []
+    for item in data.get('items') or []:
+        entry = lookup(catalog, item.get('name'))
+        if entry is None:
+            continue
+        item['name'] = entry['name']
+        if item.get('rate') is None and entry.get('rate') is not None:
+            item['rate'] = entry['rate']
+            filled.append(entry['name'])
+
+    if filled and result['status'] == 'incomplete':
+        result = order_result(data)
+    return result, filled
+
+
+class ItemCatalogStore:
+    """One catalog per merchant in SQLite, updated with a single-row read-modify-write."""
+
+    def __init__(self, path=ITEM_CATALOG_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalogs (
+                    phone TEXT PRIMARY KEY,
+                    catalog TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get(self, phone_number):
+        """Return a merchant's catalog, or None if nothing was learned yet."""
+        row = self._connect().execute('SELECT catalog FROM catalogs WHERE phone = ?', (phone_number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, phone_number, mutate):
+        """
+        Atomically replace a merchant's catalog with mutate(current catalog or None).
+
+        Returns:
+            dict: The stored catalog
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT catalog FROM catalogs WHERE phone = ?', (phone_number,)).fetchone()
+            catalog = mutate(json.loads(row[0]) if row else None)
+            conn.execute(
+                'INSERT OR REPLACE INTO catalogs (phone, catalog, updated_at) VALUES (?, ?, ?)',
+                (phone_number, json.dumps(catalog), time.time())
+            )
+        return catalog
+
+    def adopt(self, phone_number, catalog):
+        """Store a catalog moved out of a user record, unless one was learned here already."""
+        if not catalog or not catalog.get('items'):
+            return
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO catalogs (phone, catalog, updated_at) VALUES (?, ?, ?)',
+                (phone_number, json.dumps(catalog), time.time())
+            )
+
+
+_store = None
+
+
+def get_catalog_store():
+    """Return the shared item catalog store, creating it on first use."""
+    global _store
+    if _store is None:
+        _store = ItemCatalogStore()
+    return _store
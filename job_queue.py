@@ -0,0 +1,416 @@
+"""
+Durable SQLite-backed job queue for order parsing and invoice rendering.
+
+Jobs survive process restarts. A worker claims a job with a lease; if the
+worker dies, the lease expires (visibility timeout) and another worker picks
+the job up again. Each claim gets a new lease token: extend(), complete() and
+fail() only act while the caller still holds the lease, so a worker whose
+job was reclaimed cannot finish it a second time. Failed jobs are retried with capped exponential backoff
+and moved to the dead-letter state after max_attempts.
+
+Jobs that share a key (the sender's phone number) run strictly in order, one
+at a time, so a merchant's messages never race on their conversation state.
+
+CLI:
+    python job_queue.py stats
+    python job_queue.py list [queued|running|done|dead] [limit]
+    python job_queue.py show JOB_ID
+    python job_queue.py requeue JOB_ID [JOB_ID ...]
+    python job_queue.py requeue-dead
+    python job_queue.py requeue-stuck
+    python job_queue.py purge [days]
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', 'jobs.db')
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 120))
+BACKOFF_BASE = float(os.environ.get('JOB_BACKOFF_BASE', 2))
+BACKOFF_MAX = float(os.environ.get('JOB_BACKOFF_MAX', 300))
+
+STATUSES = ('queued', 'running', 'done', 'dead')
+
+
+class JobQueue:
+    """Persistent job queue with leases, retries and dead-lettering."""
+
+    def __init__(self, path=QUEUE_PATH, max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    stage TEXT NOT NULL,
+                    key TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    available_at REAL NOT NULL,
+                    lease_until REAL,
+                    lease_token TEXT,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'lease_token' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN lease_token TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)')
+            # Stage-filtered claims (interactive stages before imports) skip the import backlog
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage, status, available_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _to_job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        if job['result'] is not None:
+            job['result'] = json.loads(job['result'])
+        return job
+
+    def _insert(self, conn, stage, payload, key=None, max_attempts=None, delay=0):
+        now = time.time()
+        cursor = conn.execute(
+            'INSERT INTO jobs (stage, key, payload, max_attempts, available_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (stage, key, json.dumps(payload), max_attempts or self.max_attempts, now + delay, now, now)
+        )
+        return cursor.lastrowid
+
+    def enqueue(self, stage, payload, key=None, max_attempts=None, delay=0):
+        """
+        Add a job to the queue.
+
+        Args:
+            stage (str): Job type, e.g. 'parse' or 'render'
+            payload (dict): JSON-serialisable job data
+            key (str, optional): Ordering key; jobs with the same key run one at a time
+            max_attempts (int, optional): Attempts before dead-lettering
+            delay (float, optional): Seconds before the job becomes available
+
+        Returns:
+            int: Job id
+        """
+        with self._transaction() as conn:
+            return self._insert(conn, stage, payload, key, max_attempts, delay)
+
+    def enqueue_many(self, stage, payloads, key=None):
+        """
+        Add several jobs of one stage in a single transaction.
+
+        Returns:
+            list: Job ids, in payload order
+        """
+        with self._transaction() as conn:
+            return [self._insert(conn, stage, payload, key) for payload in payloads]
+
+    def coalesce(self, stage, payload, key, merge, delay, max_delay=None):
+        """
+        Merge a payload into the key's pending job, or enqueue a new one.
+
+        If the newest job for the key is a not-yet-attempted job of the same
+        stage, merge(existing_payload, payload) replaces its payload and its
+        start is pushed back to now + delay (capped at max_delay after the
+        job was created). Otherwise, or if merge returns None, a new job is
+        enqueued with the given delay.
+
+        Returns:
+            tuple: (job_id, merged)
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT id, stage, status, attempts, payload, created_at FROM jobs WHERE key = ? '
+                'ORDER BY id DESC LIMIT 1',
+                (key,)
+            ).fetchone()
+            if row is not None and row['stage'] == stage and row['status'] == 'queued' and row['attempts'] == 0:
+                merged = merge(json.loads(row['payload']), payload)
+                if merged is not None:
+                    available_at = now + delay
+                    if max_delay is not None:
+                        available_at = min(available_at, row['created_at'] + max_delay)
+                    conn.execute(
+                        'UPDATE jobs SET payload = ?, available_at = ?, updated_at = ? WHERE id = ?',
+                        (json.dumps(merged), available_at, now, row['id'])
+                    )
+                    return row['id'], True
+            return self._insert(conn, stage, payload, key, delay=delay), False
+
+    def claim(self, stages=None, lease_seconds=LEASE_SECONDS):
+        """
+        Lease the next runnable job.
+
+        A job is runnable when it is queued and due, or running with an
+        expired lease (its worker crashed), and no earlier unfinished job
+        has the same key.
+
+        Args:
+            stages (list, optional): Only claim jobs of these stages
+            lease_seconds (float): Visibility timeout for the claimed job
+
+        Returns:
+            dict: Claimed job, or None if nothing is runnable; job['lease_token']
+                must be passed to extend(), complete() and fail()
+        """
+        now = time.time()
+        stage_filter = ''
+        params = [now, now]
+        if stages:
+            stage_filter = f"AND j.stage IN ({','.join('?' * len(stages))})"
+            params.extend(stages)
+
+        with self._transaction() as conn:
+            # Expired leases that have used up their attempts go to the dead-letter state
+            conn.execute(
+                "UPDATE jobs SET status = 'dead', last_error = COALESCE(last_error, 'lease expired'), "
+                "updated_at = ? WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                (now, now)
+            )
+            row = conn.execute(
+                f"""
+                SELECT j.* FROM jobs j
+                WHERE ((j.status = 'queued' AND j.available_at <= ?)
+                       OR (j.status = 'running' AND j.lease_until < ?))
+                  {stage_filter}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM jobs k
+                      WHERE j.key IS NOT NULL AND k.key = j.key AND k.id < j.id
+                        AND k.status IN ('queued', 'running')
+                  )
+                ORDER BY j.id
+                LIMIT 1
+                """,
+                params
+            ).fetchone()
+            if row is None:
+                return None
+
+            token = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, lease_token = ?, "
+                "updated_at = ? WHERE id = ?",
+                (now + lease_seconds, token, now, row['id'])
+            )
+            job = self._to_job(row)
+            job['status'] = 'running'
+            job['attempts'] += 1
+            job['lease_token'] = token
+            return job
+
+    def extend(self, job_id, lease_token, lease_seconds=LEASE_SECONDS):
+        """
+        Extend the lease of a running job (heartbeat for long work).
+
+        Returns:
+            bool: False if the lease was lost, e.g. the job was reclaimed
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND lease_token = ?",
+                (now + lease_seconds, now, job_id, lease_token)
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, job_id, lease_token, result=None, next_jobs=()):
+        """
+        Mark a job done and atomically enqueue its follow-up stages.
+
+        Args:
+            job_id (int): Job id
+            lease_token (str): Token from claim()
+            result (optional): JSON-serialisable result to keep for inspection
+            next_jobs (iterable): (stage, payload, key) tuples to enqueue in
+                the same transaction, so a checkpointed result is never lost
+
+        Returns:
+            list: Ids of the follow-up jobs, or None if the lease was lost and
+                nothing was recorded
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, lease_until = NULL, lease_token = NULL, "
+                "updated_at = ? WHERE id = ? AND status = 'running' AND lease_token = ?",
+                (json.dumps(result), time.time(), job_id, lease_token)
+            )
+            if cursor.rowcount == 0:
+                return None
+            return [self._insert(conn, stage, payload, key) for stage, payload, key in next_jobs]
+
+    def fail(self, job_id, lease_token, error):
+        """
+        Record a failed attempt; retry with backoff or dead-letter the job.
+
+        Returns:
+            str: New status, 'queued' or 'dead', or None if the lease was lost
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND status = 'running' AND lease_token = ?",
+                (job_id, lease_token)
+            ).fetchone()
+            if row is None:
+                return None
+            if row['attempts'] >= row['max_attempts']:
+                status, available_at = 'dead', now
+            else:
+                delay = min(self.backoff_base * (2 ** (row['attempts'] - 1)), self.backoff_max)
+                status, available_at = 'queued', now + delay
+            conn.execute(
+                'UPDATE jobs SET status = ?, available_at = ?, lease_until = NULL, lease_token = NULL, '
+                'last_error = ?, updated_at = ? WHERE id = ?',
+                (status, available_at, str(error), now, job_id)
+            )
+            return status
+
+    def requeue(self, job_id):
+        """Put a dead or stuck job back in the queue with a fresh attempt budget."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, lease_until = NULL, "
+                "lease_token = NULL, updated_at = ? WHERE id = ? AND status != 'done'",
+                (time.time(), time.time(), job_id)
+            )
+            return cursor.rowcount > 0
+
+    def get(self, job_id):
+        return self._to_job(self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def list(self, status=None, limit=50):
+        """List jobs, newest first, optionally filtered by status."""
+        if status:
+            rows = self._connect().execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?', (status, limit)
+            )
+        else:
+            rows = self._connect().execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))
+        return [self._to_job(row) for row in rows]
+
+    def stuck(self):
+        """Running jobs whose lease has expired."""
+        rows = self._connect().execute(
+            "SELECT * FROM jobs WHERE status = 'running' AND lease_until < ? ORDER BY id", (time.time(),)
+        )
+        return [self._to_job(row) for row in rows]
+
+    def stats(self):
+        """Job counts by stage and status."""
+        counts = {}
+        for row in self._connect().execute('SELECT stage, status, COUNT(*) AS n FROM jobs GROUP BY stage, status'):
+            counts.setdefault(row['stage'], {})[row['status']] = row['n']
+        return counts
+
+    def purge(self, older_than_seconds=7 * 86400):
+        """Delete finished jobs older than the given age."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status = 'done' AND updated_at < ?",
+                (time.time() - older_than_seconds,)
+            )
+            return cursor.rowcount
+
+
+_queue = None
+
+
+def get_queue():
+    """Return the shared job queue, creating it on first use."""
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+def _print_job(job, verbose=False):
+    age = time.time() - job['created_at']
+    print(f"#{job['id']:<6} {job['stage']:<8} {job['status']:<8} attempts={job['attempts']}/{job['max_attempts']} "
+          f"key={job['key']} age={age:.0f}s")
+    if job['last_error']:
+        print(f"        last error: {job['last_error']}")
+    if verbose:
+        print(json.dumps({'payload': job['payload'], 'result': job['result']}, indent=2, ensure_ascii=False))
+
+
+def main(argv):
+    queue = get_queue()
+    command = argv[0] if argv else 'stats'
+
+    if command == 'stats':
+        stats = queue.stats()
+        if not stats:
+            print("Queue is empty")
+        for stage, counts in sorted(stats.items()):
+            print(f"{stage:<8} " + '  '.join(f"{status}={counts.get(status, 0)}" for status in STATUSES))
+    elif command == 'list':
+        status = argv[1] if len(argv) > 1 else None
+        limit = int(argv[2]) if len(argv) > 2 else 50
+        for job in queue.list(status, limit):
+            _print_job(job)
+    elif command == 'show' and len(argv) > 1:
+        job = queue.get(int(argv[1]))
+        if not job:
+            print(f"Job {argv[1]} not found")
+            return 1
+        _print_job(job, verbose=True)
+    elif command == 'requeue' and len(argv) > 1:
+        for job_id in argv[1:]:
+            print(f"#{job_id}: {'requeued' if queue.requeue(int(job_id)) else 'not found or already done'}")
+    elif command in ('requeue-dead', 'requeue-stuck'):
+        jobs = queue.list('dead', limit=1_000_000) if command == 'requeue-dead' else queue.stuck()
+        for job in jobs:
+            queue.requeue(job['id'])
+        print(f"Requeued {len(jobs)} jobs")
+    elif command == 'purge':
+        days = float(argv[1]) if len(argv) > 1 else 7
+        print(f"Deleted {queue.purge(days * 86400)} finished jobs")
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
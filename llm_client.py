@@ -0,0 +1,400 @@
+"""
+LLM client layer for order extraction.
+
+parse_order talks to an OrderExtractor instead of a module-global Gemini
+client. Every extractor call goes through the same guards:
+
+    - a process-wide limiter: at most LLM_MAX_CONCURRENCY calls in flight
+      and, optionally, a token bucket of LLM_RATE_PER_MINUTE calls,
+    - a per-call deadline (LLM_TIMEOUT seconds, including time spent
+      waiting for the limiter),
+    - a circuit breaker that fails fast for LLM_BREAKER_RESET seconds after
+      LLM_BREAKER_FAILURES consecutive upstream failures.
+
+Guard failures raise LLMUnavailable or LLMTimeout, so callers can tell
+"the model is busy" apart from "the message could not be understood".
+
+Backends are chosen with LLM_BACKEND: 'gemini' (default) or 'fake', a
+deterministic local extractor for tests and benchmarks.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-3-flash-preview')
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 30))
+MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+RATE_PER_MINUTE = float(os.environ.get('LLM_RATE_PER_MINUTE', 0))  # 0 disables the token bucket
+BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 5))
+BREAKER_RESET = float(os.environ.get('LLM_BREAKER_RESET', 30))
+FAKE_LATENCY = float(os.environ.get('FAKE_LLM_LATENCY', 0))
+# Every Nth fake call takes FAKE_LLM_SLOW_LATENCY seconds instead, to simulate a latency tail
+FAKE_SLOW_EVERY = int(os.environ.get('FAKE_LLM_SLOW_EVERY', 0))
+FAKE_SLOW_LATENCY = float(os.environ.get('FAKE_LLM_SLOW_LATENCY', 10))
+
+
+class LLMError(Exception):
+    """Base class for extractor failures."""
+
+
+class LLMUnavailable(LLMError):
+    """The model cannot be called right now (circuit open, quota or local limit)."""
+
+
+class LLMTimeout(LLMError):
+    """The call did not finish before its deadline."""
+
+
+@dataclass
+class ExtractionRequest:
+    input_type: str  # 'image', 'audio' or 'text'
+    system_prompt: str
+    instruction: str
+    text: str = None
+    media: bytes = None
+    mime_type: str = None
+    extra_media: list = None  # More (bytes, mime_type) parts sent after media, e.g. further bill pages
+    response_schema: dict = None  # Constrain the output to JSON matching this schema
+
+
+class Limiter:
+    """Semaphore on concurrent calls plus an optional token bucket on call rate."""
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, rate_per_minute=RATE_PER_MINUTE):
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, min(rate_per_minute, max_concurrency)) if rate_per_minute else 0
+        self._tokens = self.capacity
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """
+        Wait for a call slot until the deadline.
+
+        Raises:
+            LLMUnavailable: If no slot is free before the deadline
+        """
+        if self.rate:
+            self._take_token(deadline)
+        if not self._semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise LLMUnavailable(f"Too many model calls in flight (limit {MAX_CONCURRENCY})")
+
+    def release(self):
+        self._semaphore.release()
+
+    def _take_token(self, deadline):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                raise LLMUnavailable(f"Model call rate limit reached ({RATE_PER_MINUTE:.0f}/min)")
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the upstream is unhealthy.
+
+    Opens after `failures` consecutive upstream failures. After `reset`
+    seconds one trial call is let through (half-open); its outcome closes
+    the breaker or opens it again.
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.state = 'closed'
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raise LLMUnavailable unless a call may go through."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset:
+                self.state = 'half-open'
+                return
+            raise LLMUnavailable("Model temporarily unavailable, failing fast")
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._consecutive = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == 'half-open' or self._consecutive >= self.failures:
+                if self.state != 'open':
+                    print(f"🔌 Circuit breaker open after {self._consecutive} model failures")
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+class OrderExtractor:
+    """
+    Base class for model backends.
+
+    Subclasses implement _generate(request, timeout) and return the raw
+    response text. extract() wraps it with the limiter, deadline and breaker.
+    """
+
+    name = 'base'
+
+    def __init__(self, limiter=None, breaker=None, timeout=LLM_TIMEOUT):
+        self.limiter = limiter or Limiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.seconds_total = 0.0
+
+    def extract(self, request, timeout=None):
+        """
+        Run one extraction.
+
+        Args:
+            request (ExtractionRequest): Prompt and input
+            timeout (float, optional): Deadline in seconds, defaults to LLM_TIMEOUT
+
+        Returns:
+            str: Raw model response text
+
+        Raises:
+            LLMUnavailable: Circuit open, quota exhausted or no call slot in time
+            LLMTimeout: The call exceeded its deadline
+            LLMError: Any other upstream failure
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        try:
+            self.limiter.acquire(deadline)
+        except LLMUnavailable:
+            with self._lock:
+                self.rejected += 1
+            raise
+        try:
+            self.breaker.allow()
+        except LLMUnavailable:
+            self.limiter.release()
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        started = time.perf_counter()
+        try:
+            text = self._generate(request, max(0.1, deadline - time.monotonic()))
+        except Exception as e:
+            error = self._classify(e)
+            if isinstance(error, (LLMUnavailable, LLMTimeout)):
+                self.breaker.record_failure()
+            else:
+                # The upstream answered, it just rejected this request
+                self.breaker.record_success()
+            with self._lock:
+                self.failures += 1
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            self.limiter.release()
+            with self._lock:
+                self.calls += 1
+                self.seconds_total += time.perf_counter() - started
+
+        self.breaker.record_success()
+        return text
+
+    def _generate(self, request, timeout):
+        raise NotImplementedError
+
+    def _classify(self, error):
+        """
+        Map a backend exception to an LLMError (or return it unchanged).
+
+        Only LLMUnavailable and LLMTimeout count towards the circuit breaker.
+        """
+        return error
+
+    def stats(self):
+        """
+        Call metrics.
+
+        Returns:
+            dict: backend, calls, failures, rejected, avg_seconds, breaker state
+        """
+        with self._lock:
+            return {
+                'backend': self.name,
+                'calls': self.calls,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'avg_seconds': round(self.seconds_total / self.calls, 3) if self.calls else 0.0,
+                'breaker': self.breaker.state,
+            }
+
+
+class GeminiExtractor(OrderExtractor):
+    """Order extraction with Google Gemini through the google.genai API."""
+
+    name = 'gemini'
+
+    def __init__(self, api_key=None, model=GEMINI_MODEL, **kwargs):
+        super().__init__(**kwargs)
+        import google.genai as genai
+        from google.genai import types
+
+        self._types = types
+        self.model = model
+        self.client = genai.Client(api_key=api_key or os.environ.get('GOOGLE_API_KEY'))
+
+    def _generate(self, request, timeout):
+        types = self._types
+        contents = [request.system_prompt]
+        if request.media is not None:
+            contents.append(types.Part.from_bytes(data=request.media, mime_type=request.mime_type))
+        for data, mime_type in request.extra_media or ():
+            contents.append(types.Part.from_bytes(data=data, mime_type=mime_type))
+        contents.append(request.instruction)
+
+        config = {'http_options': types.HttpOptions(timeout=int(timeout * 1000))}
+        if request.response_schema is not None:
+            config['response_mime_type'] = 'application/json'
+            config['response_schema'] = request.response_schema
+
+        result = self.client.models.generate_content(
+            model=self.model,
+            contents=contents,
+            config=types.GenerateContentConfig(**config)
+        )
+        return result.text
+
+    def _classify(self, error):
+        import httpx
+        from google.genai import errors
+
+        if isinstance(error, httpx.TimeoutException):
+            return LLMTimeout(f"Gemini did not answer in time: {str(error)}")
+        if isinstance(error, errors.APIError) and (error.code == 429 or error.code >= 500):
+            return LLMUnavailable(f"Gemini unavailable ({error.code}): {error.message}")
+        if isinstance(error, httpx.TransportError):
+            return LLMUnavailable(f"Could not reach Gemini: {str(error)}")
+        if isinstance(error, errors.APIError):
+            return LLMError(f"Gemini rejected the request ({error.code}): {error.message}")
+        return error
+
+
+class FakeExtractor(OrderExtractor):
+    """
+    Deterministic local extractor for tests and benchmarks.
+
+    Text is parsed with fast_parser (whatever its confidence); media gets a
+    fixed order derived from a hash of its bytes, with one item per media
+    part. FAKE_LLM_LATENCY adds a simulated round trip, slow_every=N makes
+    every Nth call take slow_latency seconds, and fail_every=N makes every
+    Nth call fail with LLMUnavailable to exercise retries and the circuit
+    breaker.
+    """
+
+    name = 'fake'
+
+    def __init__(self, latency=FAKE_LATENCY, fail_every=0, slow_every=FAKE_SLOW_EVERY,
+                 slow_latency=FAKE_SLOW_LATENCY, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.slow_every = slow_every
+        self.slow_latency = slow_latency
+        self._count = 0
+
+    def _generate(self, request, timeout):
+        with self._lock:
+            self._count += 1
+            count = self._count
+        latency = self.slow_latency if self.slow_every and count % self.slow_every == 0 else self.latency
+        if latency:
+            time.sleep(min(latency, timeout))
+            if latency > timeout:
+                raise LLMTimeout(f"Fake model exceeded {timeout:.1f}s deadline")
+        if self.fail_every and count % self.fail_every == 0:
+            raise LLMUnavailable("Fake model failure")
+
+        if request.media is not None:
+            # One item per page, as the model merges multi-page bills into one order
+            pages = [request.media] + [data for data, _ in request.extra_media or ()]
+            digests = [hashlib.sha1(page).digest() for page in pages]
+            data = {
+                'customer': f"Customer {digests[0][0] % 100}",
+                'items': [{'name': 'Rice' if page == 1 else f'Item {page}', 'qty': digest[1] % 20 + 1, 'rate': 50}
+                          for page, digest in enumerate(digests, start=1)]
+            }
+            return json.dumps({'status': 'complete', 'data': data, 'missing_fields': []})
+
+        from fast_parser import parse_text_order
+
+        result, _ = parse_text_order(request.text or '')
+        if result is None:
+            result = {'status': 'incomplete', 'data': {'customer': None, 'items': []}, 'missing_fields': ['items']}
+        return json.dumps(result)
+
+
+EXTRACTORS = {
+    'gemini': GeminiExtractor,
+    'fake': FakeExtractor,
+}
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+
+def create_extractor(name=None):
+    """
+    Create an extractor by name.
+
+    With LLM_HEDGE=1 the extractor is wrapped in a HedgedExtractor that
+    races slow calls against a fallback model (see hedging.py).
+
+    Args:
+        name (str, optional): 'gemini' or 'fake', defaults to $LLM_BACKEND
+
+    Raises:
+        ValueError: For an unknown backend name
+    """
+    name = (name or os.environ.get('LLM_BACKEND', 'gemini')).lower()
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown LLM backend '{name}', expected one of: {', '.join(EXTRACTORS)}")
+    extractor = EXTRACTORS[name]()
+
+    import hedging
+    if hedging.HEDGE_ENABLED:
+        return hedging.create_hedged_extractor(name, extractor)
+    return extractor
+
+
+def get_extractor():
+    """Return the shared extractor, creating it on first use."""
+    global _extractor
+    if _extractor is None:
+        with _extractor_lock:
+            if _extractor is None:
+                _extractor = create_extractor()
+    return _extractor
+
+
+def set_extractor(extractor):
+    """Replace the shared extractor (e.g. with a FakeExtractor in tests)."""
+    global _extractor
+    _extractor = extractor
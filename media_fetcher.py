@@ -0,0 +1,180 @@
+"""
+Media downloads for Twilio attachments.
+
+A single requests.Session with a keep-alive connection pool is shared by
+all downloads. Each download uses connect/read timeouts, streams the body
+into memory with a size cap, and records timing and byte-count metrics.
+The bytes are handed straight to Gemini, so nothing touches the disk.
+
+The attachments of a multi-media message are downloaded concurrently
+(fetch_many), so a three-page bill takes about as long as one page.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = float(os.environ.get('MEDIA_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('MEDIA_READ_TIMEOUT', 20))
+MAX_MEDIA_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', 16 * 1024 * 1024))
+POOL_SIZE = int(os.environ.get('MEDIA_POOL_SIZE', 16))
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLarge(Exception):
+    """Raised when an attachment exceeds MEDIA_MAX_BYTES."""
+
+
+@dataclass
+class MediaDownload:
+    data: bytes
+    content_type: str
+    seconds: float
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+class MediaFetcher:
+    """Download media over a shared, pooled HTTP session."""
+
+    def __init__(self, auth=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_bytes=MAX_MEDIA_BYTES, pool_size=POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        retry = Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='billbot-media')
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=200)  # (seconds, bytes) of recent downloads
+        self.downloads = 0
+        self.errors = 0
+        self.bytes_total = 0
+        self.seconds_total = 0.0
+
+    def fetch(self, url):
+        """
+        Download a media URL into memory.
+
+        Args:
+            url (str): Media URL (Twilio redirects to its CDN)
+
+        Returns:
+            MediaDownload: Bytes, content type and download time
+
+        Raises:
+            MediaTooLarge: If the body exceeds max_bytes
+            requests.RequestException: On HTTP or network errors
+        """
+        started = time.perf_counter()
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                print(f"Media Download Status: {response.status_code}")
+                response.raise_for_status()
+
+                declared = int(response.headers.get('Content-Length') or 0)
+                if declared > self.max_bytes:
+                    raise MediaTooLarge(f"Media is {declared} bytes, limit is {self.max_bytes}")
+
+                buffer = bytearray()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    buffer.extend(chunk)
+                    if len(buffer) > self.max_bytes:
+                        raise MediaTooLarge(f"Media exceeds {self.max_bytes} bytes")
+
+                content_type = response.headers.get('Content-Type', '')
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+
+        download = MediaDownload(bytes(buffer), content_type, time.perf_counter() - started)
+        with self._lock:
+            self.downloads += 1
+            self.bytes_total += download.size
+            self.seconds_total += download.seconds
+            self._recent.append((download.seconds, download.size))
+        print(f"📥 Downloaded {download.size} bytes in {download.seconds * 1000:.0f}ms")
+        return download
+
+    def fetch_many(self, urls):
+        """
+        Download several media URLs concurrently over the shared pool.
+
+        Args:
+            urls (list): Media URLs
+
+        Returns:
+            list: MediaDownload per URL, in the same order
+
+        Raises:
+            MediaTooLarge, requests.RequestException: The first failed download's
+                error, once all downloads have finished
+        """
+        if len(urls) == 1:
+            return [self.fetch(urls[0])]
+        futures = [self._executor.submit(self.fetch, url) for url in urls]
+        for future in futures:
+            future.exception()  # wait for every download before raising
+        return [future.result() for future in futures]
+
+    def stats(self):
+        """
+        Download metrics.
+
+        Returns:
+            dict: pool_size, downloads, errors, bytes_total, avg_seconds,
+                p95_seconds, avg_bytes over the recent window
+        """
+        with self._lock:
+            recent = list(self._recent)
+            stats = {
+                'pool_size': self.pool_size,
+                'downloads': self.downloads,
+                'errors': self.errors,
+                'bytes_total': self.bytes_total,
+                'seconds_total': round(self.seconds_total, 3),
+            }
+        if recent:
+            durations = sorted(seconds for seconds, _ in recent)
+            stats['avg_seconds'] = round(sum(durations) / len(durations), 4)
+            stats['p95_seconds'] = round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 4)
+            stats['avg_bytes'] = sum(size for _, size in recent) // len(recent)
+        return stats
+
+
+_fetcher = None
+
+
+def get_fetcher():
+    """Return the shared fetcher, authenticated with the Twilio credentials."""
+    global _fetcher
+    if _fetcher is None:
+        account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
+        auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+        _fetcher = MediaFetcher(auth=(account_sid, auth_token) if account_sid else None)
+    return _fetcher
+
+
+def fetch_media(url):
+    """Download a media URL with the shared fetcher. See MediaFetcher.fetch."""
+    return get_fetcher().fetch(url)
+
+
+def fetch_many_media(urls):
+    """Download several media URLs concurrently with the shared fetcher. See MediaFetcher.fetch_many."""
+    return get_fetcher().fetch_many(urls)
@@ -0,0 +1,79 @@
+"""
+Debounce bursts of WhatsApp messages into one extraction.
+
+Merchants often send an order as several quick messages: the customer
+name, then items one per line, sometimes a photo. In async webhook mode
+each message is merged into the sender's pending 'parse' job instead of
+starting its own, and the job only becomes runnable once no new message
+has arrived for MESSAGE_COALESCE_WINDOW seconds (or MESSAGE_COALESCE_MAX_WAIT
+seconds after the first one). The combined text, plus the attachments, is
+extracted in a single model call and answered with one reply.
+
+WhatsApp delivers several photos sent together as separate messages, so
+photos of a burst are collected as pages of one bill (up to
+MESSAGE_COALESCE_MAX_PAGES).
+
+The pending job lives in the durable job queue, so bursts are coalesced
+across worker processes and survive restarts.
+"""
+import os
+
+COALESCE_WINDOW = float(os.environ.get('MESSAGE_COALESCE_WINDOW', 4))
+COALESCE_MAX_WAIT = float(os.environ.get('MESSAGE_COALESCE_MAX_WAIT', 20))
+# Twilio delivers at most 10 attachments per message
+MAX_PAGES = int(os.environ.get('MESSAGE_COALESCE_MAX_PAGES', 10))
+
+
+def _is_image(content_type):
+    return 'image' in (content_type or '').lower()
+
+
+def merge_messages(existing, new):
+    """
+    Merge a new message payload into a pending parse payload.
+
+    Texts are joined line by line in arrival order. Photos are appended as
+    further pages of the pending photo; a voice note, or a photo that would
+    exceed MAX_PAGES, starts a new job.
+
+    Returns:
+        dict: Merged payload, or None if the message must not be merged
+    """
+    merged = dict(existing)
+    if new.get('media_url') and existing.get('media_url'):
+        if not (_is_image(existing.get('media_content_type')) and _is_image(new.get('media_content_type'))):
+            return None
+        pages = list(existing.get('extra_media') or [])
+        pages.append((new['media_url'], new.get('media_content_type', '')))
+        pages.extend(new.get('extra_media') or [])
+        if len(pages) + 1 > MAX_PAGES:
+            return None
+        merged['extra_media'] = pages
+    elif new.get('media_url'):
+        merged['media_url'] = new['media_url']
+        merged['media_content_type'] = new.get('media_content_type', '')
+        merged['extra_media'] = list(new.get('extra_media') or [])
+
+    merged['incoming_msg'] = '\n'.join(
+        text for text in (existing.get('incoming_msg'), new.get('incoming_msg')) if text
+    )
+    merged['message_count'] = existing.get('message_count', 1) + 1
+    return merged
+
+
+def enqueue_message(queue, payload, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT):
+    """
+    Queue a message for parsing, coalescing it with the sender's burst.
+
+    Args:
+        queue (JobQueue): Job queue
+        payload (dict): 'parse' job payload with 'sender'
+        window (float): Debounce window in seconds; 0 disables coalescing
+
+    Returns:
+        tuple: (job_id, merged) where merged is True if the message joined
+            an existing pending job
+    """
+    if window <= 0:
+        return queue.enqueue('parse', payload, key=payload['sender']), False
+    return queue.coalesce('parse', payload, payload['sender'], merge_messages, window, max_wait)
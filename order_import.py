@@ -0,0 +1,452 @@
+"""
+Bulk order import from CSV or JSONL.
+
+Merchants who keep orders in spreadsheets upload them in one go instead of
+pasting them into WhatsApp one at a time. The upload is parsed as a
+stream, row by row; each order is checked with the same coercions and
+completeness rules as parse_order (order_validation.decode_order) without
+calling the model, and complete orders are queued in batches as
+'import_render' jobs on the durable job queue. Only the current order and
+one batch are held in memory, so a 100k-row upload uses as little memory
+as a 10-row one.
+
+Progress is tracked per import in SQLite (IMPORT_PATH): rows read, orders
+queued and rejected (with the first IMPORT_MAX_ERRORS reasons), and
+invoices rendered or failed. The invoice number issued for each row is
+recorded too, so a retried render job never issues a second invoice.
+
+CSV has one row per item; consecutive rows with the same order_id (or,
+without that column, the same customer) form one order, and a row with a
+blank order_id/customer continues the previous order:
+
+    order_id,customer,item,qty,rate
+    A-1,Ramesh Kirana,Rice,10,50
+    A-1,,Oil,5,120
+
+JSONL has one order per line: {"order_id": "A-1", "customer": "...", "items": [...]}
+
+HTTP (see app.py), with 'Authorization: Bearer $IMPORT_API_TOKEN':
+    POST /import?phone=whatsapp:+91...&format=csv   (raw file as the request body)
+    GET  /import/<import_id>
+
+CLI (queues into the local job queue):
+    python order_import.py upload orders.csv --phone=whatsapp:+91... [--format=csv|jsonl]
+    python order_import.py status IMPORT_ID
+"""
+import csv
+import functools
+import hmac
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import jsonify, request
+
+from job_queue import get_queue
+from order_validation import OrderDecodeError, decode_order
+
+IMPORT_API_TOKEN = os.environ.get('IMPORT_API_TOKEN', '')
+IMPORT_PATH = os.environ.get('IMPORT_PATH', 'imports.db')
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+# Rejection reasons kept per import; the rest are only counted
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 50))
+
+RENDER_STAGE = 'import_render'
+
+# Accepted CSV headers for each field
+CSV_COLUMNS = {
+    'order_id': ('order_id', 'order', 'invoice', 'id'),
+    'customer': ('customer', 'customer_name', 'party'),
+    'name': ('item', 'name', 'item_name', 'product'),
+    'qty': ('qty', 'quantity'),
+    'rate': ('rate', 'price', 'unit_price'),
+}
+
+
+class ImportStore:
+    """SQLite-backed progress of order imports."""
+
+    def __init__(self, path=IMPORT_PATH, max_errors=IMPORT_MAX_ERRORS):
+        self.path = path
+        self.max_errors = max_errors
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS imports (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phone TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    uploading INTEGER NOT NULL DEFAULT 1,
+                    upload_error TEXT,
+                    rows INTEGER NOT NULL DEFAULT 0,
+                    queued INTEGER NOT NULL DEFAULT 0,
+                    rejected INTEGER NOT NULL DEFAULT 0,
+                    rendered INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    errors TEXT NOT NULL DEFAULT '[]',
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS import_invoices (
+                    import_id INTEGER NOT NULL,
+                    row INTEGER NOT NULL,
+                    invoice_number TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    PRIMARY KEY (import_id, row)
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def create(self, phone, fmt):
+        """Start tracking a new import. Returns its id."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO imports (phone, format, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                (phone, fmt, now, now)
+            )
+            return cursor.lastrowid
+
+    def _add_errors(self, conn, import_id, errors):
+        row = conn.execute('SELECT errors FROM imports WHERE id = ?', (import_id,)).fetchone()
+        kept = json.loads(row['errors'])
+        if len(kept) < self.max_errors:
+            kept.extend(errors[:self.max_errors - len(kept)])
+            conn.execute('UPDATE imports SET errors = ? WHERE id = ?', (json.dumps(kept), import_id))
+
+    def add_progress(self, import_id, rows=0, queued=0, rejected=0, errors=()):
+        """Add counts for a parsed batch of the upload."""
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE imports SET rows = rows + ?, queued = queued + ?, rejected = rejected + ?, '
+                'updated_at = ? WHERE id = ?',
+                (rows, queued, rejected, time.time(), import_id)
+            )
+            if errors:
+                self._add_errors(conn, import_id, list(errors))
+
+    def finish_upload(self, import_id, error=None):
+        """Mark the upload as fully read, or as aborted with an error."""
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE imports SET uploading = 0, upload_error = ?, updated_at = ? WHERE id = ?',
+                (error, time.time(), import_id)
+            )
+
+    def record_render(self, import_id, ok, error=None):
+        """Count one queued order as rendered or failed."""
+        column = 'rendered' if ok else 'failed'
+        with self._transaction() as conn:
+            conn.execute(
+                f'UPDATE imports SET {column} = {column} + 1, updated_at = ? WHERE id = ?',
+                (time.time(), import_id)
+            )
+            if error:
+                self._add_errors(conn, import_id, [error])
+
+    def record_invoice(self, import_id, row, invoice_number, filename):
+        """
+        Record the invoice issued for an imported row and count it as rendered.
+
+        Returns:
+            bool: False if the row already had an invoice (nothing is counted)
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO import_invoices (import_id, row, invoice_number, filename) VALUES (?, ?, ?, ?)',
+                (import_id, row, invoice_number, filename)
+            )
+            if cursor.rowcount == 0:
+                return False
+            conn.execute(
+                'UPDATE imports SET rendered = rendered + 1, updated_at = ? WHERE id = ?',
+                (time.time(), import_id)
+            )
+            return True
+
+    def invoice_for(self, import_id, row):
+        """Invoice number and file name issued for an imported row, or None."""
+        found = self._connect().execute(
+            'SELECT invoice_number, filename FROM import_invoices WHERE import_id = ? AND row = ?', (import_id, row)
+        ).fetchone()
+        return dict(found) if found else None
+
+    def get(self, import_id):
+        """
+        Progress of an import.
+
+        Returns:
+            dict: Counts, kept errors, 'progress' (share of queued orders
+                finished) and 'status': 'uploading', 'rendering', 'done' or
+                'aborted'; None if the import does not exist
+        """
+        row = self._connect().execute('SELECT * FROM imports WHERE id = ?', (import_id,)).fetchone()
+        if row is None:
+            return None
+        progress = dict(row)
+        progress['errors'] = json.loads(progress['errors'])
+        finished = progress['rendered'] + progress['failed']
+        if progress.pop('uploading'):
+            status = 'uploading'
+        elif progress['upload_error']:
+            status = 'aborted'
+        elif finished < progress['queued']:
+            status = 'rendering'
+        else:
+            status = 'done'
+        progress['status'] = status
+        progress['progress'] = round(finished / progress['queued'], 4) if progress['queued'] else 1.0
+        return progress
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the shared import store, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ImportStore()
+    return _store
+
+
+def set_store(store):
+    """Replace the shared import store (e.g. a temporary file in tests)."""
+    global _store
+    _store = store
+
+
+def _csv_field_map(header):
+    """Map each field to the index of its column in a CSV header."""
+    normalized = [re.sub(r'[\s\-]+', '_', (column or '').strip().lower()) for column in header]
+    fields = {}
+    for field_name, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in normalized:
+                fields[field_name] = normalized.index(alias)
+                break
+    missing = [field_name for field_name in ('customer', 'name', 'qty', 'rate') if field_name not in fields]
+    if missing:
+        raise ValueError(f"CSV header is missing column(s): {', '.join(missing)}")
+    return fields
+
+
+def iter_csv_orders(lines):
+    """
+    Yield (row_number, order_data) from CSV lines, grouping item rows into orders.
+
+    row_number is the CSV line of the order's first row.
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    fields = _csv_field_map(header)
+
+    def cell(row, field_name):
+        idx = fields.get(field_name)
+        return row[idx].strip() if idx is not None and idx < len(row) else ''
+
+    current, current_key, start = None, None, None
+    for row_number, row in enumerate(reader, start=2):
+        if not any(value.strip() for value in row):
+            continue
+        key = cell(row, 'order_id') if 'order_id' in fields else cell(row, 'customer')
+        if current is None or (key and key != current_key):
+            if current is not None:
+                yield start, current
+            current = {'order_id': cell(row, 'order_id') or None, 'customer': cell(row, 'customer'), 'items': []}
+            current_key, start = key, row_number
+        current['items'].append({'name': cell(row, 'name'), 'qty': cell(row, 'qty'), 'rate': cell(row, 'rate')})
+    if current is not None:
+        yield start, current
+
+
+def iter_jsonl_orders(lines):
+    """Yield (line_number, order_data) from JSONL lines; bad lines yield an OrderDecodeError."""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, OrderDecodeError(f"invalid JSON: {str(e)}")
+
+
+def detect_format(filename=None, content_type=None):
+    """Guess 'csv' or 'jsonl' from a filename or content type; defaults to csv."""
+    hint = f"{filename or ''} {content_type or ''}".lower()
+    return 'jsonl' if any(marker in hint for marker in ('jsonl', 'ndjson', 'json')) else 'csv'
+
+
+def import_orders(lines, phone, fmt='csv', queue=None, store=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Stream orders from an upload into the render queue.
+
+    Args:
+        lines (iterable): Text lines of the upload (a text stream works)
+        phone (str): Merchant whose company details the invoices use
+        fmt (str): 'csv' or 'jsonl'
+        queue (JobQueue, optional): Defaults to the shared queue
+        store (ImportStore, optional): Defaults to the shared import store
+        batch_size (int): Orders queued per transaction
+
+    Returns:
+        dict: The import's progress (see ImportStore.get), including its id
+    """
+    queue = queue or get_queue()
+    store = store or get_store()
+    import_id = store.create(phone, fmt)
+    orders = iter_jsonl_orders(lines) if fmt == 'jsonl' else iter_csv_orders(lines)
+
+    batch, errors, rows, rejected = [], [], 0, 0
+
+    def flush():
+        nonlocal batch, errors, rows, rejected
+        if batch:
+            queue.enqueue_many(RENDER_STAGE, batch)
+        store.add_progress(import_id, rows, len(batch), rejected, errors)
+        batch, errors, rows, rejected = [], [], 0, 0
+
+    try:
+        for row_number, data in orders:
+            rows += 1
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                order = decode_order(data)
+                missing = order.missing_fields()
+                if missing:
+                    # A zero quantity or negative rate is dropped by the decoder and shows up as missing
+                    invalid = any(repair.endswith('_invalid') for repair in order.repairs)
+                    raise OrderDecodeError(f"{'missing or invalid' if invalid else 'missing'} {', '.join(missing)}")
+            except OrderDecodeError as e:
+                rejected += 1
+                errors.append(f"row {row_number}: {str(e)}")
+            else:
+                batch.append({
+                    'import_id': import_id,
+                    'phone': phone,
+                    'row': row_number,
+                    'order_id': data.get('order_id'),
+                    'order_data': order.to_dict()
+                })
+            if len(batch) + rejected >= batch_size:
+                flush()
+        flush()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        flush()
+        store.finish_upload(import_id, error=str(e))
+        print(f"❌ Import #{import_id} aborted: {str(e)}")
+        return store.get(import_id)
+
+    store.finish_upload(import_id)
+    progress = store.get(import_id)
+    print(f"📥 Import #{import_id}: {progress['queued']} orders queued, {progress['rejected']} rejected")
+    return progress
+
+
+def handle_import_job(payload, job):
+    """Queue stage 'import_render': render one imported order with the merchant's details."""
+    from db_manager import get_user
+    from invoice_numbers import issue_invoice
+
+    store = get_store()
+    import_id, row = payload['import_id'], payload['row']
+    if store.invoice_for(import_id, row) is not None:
+        print(f"⏭️ Import #{import_id} row {row} already has an invoice")
+        return
+
+    order_data = payload['order_data']
+    company_details = (get_user(payload['phone']) or {}).get('company_details')
+    # The reference makes a retry after a lost lease or failed progress write reuse the issued invoice
+    invoice_number, filename = issue_invoice(
+        payload['phone'], order_data, company_details, reference=f"import-{import_id}-{row}"
+    )
+    store.record_invoice(import_id, row, invoice_number, filename)
+
+
+def record_import_failure(job, error):
+    """Count an imported order whose rendering exhausted its retries."""
+    payload = job['payload']
+    get_store().record_render(payload['import_id'], ok=False, error=f"row {payload['row']}: {str(error)}")
+
+
+def require_import_token(view):
+    """Flask decorator: require 'Authorization: Bearer $IMPORT_API_TOKEN'."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not IMPORT_API_TOKEN:
+            return jsonify({'error': 'Import API is disabled'}), 404
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode('utf-8'), f"Bearer {IMPORT_API_TOKEN}".encode('utf-8')):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _option(argv, name, default=None):
+    for arg in argv:
+        if arg.startswith(f'--{name}='):
+            return arg.split('=', 1)[1]
+    return default
+
+
+def main(argv):
+    command = argv[0] if argv else None
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+
+    if command == 'upload' and args and _option(argv, 'phone'):
+        fmt = _option(argv, 'format') or detect_format(args[0])
+        with open(args[0], 'r', encoding='utf-8-sig', newline='') as f:
+            progress = import_orders(f, _option(argv, 'phone'), fmt)
+        print(json.dumps(progress, indent=2))
+        return 0 if progress['status'] != 'aborted' else 1
+    if command == 'status' and args:
+        progress = get_store().get(int(args[0]))
+        if progress is None:
+            print(f"Import {args[0]} not found")
+            return 1
+        print(json.dumps(progress, indent=2))
+        return 0
+
+    print(__doc__)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
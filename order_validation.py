@@ -0,0 +1,327 @@
+"""
+Completeness rules, response schema and strict decoder for extracted orders.
+
+Shared by the Gemini path in parse_order, the local fast-path parser and
+anything else that produces {status, data, missing_fields} results, so an
+order is judged complete by the same rules wherever it came from.
+
+Model responses are requested as JSON constrained by ORDER_RESPONSE_SCHEMA
+and decoded by decode_order_response() into a typed Order. Recoverable
+malformations (markdown fences, prose around the JSON, trailing commas,
+numbers written as "₹50" or "10 kg", a bare order without the status
+envelope) are repaired locally instead of asking the user to resend.
+Status and missing_fields are always recomputed from the data, so the
+model's own completeness claims are never trusted. Orders that do not come
+from the model (e.g. spreadsheet imports) go through decode_order() and get
+the same coercions and rules.
+"""
+import json
+import math
+import re
+import threading
+from dataclasses import dataclass, field
+
+# Gemini response_schema (OpenAPI subset) for order extraction
+ORDER_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'status': {'type': 'STRING', 'enum': ['complete', 'incomplete']},
+        'data': {
+            'type': 'OBJECT',
+            'properties': {
+                'customer': {'type': 'STRING', 'nullable': True},
+                'items': {
+                    'type': 'ARRAY',
+                    'items': {
+                        'type': 'OBJECT',
+                        'properties': {
+                            'name': {'type': 'STRING', 'nullable': True},
+                            'qty': {'type': 'NUMBER', 'nullable': True},
+                            'rate': {'type': 'NUMBER', 'nullable': True},
+                        },
+                        'required': ['name', 'qty', 'rate'],
+                    },
+                },
+            },
+            'required': ['customer', 'items'],
+        },
+        'missing_fields': {'type': 'ARRAY', 'items': {'type': 'STRING'}},
+    },
+    'required': ['status', 'data', 'missing_fields'],
+}
+
+# Placeholder customer names models emit instead of null
+EMPTY_NAMES = {'', 'null', 'none', 'unknown', 'n/a', 'na', '-'}
+NUMBER_IN_TEXT = re.compile(r'-?\d+(?:\.\d+)?')
+
+
+class OrderDecodeError(ValueError):
+    """Raised when a model response cannot be turned into an order."""
+
+
+def missing_fields(data):
+    """
+    List what an order still needs before an invoice can be generated.
+
+    Args:
+        data (dict): Order data with 'customer' and 'items'
+
+    Returns:
+        list: Field names in the prompt's format, e.g.
+            ['customer', 'item_1_rate', 'item_2_qty'], or ['items'] when
+            there are no items at all
+    """
+    missing = []
+    if not (data.get('customer') or '').strip():
+        missing.append('customer')
+
+    items = data.get('items') or []
+    if not items:
+        missing.append('items')
+
+    for idx, item in enumerate(items, start=1):
+        if not item.get('name'):
+            missing.append(f'item_{idx}_name')
+        if item.get('qty') is None:
+            missing.append(f'item_{idx}_qty')
+        if item.get('rate') is None:
+            missing.append(f'item_{idx}_rate')
+    return missing
+
+
+def order_result(data):
+    """
+    Build a parse result for order data using the completeness rules.
+
+    Returns:
+        dict: {'status': 'complete' | 'incomplete', 'data': data, 'missing_fields': [...]}
+    """
+    missing = missing_fields(data)
+    return {
+        'status': 'incomplete' if missing else 'complete',
+        'data': data,
+        'missing_fields': missing
+    }
+
+
+@dataclass
+class OrderItem:
+    name: str = None
+    qty: float = None
+    rate: float = None
+
+    def to_dict(self):
+        return {'name': self.name, 'qty': self.qty, 'rate': self.rate}
+
+
+@dataclass
+class Order:
+    customer: str = None
+    items: list = field(default_factory=list)
+    repairs: list = field(default_factory=list)  # Local fixes applied while decoding
+
+    def to_dict(self):
+        return {'customer': self.customer, 'items': [item.to_dict() for item in self.items]}
+
+    def missing_fields(self):
+        return missing_fields(self.to_dict())
+
+    def result(self):
+        """The order as a parse_order() result with recomputed status."""
+        return order_result(self.to_dict())
+
+
+class DecoderStats:
+    """Counters for decoded, repaired and failed model responses."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decoded = 0
+        self.repaired = 0
+        self.failed = 0
+        self.repairs = {}
+
+    def record(self, repairs=None, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+                return
+            self.decoded += 1
+            if repairs:
+                self.repaired += 1
+                for repair in repairs:
+                    self.repairs[repair] = self.repairs.get(repair, 0) + 1
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: decoded, repaired, failed, repair_rate, failure_rate and
+                counts per repair kind
+        """
+        with self._lock:
+            total = self.decoded + self.failed
+            return {
+                'decoded': self.decoded,
+                'repaired': self.repaired,
+                'failed': self.failed,
+                'repair_rate': round(self.repaired / total, 4) if total else 0.0,
+                'failure_rate': round(self.failed / total, 4) if total else 0.0,
+                'repairs': dict(self.repairs),
+            }
+
+
+_stats = DecoderStats()
+
+
+def decoder_stats():
+    """Decoder metrics for this process. See DecoderStats.snapshot."""
+    return _stats.snapshot()
+
+
+def _extract_json(text, repairs):
+    """Return the JSON object text inside a response, noting what was stripped."""
+    stripped = text.strip()
+    if stripped.startswith('```'):
+        repairs.append('code_fence')
+        stripped = re.sub(r'^```[a-zA-Z]*\s*|\s*```\s*$', '', stripped)
+    if not stripped.startswith('{'):
+        start, end = stripped.find('{'), stripped.rfind('}')
+        if start == -1 or end <= start:
+            raise OrderDecodeError("Response contains no JSON object")
+        repairs.append('surrounding_text')
+        stripped = stripped[start:end + 1]
+    return stripped
+
+
+def _loads(text, repairs):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    fixed = re.sub(r',\s*([}\]])', r'\1', text)
+    fixed = fixed.replace('“', '"').replace('”', '"').replace('’', "'")
+    try:
+        value = json.loads(fixed)
+    except ValueError as e:
+        raise OrderDecodeError(f"Response is not valid JSON: {str(e)}")
+    repairs.append('json_syntax')
+    return value
+
+
+def _checked(number, field_name, repairs):
+    """
+    Leave out quantities that are not positive, negative rates and values
+    that are not finite, so the user is asked for them like for any other
+    missing field.
+    """
+    if not math.isfinite(number) or not number >= 0 or (field_name == 'qty' and not number > 0):
+        repairs.append(f'{field_name}_invalid')
+        return None
+    return int(number) if float(number).is_integer() else number
+
+
+def _number(value, field_name, repairs):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return _checked(value, field_name, repairs)
+    if isinstance(value, str):
+        match = NUMBER_IN_TEXT.search(value.replace(',', ''))
+        if match:
+            repairs.append(f'{field_name}_text')
+            return _checked(float(match.group()), field_name, repairs)
+        if value.strip().lower() not in EMPTY_NAMES:
+            # "many", "a few": leave it missing so the user is asked for it
+            repairs.append(f'{field_name}_unreadable')
+        return None
+    raise OrderDecodeError(f"Item {field_name} is not a number: {value!r}")
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return None if value.lower() in EMPTY_NAMES else value
+
+
+def _decode_data(data, repairs):
+    """Build an Order from order data, coercing what is safe."""
+    raw_items = data.get('items') or []
+    if isinstance(raw_items, dict):
+        repairs.append('items_object')
+        raw_items = [raw_items]
+    if not isinstance(raw_items, list):
+        raise OrderDecodeError("Order items are not a list")
+
+    items = []
+    for raw in raw_items:
+        if not isinstance(raw, dict):
+            raise OrderDecodeError(f"Order item is not an object: {raw!r}")
+        item = OrderItem(
+            _text(raw.get('name')),
+            _number(raw.get('qty'), 'qty', repairs),
+            _number(raw.get('rate'), 'rate', repairs)
+        )
+        if item.name is None and item.qty is None and item.rate is None:
+            repairs.append('empty_item')
+            continue
+        items.append(item)
+    return Order(_text(data.get('customer')), items, repairs)
+
+
+def decode_order(data):
+    """
+    Decode order data that did not come from the model into an Order.
+
+    Args:
+        data (dict): {'customer': ..., 'items': [{'name', 'qty', 'rate'}, ...]};
+            numbers may be strings like "₹50" or "10 kg"
+
+    Returns:
+        Order: Typed order; use order.missing_fields() to check completeness
+
+    Raises:
+        OrderDecodeError: If the data cannot be read as an order
+    """
+    if not isinstance(data, dict):
+        raise OrderDecodeError("Order is not an object")
+    return _decode_data(data, [])
+
+
+def decode_order_response(text, record_stats=True):
+    """
+    Strictly decode a model response into an Order, repairing what is safe.
+
+    Args:
+        text (str): Raw model response
+        record_stats (bool): Count the outcome in decoder_stats()
+
+    Returns:
+        Order: Typed order; order.repairs lists the local fixes applied
+
+    Raises:
+        OrderDecodeError: If the response cannot be read as an order
+    """
+    repairs = []
+    try:
+        payload = _loads(_extract_json(text or '', repairs), repairs)
+        if not isinstance(payload, dict):
+            raise OrderDecodeError("Response is not a JSON object")
+
+        data = payload.get('data')
+        if data is None and ('items' in payload or 'customer' in payload):
+            # A bare order without the status envelope
+            repairs.append('missing_envelope')
+            data = payload
+        if not isinstance(data, dict):
+            raise OrderDecodeError("Response has no order data")
+        order = _decode_data(data, repairs)
+    except OrderDecodeError:
+        if record_stats:
+            _stats.record(failed=True)
+        raise
+
+    if record_stats:
+        _stats.record(repairs)
+    return order
@@ -0,0 +1,256 @@
+"""
+Content-addressed cache of parse_order results.
+
+Merchants resend the same photo, forward the same voice note or type the
+same standing order every day. Results are keyed by a hash of the input
+(normalised text or raw media bytes), input type, pending order and prompt
+version, and kept in an in-memory LRU backed by an SQLite file. Entries
+expire after PARSE_CACHE_TTL seconds and the disk store is trimmed to
+PARSE_CACHE_MAX_ENTRIES by least recent use.
+
+Changing a system prompt or the model changes the prompt version, so old
+entries stop matching and are purged on startup.
+
+CLI:
+    python parse_cache.py stats
+    python parse_cache.py clear
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CACHE_PATH = os.environ.get('PARSE_CACHE_PATH', 'parse_cache.db')
+MEMORY_ENTRIES = int(os.environ.get('PARSE_CACHE_MEMORY_ENTRIES', 512))
+MAX_ENTRIES = int(os.environ.get('PARSE_CACHE_MAX_ENTRIES', 50000))
+CACHE_TTL = float(os.environ.get('PARSE_CACHE_TTL', 30 * 86400))
+ENABLED = os.environ.get('PARSE_CACHE', '1') == '1'
+
+
+def prompt_version(*parts):
+    """Short hash identifying a set of prompts and model settings."""
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def normalize_text(text):
+    """Normalise unicode and whitespace so trivially different texts share a key."""
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def parse_cache_key(content, input_type, pending_order, version):
+    """
+    Build the cache key for a parse request.
+
+    Args:
+        content (str or bytes): Message text or raw media bytes
+        input_type (str): 'image', 'audio' or 'text'
+        pending_order (dict, optional): Partial order the message updates
+        version (str): Prompt version from prompt_version()
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{version}\x00{input_type}\x00".encode('utf-8'))
+    digest.update(json.dumps(pending_order, sort_keys=True).encode('utf-8'))
+    digest.update(b'\x00')
+    if isinstance(content, bytes):
+        digest.update(content)
+    else:
+        digest.update(normalize_text(content or '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Two-level (memory LRU + SQLite) cache of parse results."""
+
+    def __init__(self, path=CACHE_PATH, memory_entries=MEMORY_ENTRIES,
+                 max_entries=MAX_ENTRIES, ttl=CACHE_TTL, version=None):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (json string, stored_at)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parse_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    version TEXT,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS parse_cache_access ON parse_cache (last_access)')
+            if version:
+                # Entries from older prompts can never match again
+                conn.execute('DELETE FROM parse_cache WHERE version IS NOT ?', (version,))
+        self.version = version
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _remember(self, key, value, stored_at):
+        self._memory[key] = (value, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Look up a cached parse result.
+
+        Returns:
+            dict: A fresh copy of the cached result, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(entry[0])
+            self._memory.pop(key, None)
+
+        row = self._connect().execute(
+            'SELECT value, created_at FROM parse_cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        self._connect().execute('UPDATE parse_cache SET last_access = ? WHERE key = ?', (now, key))
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, row[0], row[1])
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """Store a parse result. Errors are never cached."""
+        if result.get('status') == 'error':
+            return
+
+        value = json.dumps(result)
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._puts += 1
+            trim = self._puts % 100 == 0
+
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO parse_cache (key, value, version, created_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, value, self.version, now, now)
+            )
+            if trim:
+                self._trim(conn, now)
+
+    def _trim(self, conn, now):
+        """Drop expired entries and the least recently used beyond max_entries."""
+        conn.execute('DELETE FROM parse_cache WHERE created_at < ?', (now - self.ttl,))
+        conn.execute(
+            'DELETE FROM parse_cache WHERE key IN ('
+            'SELECT key FROM parse_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def invalidate_all(self):
+        """Remove every cached result, e.g. after editing a prompt by hand."""
+        with self._lock:
+            self._memory.clear()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM parse_cache')
+
+    def stats(self):
+        """
+        Hit-rate statistics.
+
+        Returns:
+            dict: memory_hits, disk_hits, misses, hit_rate, memory_entries, disk_entries
+        """
+        disk_entries = self._connect().execute('SELECT COUNT(*) FROM parse_cache').fetchone()[0]
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'disk_entries': disk_entries,
+            }
+
+
+class NullParseCache:
+    """Drop-in replacement used when PARSE_CACHE=0."""
+
+    def get(self, key):
+        return None
+
+    def put(self, key, result):
+        pass
+
+    def invalidate_all(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+_cache = None
+
+
+def get_parse_cache(version=None):
+    """Return the shared parse cache, creating it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = ParseCache(version=version) if ENABLED else NullParseCache()
+    return _cache
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    cache = ParseCache()
+    if command == 'stats':
+        print(json.dumps(cache.stats(), indent=2))
+    elif command == 'clear':
+        cache.invalidate_all()
+        print("Parse cache cleared")
+    else:
+        print(__doc__)
+        sys.exit(1)
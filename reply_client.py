@@ -0,0 +1,77 @@
+"""
+Outbound WhatsApp replies sent through the Twilio Messages REST API.
+
+Used by the async webhook mode, where the reply is delivered after the
+webhook has already returned. The client is pluggable so tests and local
+runs can use LocalReplyClient instead of calling Twilio.
+"""
+import os
+import threading
+
+
+class TwilioReplyClient:
+    """Send replies with the Twilio Messages API."""
+
+    def __init__(self, account_sid=None, auth_token=None):
+        from twilio.rest import Client
+
+        self.client = Client(
+            account_sid or os.environ.get('TWILIO_ACCOUNT_SID'),
+            auth_token or os.environ.get('TWILIO_AUTH_TOKEN')
+        )
+
+    def send(self, to, from_, body):
+        """
+        Send a WhatsApp message.
+
+        Args:
+            to (str): Recipient, e.g. 'whatsapp:+919876543210'
+            from_ (str): Bot number, e.g. 'whatsapp:+14155238886'
+            body (str): Message text
+
+        Returns:
+            str: Twilio message SID
+        """
+        message = self.client.messages.create(to=to, from_=from_, body=body)
+        print(f"📤 Reply sent to {to}: {message.sid}")
+        return message.sid
+
+
+class LocalReplyClient:
+    """Stand-in client that records replies in memory instead of sending them."""
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, from_, body):
+        with self._lock:
+            self.sent.append({'to': to, 'from': from_, 'body': body})
+            sid = f"LOCAL{len(self.sent):06d}"
+        print(f"📤 [local] Reply to {to}: {body}")
+        return sid
+
+
+REPLY_CLIENTS = {
+    'twilio': TwilioReplyClient,
+    'local': LocalReplyClient,
+}
+
+_client = None
+
+
+def get_reply_client():
+    """Return the active reply client, chosen from $REPLY_CLIENT (default 'twilio')."""
+    global _client
+    if _client is None:
+        name = os.environ.get('REPLY_CLIENT', 'twilio').lower()
+        if name not in REPLY_CLIENTS:
+            raise ValueError(f"Unknown REPLY_CLIENT '{name}'. Choose one of: {', '.join(REPLY_CLIENTS)}")
+        _client = REPLY_CLIENTS[name]()
+    return _client
+
+
+def set_reply_client(client):
+    """Replace the active reply client (e.g. with a LocalReplyClient in tests)."""
+    global _client
+    _client = client
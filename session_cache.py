@@ -0,0 +1,173 @@
+"""
+In-memory LRU + TTL cache of user records in front of a storage backend.
+
+Active merchants send many messages in a row, so their records are served
+from memory instead of going back to disk for every message. Entries expire
+after USER_CACHE_TTL seconds without access and the least recently used
+entry is evicted once USER_CACHE_SIZE records are cached.
+
+Writes are write-through by default. With USER_CACHE_WRITE_BEHIND=1 writes
+only update the cache and are flushed to the backend every
+USER_CACHE_FLUSH_INTERVAL seconds, on eviction and at exit.
+
+The cache is opt-in (USER_CACHE_SIZE defaults to 0) because it and its
+invalidation are per process: with several workers, a worker may read a
+state or pending order that another worker already changed. Only enable it
+when each merchant is served by a single process. Write-behind additionally
+loses updates made by other processes (see stress_db.py --write-behind).
+"""
+import atexit
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 0))
+CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+WRITE_BEHIND = os.environ.get('USER_CACHE_WRITE_BEHIND', '0') == '1'
+FLUSH_INTERVAL = float(os.environ.get('USER_CACHE_FLUSH_INTERVAL', 2))
+
+
+class CachedBackend:
+    """
+    Storage backend wrapper that caches user records.
+
+    Exposes the same interface as the backends in db_backends plus
+    invalidate(), flush() and stats().
+    """
+
+    def __init__(self, backend, max_size=CACHE_SIZE, ttl=CACHE_TTL,
+                 write_behind=WRITE_BEHIND, flush_interval=FLUSH_INTERVAL):
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.write_behind = write_behind
+        self._entries = OrderedDict()  # phone -> (record, last_access)
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if write_behind:
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(
+                target=self._flush_loop, args=(flush_interval,), daemon=True
+            )
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def _store(self, phone_number, user_data):
+        """Insert a record as most recently used and evict beyond max_size."""
+        self._entries[phone_number] = (copy.deepcopy(user_data), time.monotonic())
+        self._entries.move_to_end(phone_number)
+        while len(self._entries) > self.max_size:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, phone_number):
+        record, _ = self._entries.pop(phone_number)
+        if phone_number in self._dirty:
+            self.backend.put(phone_number, record)
+            self._dirty.discard(phone_number)
+        self.evictions += 1
+
+    def evict_idle(self):
+        """Evict every entry not accessed within the TTL."""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            idle = [phone for phone, (_, last) in self._entries.items() if last < cutoff]
+            for phone_number in idle:
+                self._evict(phone_number)
+        return len(idle)
+
+    def get(self, phone_number):
+        with self._lock:
+            entry = self._entries.get(phone_number)
+            if entry is not None:
+                record, last_access = entry
+                if time.monotonic() - last_access <= self.ttl:
+                    self.hits += 1
+                    self._entries[phone_number] = (record, time.monotonic())
+                    self._entries.move_to_end(phone_number)
+                    # Callers mutate the record, so never hand out the cached copy
+                    return copy.deepcopy(record)
+                self._evict(phone_number)
+
+            self.misses += 1
+            user_data = self.backend.get(phone_number)
+            if user_data is not None:
+                self._store(phone_number, user_data)
+            return user_data
+
+    def put(self, phone_number, user_data):
+        with self._lock:
+            if not self.write_behind:
+                self.backend.put(phone_number, user_data)
+            self._store(phone_number, user_data)
+            if self.write_behind:
+                self._dirty.add(phone_number)
+
+    def update(self, phone_number, mutate):
+        with self._lock:
+            entry = self._entries.get(phone_number)
+            if self.write_behind and entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                # Every write in this process goes through the cache, so the entry is current
+                user_data = mutate(copy.deepcopy(entry[0]))
+                self._store(phone_number, user_data)
+                self._dirty.add(phone_number)
+                return copy.deepcopy(user_data)
+            self._flush_one(phone_number)
+            user_data = self.backend.update(phone_number, mutate)
+            self._store(phone_number, user_data)
+            return user_data
+
+    def delete(self, phone_number):
+        with self._lock:
+            self.invalidate(phone_number)
+            self.backend.delete(phone_number)
+
+    def items(self):
+        self.flush()
+        return self.backend.items()
+
+    def invalidate(self, phone_number):
+        """Drop a cached record so the next read goes to the backend."""
+        with self._lock:
+            self._flush_one(phone_number)
+            self._entries.pop(phone_number, None)
+
+    def _flush_one(self, phone_number):
+        if phone_number in self._dirty:
+            record, _ = self._entries[phone_number]
+            self.backend.put(phone_number, record)
+            self._dirty.discard(phone_number)
+
+    def flush(self):
+        """Write every dirty record to the backend."""
+        with self._lock:
+            for phone_number in list(self._dirty):
+                self._flush_one(phone_number)
+
+    def stats(self):
+        """
+        Cache counters for sizing.
+
+        Returns:
+            dict: size, max_size, hits, misses, evictions, hit_rate, dirty
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'dirty': len(self._dirty),
+            }
@@ -0,0 +1,220 @@
+"""
+Local slot-filling for AWAITING_INFO follow-ups.
+
+When an order is incomplete the bot asks for the missing details, and the
+answer is usually tiny: "Ramesh", "rate 50", "3 kg", "rice 50, oil 120".
+Instead of sending the whole prompt and pending order back to Gemini to
+merge one field, the answer is mapped onto the pending order's
+missing_fields here and the completeness check is re-run locally.
+
+Only unambiguous answers are filled. A bare number when both a rate and a
+quantity are missing, extra values, or anything that does not look like a
+short answer returns confidence 0 so parse_order asks the model. A bare
+name is only taken as the customer when the bot asked for the customer and
+no word of the reply is a command, question or filler ("cancel order",
+"not now", "who is this"), since a wrong name completes the order and
+issues an invoice. When the bot suggested a customer from the directory,
+"yes" takes the suggestion and "no" keeps the name as the merchant sent it.
+"""
+import copy
+import re
+
+from fast_parser import CURRENCY, NON_LATIN, NUMBER, SEGMENT_SPLIT, UNITS
+from order_validation import missing_fields, order_result
+
+MISSING_SLOT = re.compile(r'^item_(\d+)_(name|qty|rate)$')
+
+# "customer: Ramesh", "bill for Ramesh", "name - Ramesh"
+CUSTOMER_ANSWER = re.compile(
+    r'^(?:(?:bill|invoice|order)\s+(?:for|to)|customer(?:\s+name)?|name|for|to)\s*[:\-]?\s*(?P<value>[a-z][a-z .&\']*)$',
+    re.IGNORECASE
+)
+# A bare customer name: letters only, at most four words
+NAME_ONLY = re.compile(r"^[a-z][a-z.&']*(?:\s+[a-z.&']+){0,3}$", re.IGNORECASE)
+# Words that make a short reply a command, question or filler rather than a name
+NOT_NAME_WORDS = {
+    'ok', 'okay', 'yes', 'yeah', 'yep', 'no', 'nope', 'not', 'wait', 'cancel', 'stop', 'hold', 'thanks',
+    'thank', 'thx', 'please', 'pls', 'plz', 'who', 'what', 'why', 'when', 'where', 'how', 'which', 'send',
+    'tomorrow', 'today', 'now', 'later', 'again', 'sorry', 'hi', 'hello', 'hey', 'done', 'skip', 'help',
+    'same', 'change', 'edit', 'delete', 'remove', 'add', 'make', 'bill', 'invoice', 'order', 'item',
+    'items', 'rate', 'price', 'qty', 'quantity', 'this', 'that', 'it', 'you', 'your', 'haan', 'nahi',
+    'nahin', 'bas', 'theek', 'hai', 'ji', 'kal', 'abhi', 'mat', 'karo', 'bhejo', 'ruko',
+}
+# Answers to "Is this for Ramesh Kumar?"
+CONFIRM_WORDS = {'yes', 'y', 'yeah', 'yep', 'ok', 'okay', 'correct', 'right', 'haan', 'han', 'ha', 'ji', 'sahi'}
+DENY_WORDS = {'no', 'n', 'nope', 'wrong', 'nahi', 'nahin', 'na'}
+RATE_ANSWER = re.compile(
+    rf'^(?:(?:rate|price|cost)\s*(?:is|[:\-=])?\s*|@\s*|at\s+)?(?P<currency>{CURRENCY})?\s*(?P<value>{NUMBER})'
+    rf'\s*(?P<suffix>{CURRENCY}|/-|each|per\s+\w+|/\s*{UNITS})?$',
+    re.IGNORECASE
+)
+QTY_ANSWER = re.compile(
+    rf'^(?:(?:qty|quantity)\s*(?:is|[:\-=])?\s*)?(?P<value>{NUMBER})\s*(?P<unit>{UNITS}|units?)?$',
+    re.IGNORECASE
+)
+# "rice 50", "rice @ 50", "rice rate 50", "rice 3 kg"
+ITEM_ANSWER = re.compile(
+    rf'^(?P<name>[a-z][a-z ]*?)\s*(?:(?P<kind>rate|price|qty|quantity)\s*)?(?P<sep>@|=|:|-|\bat\b)?\s*'
+    rf'(?P<currency>{CURRENCY})?\s*(?P<value>{NUMBER})\s*(?P<unit>{UNITS})?(?P<suffix>\s*(?:each|/-|/\s*{UNITS}))?$',
+    re.IGNORECASE
+)
+
+
+def _number(value):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _is_name(value):
+    """True if a reply can be a customer name: letters only, short, no command or filler words."""
+    words = re.findall(r"[a-z]+", value.lower())
+    return bool(NAME_ONLY.match(value)) and bool(words) and not any(word in NOT_NAME_WORDS for word in words)
+
+
+def _classify(segment):
+    """
+    Classify one answer segment.
+
+    Returns:
+        tuple: (kind, value, item_name) where kind is 'customer', 'rate',
+            'qty' or 'number' (could be either), or None if unrecognised
+    """
+    match = CUSTOMER_ANSWER.match(segment)
+    if match:
+        value = match.group('value').strip(" .'")
+        return ('customer', value, None) if _is_name(value) else (None, None, None)
+
+    match = RATE_ANSWER.match(segment)
+    if match and (match.group('currency') or match.group('suffix') or not segment[0].isdigit()):
+        return 'rate', _number(match.group('value')), None
+
+    match = QTY_ANSWER.match(segment)
+    if match:
+        labelled = match.group('unit') or not segment[0].isdigit()
+        return ('qty' if labelled else 'number'), _number(match.group('value')), None
+
+    match = ITEM_ANSWER.match(segment)
+    if match:
+        kind = (match.group('kind') or '').lower()
+        if kind in ('rate', 'price') or match.group('sep') or match.group('currency') or match.group('suffix'):
+            slot = 'rate'
+        elif kind in ('qty', 'quantity') or match.group('unit'):
+            slot = 'qty'
+        else:
+            slot = 'number'
+        return slot, _number(match.group('value')), match.group('name').strip()
+
+    if _is_name(segment):
+        return 'customer', segment.strip(" .'"), None
+    return None, None, None
+
+
+def _item_index(items, name):
+    """Index of the pending item whose name matches an answer, or None."""
+    name = name.lower()
+    matches = [
+        idx for idx, item in enumerate(items)
+        if item.get('name') and (name in item['name'].lower() or item['name'].lower() in name)
+    ]
+    return matches[0] if len(matches) == 1 else None
+
+
+def fill_slots(pending_order, text):
+    """
+    Merge a short follow-up answer into a pending order.
+
+    Args:
+        pending_order (dict): Partial order data saved in AWAITING_INFO
+        text (str): The user's follow-up message
+
+    Returns:
+        tuple: (result, confidence) where result has the parse_order
+            structure {status, data, missing_fields}. confidence is 1.0 when
+            every part of the answer was mapped onto a missing field and 0
+            when the model should interpret the message instead.
+    """
+    if not pending_order or not text or not text.strip() or NON_LATIN.search(text):
+        return None, 0.0
+
+    data = copy.deepcopy(pending_order)
+    items = data.get('items') or []
+    missing = missing_fields(data)
+    if not missing or 'items' in missing:
+        # Nothing to fill, or the whole item list is still missing
+        return None, 0.0
+
+    # field -> indexes of the items still missing it
+    open_slots = {'rate': [], 'qty': []}
+    for field in missing:
+        match = MISSING_SLOT.match(field)
+        if match and match.group(2) in open_slots:
+            open_slots[match.group(2)].append(int(match.group(1)) - 1)
+
+    body = re.sub(r'(?<=\d),(?=\d{3}\b)', '', text.strip())
+    segments = [s.strip(' .') for s in SEGMENT_SPLIT.split(body) if s.strip(' .')]
+    if not segments or len(segments) > len(missing):
+        return None, 0.0
+
+    unassigned = []
+    for segment in segments:
+        answer = segment.lower()
+        if data.get('customer_suggestion') and answer in CONFIRM_WORDS | DENY_WORDS:
+            if 'customer' not in missing or data.get('customer'):
+                return None, 0.0
+            data['customer'] = data['customer_suggestion'] if answer in CONFIRM_WORDS else data.get('customer_as_sent')
+            data.pop('customer_suggestion')
+            continue
+
+        kind, value, item_name = _classify(segment)
+        if kind is None or (kind != 'customer' and value <= 0):
+            # "rate 0" is not an answer to invoice; let the model ask again
+            return None, 0.0
+
+        if kind == 'customer':
+            if 'customer' not in missing or data.get('customer'):
+                return None, 0.0
+            data['customer'] = value.title() if value.islower() else value
+            continue
+
+        if item_name is not None:
+            idx = _item_index(items, item_name)
+            if idx is None:
+                return None, 0.0
+            if kind == 'number':
+                # "rice 50": fill whichever of rate/qty the item is missing
+                candidates = [slot for slot in ('rate', 'qty') if idx in open_slots[slot]]
+                if len(candidates) != 1:
+                    return None, 0.0
+                kind = candidates[0]
+            if idx not in open_slots[kind]:
+                return None, 0.0
+            items[idx][kind] = value
+            open_slots[kind].remove(idx)
+            continue
+
+        unassigned.append((kind, value))
+
+    # Unlabelled values fill the open slots in item order
+    for kind in ('rate', 'qty'):
+        values = [value for value_kind, value in unassigned if value_kind == kind]
+        if values:
+            if len(values) != len(open_slots[kind]):
+                return None, 0.0
+            for idx, value in zip(list(open_slots[kind]), values):
+                items[idx][kind] = value
+            open_slots[kind] = []
+
+    numbers = [value for value_kind, value in unassigned if value_kind == 'number']
+    if numbers:
+        remaining = [kind for kind in ('rate', 'qty') if open_slots[kind]]
+        if len(remaining) != 1 or len(numbers) != len(open_slots[remaining[0]]):
+            # A bare "50" when both a rate and a quantity are missing
+            return None, 0.0
+        for idx, value in zip(list(open_slots[remaining[0]]), numbers):
+            items[idx][remaining[0]] = value
+
+    if data.get('customer'):
+        # The suggestion was answered; 'customer_asked' stays so it is not asked again
+        data.pop('customer_suggestion', None)
+        data.pop('customer_as_sent', None)
+    return order_result(data), 1.0
@@ -0,0 +1,106 @@
+"""
+Concurrency stress test for the user database backends.
+
+Spawns several worker processes that hammer the store at the same time:
+each worker creates its own users and all workers increment a shared
+counter on one hot user. Afterwards every record and every increment must
+be present, otherwise updates were lost.
+
+With --cache the workers go through the session cache (CachedBackend) and
+also read the hot user between increments, as UserSession does; add
+--write-behind to batch writes in the cache as well. Write-behind keeps
+writes in one process's memory, so it is expected to lose updates with more
+than one process.
+
+Usage:
+    python stress_db.py [json|sharded|sqlite] [processes] [ops_per_process] [--cache] [--write-behind]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from db_backends import create_backend
+from session_cache import CACHE_TTL, CachedBackend
+
+HOT_USER = 'whatsapp:+910000000000'
+
+
+def open_backend(backend_name, path, cache=False, write_behind=False):
+    backend = create_backend(backend_name, path)
+    if cache:
+        backend = CachedBackend(backend, max_size=1024, ttl=CACHE_TTL, write_behind=write_behind)
+    return backend
+
+
+def worker(backend_name, path, worker_id, ops, cache=False, write_behind=False):
+    backend = open_backend(backend_name, path, cache, write_behind)
+
+    def increment(user_data):
+        user_data = user_data or {'phone': HOT_USER, 'counter': 0}
+        user_data['counter'] += 1
+        return user_data
+
+    for i in range(ops):
+        phone_number = f"whatsapp:+91{worker_id:03d}{i:06d}"
+        backend.put(phone_number, {'phone': phone_number, 'worker': worker_id, 'seq': i})
+        backend.get(HOT_USER)
+        backend.update(HOT_USER, increment)
+
+    if cache:
+        # Worker processes exit without running atexit handlers
+        backend.flush()
+
+
+def run(backend_name='sharded', processes=8, ops=200, cache=False, write_behind=False):
+    workdir = tempfile.mkdtemp(prefix='billbot-stress-')
+    path = os.path.join(workdir, 'user_data.db' if backend_name == 'sqlite' else 'user_data')
+    if backend_name == 'json':
+        path += '.json'
+
+    try:
+        # Create schema/directories before the workers start
+        create_backend(backend_name, path)
+
+        start = time.perf_counter()
+        procs = [
+            multiprocessing.Process(target=worker, args=(backend_name, path, w, ops, cache, write_behind))
+            for w in range(processes)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        failed = [p.exitcode for p in procs if p.exitcode != 0]
+        backend = create_backend(backend_name, path)
+        records = dict(backend.items())
+        expected = processes * ops
+        missing = sum(
+            1 for w in range(processes) for i in range(ops)
+            if f"whatsapp:+91{w:03d}{i:06d}" not in records
+        )
+        counter = (records.get(HOT_USER) or {}).get('counter', 0)
+
+        mode = ' + write-behind cache' if write_behind else ' + cache' if cache else ''
+        print(f"Backend: {backend_name}{mode} | {processes} processes x {ops} ops in {elapsed:.2f}s")
+        print(f"Records: {expected - missing}/{expected} present, hot counter {counter}/{expected}")
+
+        ok = not failed and missing == 0 and counter == expected
+        print("✅ No lost updates" if ok else f"❌ Lost updates (worker exit codes: {failed})")
+        return ok
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    flags = {arg for arg in sys.argv[1:] if arg.startswith('--')}
+    backend_name = args[0] if len(args) > 0 else 'sharded'
+    processes = int(args[1]) if len(args) > 1 else 8
+    ops = int(args[2]) if len(args) > 2 else 200
+    write_behind = '--write-behind' in flags
+    sys.exit(0 if run(backend_name, processes, ops, '--cache' in flags or write_behind, write_behind) else 1)
@@ -0,0 +1,149 @@
+"""
+Conversation flow tests for the WhatsApp webhook.
+
+Messages are posted to /whatsapp through Flask's test client with the fake
+model backend and throwaway SQLite stores. Invoice issuing is replaced by a
+recorder, or PDF rendering by a no-op, so no PDFs are written.
+
+Usage:
+    python -m pytest test_conversation.py
+"""
+import copy
+import os
+import tempfile
+import uuid
+
+# Settings are read at import time, so point every store at a scratch directory first
+WORKDIR = tempfile.mkdtemp(prefix='billbot-test-')
+os.environ.update({
+    'LLM_BACKEND': 'fake',
+    'DB_BACKEND': 'sqlite',
+    'DB_PATH': os.path.join(WORKDIR, 'user_data.db'),
+    'JOB_QUEUE_PATH': os.path.join(WORKDIR, 'jobs.db'),
+    'IDEMPOTENCY_PATH': os.path.join(WORKDIR, 'idempotency.db'),
+    'PARSE_CACHE_PATH': os.path.join(WORKDIR, 'parse_cache.db'),
+    'IMPORT_PATH': os.path.join(WORKDIR, 'imports.db'),
+    'INVOICE_NUMBERS_PATH': os.path.join(WORKDIR, 'invoice_numbers.db'),
+    'ITEM_CATALOG_PATH': os.path.join(WORKDIR, 'item_catalog.db'),
+    'CONVERSATION_LOG_DIR': os.path.join(WORKDIR, 'conversation_logs'),
+    'ASYNC_WEBHOOK': '0',
+})
+
+import pytest
+
+import app as billbot
+import invoice_gen
+from db_manager import get_user, update_user
+from invoice_numbers import get_allocator
+
+
+def onboarded_merchant():
+    phone = f"whatsapp:+91{uuid.uuid4().int % 10**10:010d}"
+    update_user(phone, {'state': 'READY', 'company_details': {'name': 'Test Traders'}})
+    return phone
+
+
+@pytest.fixture
+def merchant(monkeypatch):
+    """An onboarded merchant; returns (phone, list of issued invoice orders)."""
+    phone = onboarded_merchant()
+    issued = []
+
+    def issue_invoice(phone_number, data, company_details=None, **kwargs):
+        issued.append(copy.deepcopy(data))
+        return f"INV-{len(issued):06d}", f"invoice_{len(issued)}.pdf"
+
+    monkeypatch.setattr(billbot, 'issue_invoice', issue_invoice)
+    return phone, issued
+
+
+def send(phone, body):
+    """Post one message to the webhook and return the reply TwiML."""
+    with billbot.app.test_client() as client:
+        response = client.post('/whatsapp', data={'From': phone, 'Body': body, 'MessageSid': uuid.uuid4().hex})
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_reply_after_invoice_does_not_reuse_the_order(merchant):
+    phone, issued = merchant
+
+    assert 'Customer name' in send(phone, '10 rice at 50')
+    assert get_user(phone)['state'] == 'AWAITING_INFO'
+
+    assert 'INV-000001' in send(phone, 'Ramesh')
+    assert issued == [{'customer': 'Ramesh', 'items': [{'name': 'Rice', 'qty': 10, 'rate': 50}]}]
+    user = get_user(phone)
+    assert user['state'] == 'READY'
+    assert user['pending_order'] is None
+
+    # A stray name is not an answer to the invoiced order
+    assert 'INV-' not in send(phone, 'Suresh')
+    assert len(issued) == 1
+
+
+def test_stale_pending_order_is_ignored_outside_awaiting_info(merchant):
+    phone, issued = merchant
+    # A record left with an old order by an earlier version of the bot
+    update_user(phone, {'state': 'READY', 'pending_order': {'customer': None, 'items': [{'name': 'Rice', 'qty': 10, 'rate': 50}]}})
+
+    assert 'INV-' not in send(phone, 'Suresh')
+    assert issued == []
+
+
+def test_text_order_after_an_invoice_takes_the_fast_path(merchant, capsys):
+    phone, issued = merchant
+    send(phone, '10 rice at 50')
+    send(phone, 'Ramesh')
+    capsys.readouterr()
+
+    assert 'INV-000002' in send(phone, 'Bill for Mahesh: 5 oil at 100')
+    assert '⚡ Parsed locally' in capsys.readouterr().out
+    assert issued[-1] == {'customer': 'Mahesh', 'items': [{'name': 'Oil', 'qty': 5, 'rate': 100}]}
+
+
+def test_zero_quantity_is_asked_for_not_invoiced(merchant):
+    phone, issued = merchant
+
+    assert 'Quantity' in send(phone, 'Bill for Ravi: 0 rice at 50')
+    assert issued == []
+    assert 'INV-000001' in send(phone, '10')
+    assert issued[0]['items'] == [{'name': 'Rice', 'qty': 10, 'rate': 50}]
+
+
+def test_retried_render_job_reuses_its_invoice_number(monkeypatch):
+    monkeypatch.setattr(invoice_gen, 'generate_pdf', lambda *args, **kwargs: None)
+    phone = onboarded_merchant()
+    payload = {
+        'sender': phone, 'bot_number': 'whatsapp:+10000000000', 'incoming_msg': 'Bill for Ramesh: 10 rice at 50',
+        'host_url': 'http://localhost/', 'order_data': {'customer': 'Ramesh', 'items': [{'name': 'Rice', 'qty': 10, 'rate': 50}]}
+    }
+
+    first = billbot.handle_render_job(payload, {'id': 41})
+    retry = billbot.handle_render_job(payload, {'id': 41})
+    billbot.handle_render_job(payload, {'id': 42})
+
+    assert 'INV-000001' in first[0][1]['body']
+    assert retry == first
+    ledger = get_allocator().ledger(phone)
+    assert (ledger['issued'], ledger['last_issued']) == (2, 2)
+
+
+def test_model_order_with_a_bad_value_asks_for_it(merchant, monkeypatch):
+    phone, issued = merchant
+    response = '{"status": "complete", "data": {"customer": "Ramesh", "items": [{"name": "Rice", "qty": 10, "rate": -50}]}}'
+    monkeypatch.setattr(billbot.get_extractor(), '_generate', lambda request, timeout: response)
+
+    reply = send(phone, 'bill ramesh rice ten bags rate minus fifty')
+    assert 'Price/rate' in reply
+    assert issued == []
+    assert get_user(phone)['pending_order']['items'] == [{'name': 'Rice', 'qty': 10, 'rate': None}]
+
+
+def test_stats_report_media_and_user_cache():
+    with billbot.app.test_client() as client:
+        stats = client.get('/stats').get_json()
+
+    assert stats['media']['pool_size'] > 0
+    assert 'downloads' in stats['media']
+    assert 'user_cache' in stats